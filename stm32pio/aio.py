@@ -0,0 +1,195 @@
+"""
+asyncio API for the project actions. Subprocesses are driven by the event loop itself so no thread is wasted per a
+running action (see AsyncStm32pio)
+"""
+
+import asyncio
+import functools
+import logging
+from typing import Any, Awaitable, Callable, List, Mapping, Tuple
+
+import stm32pio.lib
+import stm32pio.settings
+import stm32pio.util
+
+
+# Loop of the current coroutine. Python 3.6 has no get_running_loop() but get_event_loop() is equivalent when called from
+# a coroutine there
+get_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class AsyncStm32pio:
+    """
+    Wrapper around the Stm32pio instance providing the coroutine versions of the actions spawning the subprocesses
+    (generate_code, pio_init, build). Everything else (state, config, patch(), clean(), ...) is forwarded to the wrapped
+    project as-is as these are quick filesystem operations.
+
+    The subprocess output is streamed into the project logger in the same way the sync API does. Cancel the task to stop
+    the action: the child process will be terminated (and killed if it doesn't respond in time). The blocking steps
+    around the subprocesses (state probes, fingerprints, firmware cache hashing and copying) are performed in the default
+    executor so one project doesn't stall the others.
+
+    Note: on Windows, the event loop should be the ProactorEventLoop (default since Python 3.8) to support subprocesses.
+
+    Example:
+
+        async def build_all(paths):
+            projects = [stm32pio.aio.AsyncStm32pio(stm32pio.lib.Stm32pio(path)) for path in paths]
+            return await asyncio.gather(*(project.build() for project in projects))
+    """
+
+    def __init__(self, project: stm32pio.lib.Stm32pio,
+                 terminate_timeout: float = stm32pio.settings.async_terminate_timeout):
+        """
+        Args:
+            project: project to operate on
+            terminate_timeout: seconds to wait for the child process to exit after the termination request on
+                cancellation. It is killed afterwards
+        """
+        self.project = project
+        self.terminate_timeout = terminate_timeout
+
+    def __getattr__(self, name: str):
+        return getattr(self.project, name)
+
+    def __repr__(self):
+        return f"AsyncStm32pio({self.project!r})"
+
+    async def _terminate(self, process: asyncio.subprocess.Process) -> None:
+        """Stop the child process gracefully if possible"""
+        if process.returncode is not None:
+            return
+        self.project.logger.warning(f"the action has been cancelled, terminating the process (PID {process.pid})...")
+        try:
+            process.terminate()
+            await asyncio.wait_for(process.wait(), timeout=self.terminate_timeout)
+        except ProcessLookupError:
+            pass  # already finished
+        except asyncio.TimeoutError:
+            self.project.logger.warning("the process didn't respond, killing it")
+            process.kill()
+            await process.wait()
+
+    async def _run(self, command_arr: List[str], level: int,
+                   capture: stm32pio.util.LogPipeCapture = stm32pio.util.LogPipeCapture.FULL,
+                   encoding: str = None) -> Tuple[int, str]:
+        """
+        Run the command streaming its merged STDOUT/STDERR output into the logging (use level=None to only capture the
+        output)
+
+        Returns:
+            return code and the captured output
+        """
+
+        output = stm32pio.util.OutputLogger(self.project.logger, level, capture=capture, encoding=encoding)
+        process = await asyncio.create_subprocess_exec(*command_arr, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.STDOUT)
+        try:
+            while True:
+                chunk = await process.stdout.read(65536)
+                output.feed(chunk)
+                if chunk == b'':  # EOF
+                    break
+            return_code = await process.wait()
+        except asyncio.CancelledError:
+            await self._terminate(process)
+            raise
+        return return_code, output.value
+
+    @staticmethod
+    async def _in_executor(func: Callable[..., Any], *args) -> Any:
+        """Run the blocking function in the default executor"""
+        return await get_running_loop().run_in_executor(None, func, *args)
+
+    async def generate_code(self, force: bool = False) -> int:
+        """
+        Coroutine version of the Stm32pio.generate_code(). The persistent CubeMX worker (if any) is thread-based so it
+        is called in the default executor
+
+        Returns:
+            return code on success, raises an exception otherwise
+        """
+
+        project = self.project
+        cubemx_script_content, fingerprint = await self._in_executor(project._prepare_generation, force)
+        if cubemx_script_content is None:
+            return 0
+
+        with project._recorded('generate_code'):
+            try:
+                # Can start the worker process (JVM) so is performed outside the loop
+                if await self._in_executor(project._can_use_cubemx_worker):
+                    return_code, result_output = await self._in_executor(
+                        project.cubemx_worker.run_script, cubemx_script_content, project.logger)
+                else:
+                    with project._cubemx_script_file(cubemx_script_content) as cubemx_script_name:
+                        return_code, result_output = await self._run(project._cubemx_command(cubemx_script_name),
+                                                                     logging.DEBUG)
+            finally:
+                project.invalidate_state()
+
+            return await self._in_executor(project._finish_generation, return_code, result_output, fingerprint)
+
+    async def pio_init(self) -> int:
+        """
+        Coroutine version of the Stm32pio.pio_init()
+
+        Returns:
+            return code of the PlatformIO on success, raises an exception otherwise
+        """
+        command_arr = self.project._prepare_pio_init()
+        with self.project._recorded('pio_init'):
+            try:
+                # The output is analyzed and logged as a whole afterwards, same as the sync version does
+                return_code, result_output = await self._run(command_arr, None, encoding='utf-8')
+            finally:
+                self.project.invalidate_state()
+            return await self._in_executor(self.project._check_pio_init_result, return_code, result_output)
+
+    async def build(self, force: bool = False) -> int:
+        """
+        Coroutine version of the Stm32pio.build()
+
+        Returns:
+            passes a return code of the PlatformIO
+        """
+        skip, fingerprint, cache_key = await self._in_executor(self.project._lookup_build, force)
+        if skip:
+            return 0
+
+        command_arr, log_level = self.project._prepare_build()
+        with self.project._recorded('build') as run:
+            try:
+                return_code, _ = await self._run(command_arr, log_level, capture=stm32pio.util.LogPipeCapture.NONE)
+            finally:
+                self.project.invalidate_state()
+            run['success'] = return_code == 0
+            return await self._in_executor(self.project._check_build_result, return_code, fingerprint, cache_key)
+
+    async def run_pipeline(self, with_build: bool = False, force: bool = False,
+                           actions: Mapping[str, Callable[[], Awaitable[Any]]] = None) \
+            -> List[stm32pio.lib.PipelineStep]:
+        """
+        Coroutine version of the Stm32pio.run_pipeline(). 'actions' replacements should be coroutine functions (the plan
+        and the patch are performed in the default executor)
+
+        Returns:
+            the executed plan
+        """
+
+        steps = await self._in_executor(functools.partial(self.project.plan, with_build=with_build, force=force))
+        for step in steps:
+            if not step.run:
+                self.project.logger.info(f"skipping '{step.action}': {step.reason}")
+                continue
+            if actions is not None and step.action in actions:
+                result = await actions[step.action]()
+            elif step.action in ['generate_code', 'build']:
+                result = await getattr(self, step.action)(force=force)
+            elif step.action == 'patch':
+                result = await self._in_executor(self.project.patch)
+            else:
+                result = await getattr(self, step.action)()
+            if step.action == 'build' and result != 0:
+                raise Exception("PlatformIO build error")
+        return steps
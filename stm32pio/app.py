@@ -4,20 +4,20 @@
 __version__ = '1.30'
 
 import argparse
-import inspect
 import logging
+import os
 import pathlib
 import sys
 from typing import Optional, List
 
+# The CLI is called from the shell prompts and editor hooks so its start-up time matters. Only the essentials are
+# imported here, the modules needed by the particular subcommands are imported on demand (see main())
 try:
     import stm32pio.settings
-    import stm32pio.lib
     import stm32pio.util
 except ModuleNotFoundError:
     sys.path.append(str(pathlib.Path(sys.path[0]).parent))  # hack to be able to run the app as 'python app.py'
     import stm32pio.settings
-    import stm32pio.lib
     import stm32pio.util
 
 
@@ -32,14 +32,17 @@ def parse_args(args: List[str]) -> Optional[argparse.Namespace]:
         argparse.Namespace or None if no arguments were given
     """
 
-    root_parser = argparse.ArgumentParser(description=inspect.cleandoc('''
-        Automation of creating and updating STM32CubeMX-PlatformIO projects. Requirements: Python 3.6+, STM32CubeMX,
-        Java, PlatformIO CLI. Visit https://github.com/ussserrr/stm32pio for more information. Use 'help' command to
-        take a glimpse on the available functionality'''))
+    root_parser = argparse.ArgumentParser(description=(
+        "Automation of creating and updating STM32CubeMX-PlatformIO projects. Requirements: Python 3.6+, STM32CubeMX, "
+        "Java, PlatformIO CLI. Visit https://github.com/ussserrr/stm32pio for more information. Use 'help' command to "
+        "take a glimpse on the available functionality"))
 
     # Global arguments (there is also an automatically added '-h, --help' option)
     root_parser.add_argument('--version', action='version', version=f"stm32pio v{__version__}")
     root_parser.add_argument('-v', '--verbose', help="enable verbose output (default: INFO)", action='count', default=0)
+    root_parser.add_argument('--trace', metavar='FILE',
+                             help="record the timings of the performed actions and their subprocesses to the FILE (in "
+                                  "Chrome trace_event JSON format, open it with chrome://tracing or ui.perfetto.dev)")
 
     subparsers = root_parser.add_subparsers(dest='subcommand', title='subcommands', description="valid subcommands",
                                             help="available actions")
@@ -52,23 +55,61 @@ def parse_args(args: List[str]) -> Optional[argparse.Namespace]:
                                                    "be passed forward, see its --help for more information")
     parser_generate = subparsers.add_parser('generate', help="generate CubeMX code only")
     parser_status = subparsers.add_parser('status', help="get the description of the current project state")
+    parser_stats = subparsers.add_parser('stats', help="show the statistics of the actions durations (median, 95th "
+                                                       "percentile, trend) from the project history")
     parser_clean = subparsers.add_parser('clean',
                                          help="clean-up the project (delete ALL content of 'path' except an .ioc file)")
+    parser_batch = subparsers.add_parser('batch', help="run one of the actions above for many projects in parallel")
+    parser_watch = subparsers.add_parser('watch', help="regenerate the code (and rebuild the project) automatically "
+                                                       "on the .ioc file (and the sources) changes. Stop by Ctrl+C")
 
     # Common subparsers options
-    for parser in [parser_init, parser_new, parser_gui, parser_generate, parser_status, parser_clean]:
+    for parser in [parser_init, parser_new, parser_gui, parser_generate, parser_status, parser_stats, parser_clean,
+                   parser_watch]:
         parser.add_argument('-d', '--directory', dest='path', default=pathlib.Path.cwd(),
                             help="path to the project (current directory, if not given)")
-    for parser in [parser_init, parser_new, parser_gui]:
+    for parser in [parser_init, parser_new, parser_gui, parser_batch]:
         parser.add_argument('-b', '--board', dest='board', default='', help="PlatformIO name of the board")
     for parser in [parser_init, parser_new, parser_generate]:
         parser.add_argument('--start-editor', dest='editor',
                             help="use specified editor to open the PlatformIO project (e.g. subl, code, atom, etc.)")
-    for parser in [parser_new, parser_generate]:
+    for parser in [parser_new, parser_generate, parser_batch, parser_watch]:
         parser.add_argument('--with-build', action='store_true', help="build the project after generation")
-
-    parser_clean.add_argument('-q', '--quiet', action='store_true',
-                              help="suppress the caution about the content removal (be sure of what you are doing!)")
+    for parser in [parser_new, parser_generate, parser_batch]:
+        parser.add_argument('--force', action='store_true',
+                            help="run the code generation (and the build) even if the .ioc file and the CubeMX "
+                                 "parameters (the sources) haven't been changed since the last successful one")
+
+    for parser in [parser_clean, parser_batch]:
+        parser.add_argument('-q', '--quiet', action='store_true',
+                            help="suppress the caution about the content removal (be sure of what you are doing!)")
+        parser.add_argument('--wait', action='store_true',
+                            help="wait for the removed files to be actually deleted (otherwise it is done in the "
+                                 "background and, if interrupted by the exit, continued by the next stm32pio run)")
+
+    parser_new.add_argument('--plan', action='store_true',
+                            help="only print the actions to be performed (the project stages already fulfilled are "
+                                 "skipped) and exit")
+
+    parser_stats.add_argument('-a', '--action', choices=['generate_code', 'pio_init', 'patch', 'build'],
+                              help="show only the given action")
+
+    parser_watch.add_argument('--polling', action='store_true',
+                              help="check the files periodically instead of using the OS notifications")
+
+    parser_batch.add_argument('action', choices=stm32pio.settings.batch_actions,
+                              help="action to perform for every project")
+    parser_batch.add_argument('paths', nargs='+', metavar='path',
+                              help="paths to the projects or glob patterns (quote them to prevent the shell expansion, "
+                                   "e.g. 'projects/*')")
+    parser_batch.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                              help="number of projects processed simultaneously (default: CPU count)")
+    parser_batch.add_argument('--cubemx-jobs', type=int,
+                              help="maximum number of simultaneous CubeMX code generations (default: same as --jobs)")
+    parser_batch.add_argument('--build-jobs', type=int,
+                              help="maximum number of simultaneous PlatformIO builds (default: same as --jobs)")
+    parser_batch.add_argument('--persistent-cubemx', action='store_true',
+                              help="keep the CubeMX processes running and reuse them for all projects")
 
     if len(args) == 0:
         root_parser.print_help()
@@ -141,6 +182,13 @@ def main(sys_argv: List[str] = None, should_setup_logging: bool = True) -> int:
         print("\nNo arguments were given, exiting...")
         return 0
 
+    # Note: the imports inside the function make the 'stm32pio' name local so bind it before anything else
+    import stm32pio.lib  # needed by every subcommand
+
+    if args.trace:
+        import stm32pio.trace
+        stm32pio.trace.set_tracer(stm32pio.trace.Tracer())
+
     # Main routine
     try:
         if args.subcommand == 'init':
@@ -156,24 +204,25 @@ def main(sys_argv: List[str] = None, should_setup_logging: bool = True) -> int:
 
         elif args.subcommand == 'new':
             project = stm32pio.lib.Stm32pio(args.path, parameters={'project': {'board': args.board}},
-                                            instance_options={'save_on_destruction': True})
+                                            instance_options={'save_on_destruction': not args.plan})
+            if args.plan:  # dry run
+                for step in project.plan(with_build=args.with_build, force=args.force):
+                    print(f"{'[run] ' if step.run else '[skip]'}  {step.action:<14} ({step.reason})")
+                return 0
             if project.config.get('project', 'board') == '':
                 raise Exception("PlatformIO board identifier is not specified, it is needed for PlatformIO project "
                                 "creation. Type 'pio boards' or go to https://platformio.org to find an appropriate "
                                 "identifier")
-            project.generate_code()
-            project.pio_init()
-            project.patch()
-            if args.with_build:
-                project.build()
+            # Only the missing stages are performed so it is safe to call 'new' for the half-finished project again
+            project.run_pipeline(with_build=args.with_build, force=args.force)
             if args.editor:
                 project.start_editor(args.editor)
 
         elif args.subcommand == 'generate':
             project = stm32pio.lib.Stm32pio(args.path)
-            project.generate_code()
+            project.generate_code(force=args.force)
             if args.with_build:
-                project.build()
+                project.build(force=args.force)
             if args.editor:
                 project.start_editor(args.editor)
 
@@ -181,17 +230,48 @@ def main(sys_argv: List[str] = None, should_setup_logging: bool = True) -> int:
             project = stm32pio.lib.Stm32pio(args.path)
             print(project.state)
 
+        elif args.subcommand == 'stats':
+            import stm32pio.history
+            project = stm32pio.lib.Stm32pio(args.path)
+            print(stm32pio.history.format_stats(project.history.stats(args.action), project.history.last_versions()))
+
+        elif args.subcommand == 'batch':
+            import stm32pio.batch
+            paths = stm32pio.batch.expand_paths(args.paths)
+            if args.action == 'clean' and not args.quiet:
+                while True:
+                    reply = input(f'WARNING: this operation will delete ALL content of {len(paths)} directories except '
+                                  'the .ioc files. Are you sure? (y/n) ')
+                    if reply.lower() in ['y', 'yes', 'true', '1']:
+                        break
+                    elif reply.lower() in ['n', 'no', 'false', '0']:
+                        return 0
+            runner = stm32pio.batch.BatchRunner(args.action, jobs=args.jobs, cubemx_jobs=args.cubemx_jobs,
+                                                build_jobs=args.build_jobs, board=args.board,
+                                                with_build=args.with_build, force=args.force,
+                                                persistent_cubemx=args.persistent_cubemx,
+                                                wait_clean=args.wait)
+            results = runner.run(paths)
+            print(stm32pio.batch.format_summary(args.action, results))
+            if not all(result.success for result in results):
+                return -1
+
+        elif args.subcommand == 'watch':
+            import stm32pio.watch
+            project = stm32pio.lib.Stm32pio(args.path)
+            stm32pio.watch.watch(project, with_build=args.with_build, polling=args.polling)
+
         elif args.subcommand == 'clean':
             project = stm32pio.lib.Stm32pio(args.path)
             if args.quiet:
-                project.clean()
+                project.clean(wait=args.wait)
             else:
                 while True:
                     reply = input(f'WARNING: this operation will delete ALL content of the directory "{project.path}" '
                                   f'except the "{pathlib.Path(project.config.get("project", "ioc_file")).name}" file. '
                                   'Are you sure? (y/n) ')
                     if reply.lower() in ['y', 'yes', 'true', '1']:
-                        project.clean()
+                        project.clean(wait=args.wait)
                         break
                     elif reply.lower() in ['n', 'no', 'false', '0']:
                         break
@@ -201,6 +281,15 @@ def main(sys_argv: List[str] = None, should_setup_logging: bool = True) -> int:
         stm32pio.util.log_current_exception(logger)
         return -1
 
+    finally:
+        if args.trace:
+            tracer = stm32pio.trace.set_tracer(None)
+            try:
+                tracer.write(args.trace)
+                logger.info(f"trace has been written to {args.trace}")
+            except Exception:
+                stm32pio.util.log_current_exception(logger)
+
     return 0
 
 
@@ -0,0 +1,173 @@
+"""
+Running the same action across many projects in parallel (see 'batch' CLI subcommand)
+"""
+
+import collections
+import concurrent.futures
+import contextlib
+import glob
+import logging
+import os
+import queue
+import time
+from typing import List, Iterable, Tuple
+
+import stm32pio.lib
+import stm32pio.settings
+import stm32pio.util
+
+
+ACTIONS = stm32pio.settings.batch_actions
+
+# Outcome of the action for a single project. 'message' is a stage for the 'status' action and an error description for
+# the failed ones
+BatchResult = collections.namedtuple('BatchResult', ['path', 'success', 'duration', 'message'])
+
+
+def expand_paths(patterns: Iterable[str]) -> List[str]:
+    """
+    Expand glob patterns (e.g. 'projects/*') preserving an order and dropping duplicates. Strings without any special
+    characters are passed as-is (so the non-existing path will be reported later as for any other project)
+    """
+    paths = []
+    for pattern in patterns:
+        pattern = os.path.expanduser(pattern)
+        if any(char in pattern for char in '*?['):
+            matches = sorted(glob.glob(pattern))
+            if len(matches) == 0:
+                logging.getLogger('stm32pio').warning(f"no projects match the '{pattern}' pattern")
+            paths.extend(matches)
+        else:
+            paths.append(pattern)
+    return list(collections.OrderedDict.fromkeys(paths))
+
+
+class BatchRunner:
+    """
+    Run the action for every given project using the pool of workers. The most resource-hungry stages (the CubeMX code
+    generation and the PlatformIO build) can be additionally limited so it is possible to, say, run a lot of quick
+    actions at once while having only a couple of JVMs at a time. The output of every project is prefixed by its path
+    using the ProjectLoggerAdapter.
+
+    Actions are run in threads as all heavy lifting happens in child processes (Java, PlatformIO) anyway.
+    """
+
+    def __init__(self, action: str, jobs: int = None, cubemx_jobs: int = None, build_jobs: int = None,
+                 board: str = '', with_build: bool = False, force: bool = False, persistent_cubemx: bool = False,
+                 wait_clean: bool = False, logger: logging.Logger = None):
+        """
+        Args:
+            action: one of the ACTIONS
+            jobs: total number of simultaneously processed projects (CPU count by default)
+            cubemx_jobs: maximum number of simultaneous code generations (same as 'jobs' by default)
+            build_jobs: maximum number of simultaneous PlatformIO builds (same as 'jobs' by default)
+            board: PlatformIO board identifier for 'init' and 'new' actions
+            with_build: build the projects after the generation
+            force: run the code generation (and the build) even if it is up-to-date
+            persistent_cubemx: use the long-living CubeMX processes (one per 'cubemx_jobs' slot)
+            wait_clean: wait for the files removed by 'clean' to be actually deleted (see Stm32pio.clean())
+            logger: underlying logger for the projects (prefixed adapters will be created on top of it)
+        """
+
+        if action not in ACTIONS:
+            raise ValueError(f"unknown batch action '{action}', should be one of {ACTIONS}")
+        self.action = action
+        self.jobs = jobs if jobs else (os.cpu_count() or 1)
+        self.board = board
+        self.with_build = with_build
+        self.force = force
+        self.wait_clean = wait_clean
+        self.logger = logger if logger is not None else logging.getLogger('stm32pio.projects')
+
+        # Acquire an item from the queue to take the slot and put it back to release. Items are CubeMXWorker's or
+        # just None placeholders if persistent workers are not requested
+        self.cubemx_slots = queue.Queue()
+        for _ in range(cubemx_jobs if cubemx_jobs else self.jobs):
+            self.cubemx_slots.put(stm32pio.lib.CubeMXWorker(
+                stm32pio.settings.config_default['app']['java_cmd'],
+                stm32pio.settings.config_default['app']['cubemx_cmd']) if persistent_cubemx else None)
+        self.build_slots = queue.Queue()
+        for _ in range(build_jobs if build_jobs else self.jobs):
+            self.build_slots.put(None)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _slot(slots: queue.Queue):
+        item = slots.get()
+        try:
+            yield item
+        finally:
+            slots.put(item)
+
+    def generate_code(self, project: stm32pio.lib.Stm32pio) -> int:
+        with self._slot(self.cubemx_slots) as cubemx_worker:
+            project.cubemx_worker = cubemx_worker
+            return project.generate_code(force=self.force)
+
+    def build(self, project: stm32pio.lib.Stm32pio) -> int:
+        with self._slot(self.build_slots):
+            return project.build(force=self.force)
+
+    def run_single(self, path: str) -> BatchResult:
+        """Perform the action for the single project. Never raises, all errors are reported via the result"""
+
+        logger = stm32pio.util.ProjectLoggerAdapter(self.logger, { 'project_id': path, 'prefix': f"[{path}]" })
+        start = time.monotonic()
+        message = ''
+        try:
+            instance_options = { 'logger': logger }
+            parameters = {}
+            if self.action in ['init', 'new']:
+                instance_options['save_on_destruction'] = True
+                if self.board:  # do not override the board from the project config by an empty value
+                    parameters = { 'project': { 'board': self.board } }
+            project = stm32pio.lib.Stm32pio(path, parameters=parameters, instance_options=instance_options)
+
+            if self.action == 'init':
+                logger.info("project has been initialized")
+            elif self.action == 'status':
+                message = str(project.state.current_stage)
+            elif self.action == 'clean':
+                project.clean(wait=self.wait_clean)
+            elif self.action == 'new':
+                if project.config.get('project', 'board') == '':
+                    raise Exception("PlatformIO board identifier is not specified")
+                # Only the missing stages are performed, the heavy ones are taking the slots
+                project.run_pipeline(with_build=self.with_build, force=self.force, actions={
+                    'generate_code': lambda: self.generate_code(project),
+                    'build': lambda: self.build(project)
+                })
+            else:  # 'generate'
+                self.generate_code(project)
+                if self.with_build and self.build(project) != 0:
+                    raise Exception("PlatformIO build error")
+            success = True
+        except Exception as e:
+            stm32pio.util.log_current_exception(logger)
+            success = False
+            message = str(e)
+
+        return BatchResult(path=path, success=success, duration=time.monotonic() - start, message=message)
+
+    def run(self, paths: Iterable[str]) -> List[BatchResult]:
+        """Process all the projects and return the results in the same order"""
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                return list(executor.map(self.run_single, paths))
+        finally:
+            while not self.cubemx_slots.empty():
+                cubemx_worker = self.cubemx_slots.get_nowait()
+                if cubemx_worker is not None:
+                    cubemx_worker.close()
+
+
+def format_summary(action: str, results: List[BatchResult]) -> str:
+    """Human-readable table of the results"""
+    rows: List[Tuple[str, ...]] = [('PROJECT', 'RESULT', 'TIME, s', 'DETAILS')]
+    for result in results:
+        rows.append((result.path, 'OK' if result.success else 'FAILED', f'{result.duration:.1f}', result.message))
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]) - 1)]
+    lines = ['  '.join(cell.ljust(width) for cell, width in zip(row, widths)) + '  ' + row[-1] for row in rows]
+    succeeded = sum(1 for result in results if result.success)
+    lines.append(f"\n'{action}': {succeeded} of {len(results)} projects succeeded")
+    return '\n'.join(line.rstrip() for line in lines)
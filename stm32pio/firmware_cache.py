@@ -0,0 +1,120 @@
+"""
+Content-addressed cache of the build artifacts (firmware.elf, .bin, .hex) shared between the projects, the branches and
+the CI runs. The key is a digest of everything the firmware depends on (see Stm32pio._firmware_cache_key()), so a hit
+means PlatformIO would have produced the very same files and the build can be skipped. The cache is disabled by default,
+set the 'firmware_cache_dir' option of the 'app' config section to turn it on.
+
+Layout: every entry is a folder named by its key containing the artifacts by their paths relative to the PlatformIO
+build folder (i.e. 'ENV/firmware.EXT'). Entries are written to the temporary folders first and then renamed so the
+concurrent users (e.g. the parallel CI jobs sharing the folder) never see the incomplete ones. The modification time of
+the entry folder is its last use time: the least recently used entries are evicted when the total size exceeds the
+limit.
+"""
+
+import contextlib
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+from typing import List, Mapping, Optional
+
+import stm32pio.trace
+
+
+module_logger = logging.getLogger(__name__)  # this file logger
+
+_TEMP_PREFIX = '.tmp-'  # incomplete entries, never looked up
+_TEMP_MAX_AGE = 24 * 60 * 60  # seconds, temporary folders older than this are considered abandoned (e.g. by a crash)
+
+
+class FirmwareCache:
+    """
+    Folder holding the cached artifacts. The instance keeps no state besides the settings so it is safe to use from the
+    multiple threads and processes at once
+    """
+
+    def __init__(self, path: pathlib.Path, max_size: int):
+        """
+        Args:
+            path: cache folder (created on the first store)
+            max_size: limit of the total size of the entries, bytes
+        """
+        self.path = path
+        self.max_size = max_size
+
+    def restore(self, key: str, build_dir: pathlib.Path) -> Optional[List[pathlib.Path]]:
+        """
+        Copy the artifacts of the entry into the build folder
+
+        Returns:
+            restored files or None on a miss
+        """
+        entry = self.path.joinpath(key)
+        try:
+            files = [file for file in entry.rglob('*') if file.is_file()]
+            if len(files) == 0:
+                return None
+            restored = []
+            for file in files:
+                destination = build_dir.joinpath(file.relative_to(entry))
+                destination.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(file, destination)
+                restored.append(destination)
+            os.utime(entry)  # mark as recently used
+        except OSError as e:  # e.g. the entry is being evicted by someone else right now
+            module_logger.debug(f"cannot restore the firmware cache entry {key}: {e}")
+            return None
+        return restored
+
+    @stm32pio.trace.traced()
+    def store(self, key: str, files: Mapping[str, pathlib.Path]) -> None:
+        """
+        Save the artifacts under the key and evict the old entries if the size limit is exceeded
+
+        Args:
+            key: digest of the inputs
+            files: artifacts by their paths relative to the build folder (e.g. 'ENV/firmware.elf': absolute path)
+        """
+        if len(files) == 0:
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        temp_entry = pathlib.Path(tempfile.mkdtemp(prefix=_TEMP_PREFIX, dir=self.path))
+        try:
+            for relative_path, file in files.items():
+                destination = temp_entry.joinpath(relative_path)
+                destination.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(file, destination)
+            try:
+                os.rename(temp_entry, self.path.joinpath(key))
+            except OSError:  # the same entry has been stored concurrently, it is identical so just use it
+                os.utime(self.path.joinpath(key))
+        finally:
+            shutil.rmtree(temp_entry, ignore_errors=True)  # no-op after the successful rename
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the total size fits the limit"""
+        entries = []  # (last use time, size, path)
+        now = time.time()
+        with os.scandir(self.path) as children:
+            for child in children:
+                with contextlib.suppress(OSError):  # the entries can disappear while we are looking at them
+                    if not child.is_dir(follow_symlinks=False):
+                        continue
+                    mtime = child.stat().st_mtime
+                    if child.name.startswith(_TEMP_PREFIX):
+                        if now - mtime > _TEMP_MAX_AGE:
+                            shutil.rmtree(child.path, ignore_errors=True)
+                        continue
+                    size = sum(file.stat().st_size for file in pathlib.Path(child.path).rglob('*') if file.is_file())
+                    entries.append((mtime, size, child.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+            module_logger.debug(f"firmware cache entry has been evicted: {path}")
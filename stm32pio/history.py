@@ -0,0 +1,171 @@
+"""
+Per-project history of the actions runs: duration, result and versions of the tools involved. The records are appended
+to the JSON Lines file in the service folder of the project so it is cheap to write and easy to inspect. Use it to see
+whether the builds are getting slower over time (see 'stm32pio stats') or to estimate how long the action will take.
+"""
+
+import collections
+import json
+import os
+import pathlib
+import statistics
+import tempfile
+import threading
+from typing import Any, Dict, List, Mapping, Optional
+
+import stm32pio.settings
+import stm32pio.util
+
+
+# Number of the last successful runs compared with the same number of the preceding ones to determine a trend
+TREND_WINDOW = 5
+
+ActionStats = collections.namedtuple('ActionStats', ['action', 'runs', 'failures', 'p50', 'p95', 'last', 'trend'])
+ActionStats.__doc__ = """
+Summary of the runs of the single action. Durations are in seconds and calculated over the successful runs only (None if
+there are no such). 'trend' is a relative change of the median duration of the last TREND_WINDOW runs comparing to the
+TREND_WINDOW runs before them (e.g. 0.1 means 10% slower), None if there is not enough data
+"""
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """Nearest-rank percentile of the values (fraction is in [0, 1]), None for an empty list"""
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(fraction * len(ordered) + 0.5) - 1))]
+
+
+class ProjectHistory:
+    """
+    History file of the single project. Appending is safe from the multiple threads of the same process. The file is
+    compacted (only the last 'max_records' are kept) when it grows twice as large. Broken lines (e.g. after the crash
+    in the middle of writing) are silently skipped.
+
+    The records are not counted on every append as it means reading the whole file. Instead, the file is only read when
+    its size exceeds the estimated size of 2 * max_records records. The estimation is then refined by the actual average
+    record size so the file is read again only when the limit is about to be exceeded
+    """
+
+    def __init__(self, service_dir: pathlib.Path, max_records: int = stm32pio.settings.history_max_records,
+                 record_size: int = stm32pio.settings.history_record_size):
+        """
+        Args:
+            service_dir: service folder of the project (see stm32pio.util.ensure_service_dir())
+            max_records: number of the records to keep on compaction
+            record_size: initial estimation of the record size, bytes
+        """
+        self.path = service_dir.joinpath(stm32pio.settings.history_file_name)
+        self.max_records = max_records
+        self._compact_size = 2 * max_records * record_size  # file size to count the records at
+        self._lock = threading.Lock()
+        self._cache = None  # (mtime, size, records) of the last read
+
+    def append(self, action: str, start: float, duration: float, success: bool,
+               versions: Mapping[str, str] = None) -> None:
+        """
+        Args:
+            action: name of the action (e.g. 'build')
+            start: UNIX timestamp of the start of the run
+            duration: seconds the run has taken
+            success: whether the run has succeeded
+            versions: versions of the tools the action depends on (tool: version)
+        """
+        record = { 'action': action, 'start': round(start, 3), 'duration': round(duration, 3), 'success': success,
+                   'versions': dict(versions) if versions else {} }
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            stm32pio.util.ensure_service_dir(self.path.parent)
+            with self.path.open(mode='a') as history_file:
+                history_file.write(line)
+                size = history_file.tell()
+            if size > self._compact_size:
+                self._compact()
+
+    def _compact(self) -> None:
+        """
+        Drop the oldest records if the limit has been exceeded twice. Update the size to check the records count at next
+        time (should be called under the lock)
+        """
+        content = self.path.read_text()
+        lines = content.splitlines(keepends=True)
+        record_size = len(content) / max(len(lines), 1)
+        if len(lines) <= 2 * self.max_records:
+            self._compact_size = len(content) + (2 * self.max_records - len(lines)) * record_size
+            return
+        with tempfile.NamedTemporaryFile(mode='w', dir=self.path.parent, delete=False) as temp_file:
+            temp_file.writelines(lines[-self.max_records:])
+        os.replace(temp_file.name, self.path)
+        self._compact_size = 2 * self.max_records * record_size
+
+    def records(self, action: str = None) -> List[Dict[str, Any]]:
+        """All records (of the given action only, if specified), from the oldest to the newest"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return []
+        with self._lock:
+            if self._cache is None or self._cache[:2] != (stat.st_mtime_ns, stat.st_size):
+                records = []
+                for line in self.path.read_text().splitlines():
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+                self._cache = (stat.st_mtime_ns, stat.st_size, records)
+            records = self._cache[2]
+        return [record for record in records if action is None or record.get('action') == action]
+
+    def stats(self, action: str = None) -> Dict[str, ActionStats]:
+        """Per-action summaries (of the given action only, if specified) in the order of their first appearance"""
+        grouped = collections.OrderedDict()
+        for record in self.records(action):
+            grouped.setdefault(record['action'], []).append(record)
+
+        result = collections.OrderedDict()
+        for name, records in grouped.items():
+            durations = [record['duration'] for record in records if record['success']]
+            trend = None
+            if len(durations) >= 2 * TREND_WINDOW:
+                previous = statistics.median(durations[-2 * TREND_WINDOW:-TREND_WINDOW])
+                recent = statistics.median(durations[-TREND_WINDOW:])
+                trend = recent / previous - 1 if previous else None
+            result[name] = ActionStats(action=name, runs=len(records),
+                                       failures=sum(1 for record in records if not record['success']),
+                                       p50=percentile(durations, 0.5), p95=percentile(durations, 0.95),
+                                       last=durations[-1] if len(durations) else None, trend=trend)
+        return result
+
+    def expected_duration(self, action: str) -> Optional[float]:
+        """Median duration of the last successful runs of the action (None if it has never been succeeded)"""
+        durations = [record['duration'] for record in self.records(action) if record['success']]
+        if len(durations) == 0:
+            return None
+        return statistics.median(durations[-2 * TREND_WINDOW:])
+
+    def last_versions(self) -> Dict[str, str]:
+        """The most recent known version of every tool mentioned in the history"""
+        versions = {}
+        for record in self.records():
+            versions.update(record.get('versions', {}))
+        return versions
+
+
+def format_stats(stats: Mapping[str, ActionStats], last_versions: Mapping[str, str] = None) -> str:
+    """Human-readable table of the statistics (see ProjectHistory.stats())"""
+    if len(stats) == 0:
+        return "no history has been recorded yet"
+
+    def seconds(value: Optional[float]) -> str:
+        return '-' if value is None else f'{value:.2f}' if value < 10 else f'{value:.1f}'
+
+    rows = [('ACTION', 'RUNS', 'FAILED', 'P50, s', 'P95, s', 'LAST, s', 'TREND')]
+    for item in stats.values():
+        rows.append((item.action, str(item.runs), str(item.failures), seconds(item.p50), seconds(item.p95),
+                     seconds(item.last), '-' if item.trend is None else f'{item.trend * 100:+.0f}%'))
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    lines = ['  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows]
+    if last_versions:
+        lines.append('\ntools of the last runs: ' +
+                     ', '.join(f'{tool} ({version})' for tool, version in sorted(last_versions.items())))
+    return '\n'.join(lines)
@@ -7,20 +7,30 @@ import configparser
 import contextlib
 import copy
 import enum
+import functools
 import logging
+import mmap
+import os
 import pathlib
-import shlex
-import shutil
+import queue
+import re
 import string
-import subprocess
-import tempfile
+import threading
+import time
 import weakref
-from typing import Mapping, Any, Union
+from typing import Mapping, Any, Union, Optional, Tuple, List, Callable
 
+# Modules needed only by the actions themselves (hashlib, json, shlex, shutil, subprocess, tempfile, stm32pio.history)
+# are imported right where they are used so the quick commands like 'stm32pio status' don't pay for them at startup
 import stm32pio.settings
+import stm32pio.trace
 import stm32pio.util
 
 
+# Snippets of the CubeMX output indicating the result of the code generation (see generate_code)
+_cubemx_success_marker = 'Code succesfully generated'
+_cubemx_error_marker = '[ERROR]'
+
 _stages_string_representations = {
     'UNDEFINED': 'The project is messed up',
     'EMPTY': '.ioc file is present',
@@ -31,6 +41,10 @@ _stages_string_representations = {
     'BUILT': 'PlatformIO project built'
 }
 
+# Actions to take the project from the .ioc file to the firmware, in order. Each one is a Stm32pio method fulfilling the
+# corresponding stage (see Stm32pio.plan())
+PipelineStep = collections.namedtuple('PipelineStep', ['action', 'stage', 'run', 'reason'])
+
 @enum.unique
 class ProjectStage(enum.IntEnum):
     """
@@ -120,6 +134,216 @@ class ProjectState(collections.OrderedDict):
         return self.current_stage != ProjectStage.UNDEFINED
 
 
+class IocFile:
+    """
+    CubeMX project file (.ioc). This is a Java properties text file consisting of 'Key=Value' lines, e.g.
+
+        Mcu.Family=STM32F0
+        Mcu.Name=STM32F031K6Tx
+        ProjectManager.ProjectName=stm32pio-test-project
+
+    Nothing is parsed on the instance creation. The file is memory-mapped and the index of the keys and the offsets of
+    their values is built on the first access to any value. Values are decoded on demand and cached. Use IocFile.load()
+    to obtain the instance: parsed files are shared across the process and are re-parsed only if the modification time
+    or the size of the file have changed.
+
+    The file is mapped only for the duration of the reading so it is never locked (some OSes doesn't allow to modify
+    mapped files).
+    """
+
+    _instances = {}  # absolute path: IocFile
+    _instances_lock = threading.Lock()
+
+    # Java properties escapes: '\:', '\=', '\\', '\uXXXX', etc.
+    _escape_regex = re.compile(r'\\(u[0-9a-fA-F]{4}|.)')
+    _escapes = { 't': '\t', 'n': '\n', 'r': '\r', 'f': '\f' }
+
+    _check_size = 4096  # bytes, see check()
+
+    def __init__(self, path: Union[str, pathlib.Path], stat: os.stat_result = None):
+        self.path = pathlib.Path(path)
+        if stat is None:
+            stat = os.stat(self.path)
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+
+        self._index = None  # key: (value start offset, value end offset)
+        self._values = {}  # decoded values cache
+        self._digest = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: Union[str, pathlib.Path]) -> 'IocFile':
+        """Get the shared instance for the file, a new one if the file has been changed since the last call"""
+        path = pathlib.Path(path).absolute()
+        stat = os.stat(path)
+        with cls._instances_lock:
+            instance = cls._instances.get(path)
+            if instance is None or instance.mtime_ns != stat.st_mtime_ns or instance.size != stat.st_size:
+                instance = cls(path, stat=stat)
+                cls._instances[path] = instance
+            return instance
+
+    @contextlib.contextmanager
+    def _mapped(self):
+        with self.path.open(mode='rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+    def check(self) -> None:
+        """
+        Cheap sanity check of the file looking only at its beginning: it should be a non-empty text file containing
+        'Key=Value' lines. Raises ValueError otherwise
+        """
+        if self.size == 0:
+            raise ValueError("the file is empty")
+        with self._mapped() as data:
+            head = data[:self._check_size]
+        if b'\x00' in head:
+            raise ValueError("the file is not a text one")
+        import codecs
+        try:
+            # Incremental decoder tolerates the multibyte character cut off by the chunk boundary
+            codecs.getincrementaldecoder('utf-8')().decode(head, final=len(head) == self.size)
+        except UnicodeDecodeError as e:
+            raise ValueError("the file is not a text one") from e
+        if not any(b'=' in line and not line.lstrip().startswith((b'#', b'!')) for line in head.splitlines()):
+            raise ValueError("no 'Key=Value' lines have been found")
+
+    def _build_index(self) -> None:
+        index = {}
+        if self.size != 0:  # zero-length files cannot be mapped
+            with self._mapped() as data:
+                position = 0
+                while position < len(data):
+                    line_end = data.find(b'\n', position)
+                    if line_end == -1:
+                        line_end = len(data)
+                    separator = data.find(b'=', position, line_end)
+                    if separator != -1 and data[position:position + 1] not in (b'#', b'!'):
+                        value_end = line_end - 1 if data[line_end - 1:line_end] == b'\r' else line_end
+                        index[data[position:separator].decode('latin-1').strip()] = (separator + 1, value_end)
+                    position = line_end + 1
+        self._index = index
+
+    @property
+    def index(self) -> Mapping[str, Tuple[int, int]]:
+        with self._lock:
+            if self._index is None:
+                self._build_index()
+            return self._index
+
+    def keys(self) -> List[str]:
+        return list(self.index.keys())
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def value(self, key: str, fallback: Any = None) -> Any:
+        """Decoded value of the key (or 'fallback' if there is no such key)"""
+        if key not in self._values:
+            offsets = self.index.get(key)
+            if offsets is None:
+                return fallback
+            with self._mapped() as data:
+                raw = data[offsets[0]:offsets[1]].decode('latin-1')  # standard encoding of Java properties files
+            self._values[key] = self._escape_regex.sub(
+                lambda match: chr(int(match.group(1)[1:], 16)) if len(match.group(1)) == 5 else
+                self._escapes.get(match.group(1), match.group(1)), raw)
+        return self._values[key]
+
+    def __getitem__(self, key: str) -> str:
+        if key not in self:
+            raise KeyError(key)
+        return self.value(key)
+
+    def section(self, prefix: str) -> Mapping[str, str]:
+        """All values which keys starting with 'prefix.' (the prefix is cut off)"""
+        return { key[len(prefix) + 1:]: self.value(key) for key in self.index if key.startswith(f'{prefix}.') }
+
+    @property
+    def mcu_name(self) -> Optional[str]:
+        return self.value('Mcu.Name')
+
+    @property
+    def mcu_family(self) -> Optional[str]:
+        return self.value('Mcu.Family')
+
+    @property
+    def project_manager(self) -> Mapping[str, str]:
+        """'ProjectManager.*' parameters, e.g. { 'ProjectName': 'stm32pio-test-project', ... }"""
+        return self.section('ProjectManager')
+
+    @property
+    def digest(self) -> str:
+        """SHA-256 of the file content (hex string)"""
+        if self._digest is None:
+            import hashlib
+            self._digest = hashlib.sha256(b'').hexdigest()
+            if self.size != 0:
+                with self._mapped() as data:
+                    self._digest = hashlib.sha256(data).hexdigest()
+        return self._digest
+
+
+class ConfigFile:
+    """
+    Parsed INI config file (e.g. stm32pio.ini) shared across the process. Use ConfigFile.load() to obtain the content:
+    every file is parsed only once and is re-parsed only if its modification time or size have changed (or it has been
+    written via ConfigFile.invalidate()-aware code, see Stm32pio._save_config())
+    """
+
+    _instances = {}  # absolute path: ConfigFile
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path: pathlib.Path, stat: os.stat_result):
+        self.path = path
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+
+        parser = configparser.ConfigParser(interpolation=None)
+        parser.read(path)
+        # Plain dictionary suitable for the ConfigParser.read_dict(). Keys are already normalized by the parser
+        self.content = { section: { key: parser.get(section, key, raw=True) for key in parser.options(section) }
+                         for section in parser.sections() }
+        if len(parser.defaults()):
+            self.content[parser.default_section] = dict(parser.defaults())
+
+    @classmethod
+    def load(cls, path: Union[str, pathlib.Path]) -> Optional['ConfigFile']:
+        """Get the shared parsed file, None if there is no such file"""
+        path = pathlib.Path(path).absolute()
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with cls._instances_lock:
+            instance = cls._instances.get(path)
+            if instance is None or instance.mtime_ns != stat.st_mtime_ns or instance.size != stat.st_size:
+                instance = cls(path, stat)
+                cls._instances[path] = instance
+            return instance
+
+    @classmethod
+    def invalidate(cls, path: Union[str, pathlib.Path]) -> None:
+        """
+        Forget the file. Call it after writing to the file as the modification time resolution of some file systems is
+        too coarse to notice the quick successive changes
+        """
+        with cls._instances_lock:
+            cls._instances.pop(pathlib.Path(path).absolute(), None)
+
+
+@functools.lru_cache(maxsize=32)
+def _parse_patch(patch_content: str) -> configparser.ConfigParser:
+    """
+    Parse the 'platformio.ini' patch (usually the same for all projects so it is done once per process). The result is
+    shared, do not modify it
+    """
+    patch_config = configparser.ConfigParser(interpolation=None)  # our patch has the INI config format, too
+    patch_config.read_string(patch_content)
+    return patch_config
+
+
 class Stm32pio:
     """
     Main class.
@@ -141,9 +365,11 @@ class Stm32pio:
 
     INSTANCE_OPTIONS_DEFAULTS = {  # TODO: use Python 3.8 TypedDict
         'save_on_destruction': False,
-        'logger': None
+        'logger': None,
+        'cubemx_worker': None
     }
 
+    @stm32pio.trace.traced()
     def __init__(self, dirty_path: Union[str, pathlib.Path], parameters: Mapping[str, Any] = None,
                  instance_options: Mapping[str, Any] = None):
         """
@@ -155,6 +381,8 @@ class Stm32pio:
                 save_on_destruction (bool=True): register or not the finalizer that saves the config to file
                 logger (logging.Logger=None): if an external logger is given, it will be used, otherwise the new one
                                               will be created (unique for every instance)
+                cubemx_worker (CubeMXWorker=None): long-living CubeMX process to use for the code generation instead
+                                                   of starting a new one every time (can be shared between projects)
         """
 
         if parameters is None:
@@ -189,22 +417,35 @@ class Stm32pio:
             path = path.parent
         self.path = path
 
+        self._state_cache = None  # (key, ProjectState, firmware files) triple, see 'state' property
+        self._state_generation = 0  # incremented on every invalidate_state()
+        self._state_lock = threading.Lock()  # the state can be read from several threads (e.g. by the GUI)
+        self._history = None  # see 'history' property
+
         self.config = self._load_config(parameters)
 
         self.ioc_file = self._find_ioc_file(explicit_file=ioc_file)
         self.config.set('project', 'ioc_file', self.ioc_file.name)  # save only the name of file to the config
 
-        # Notify the caller about the board presence
-        if 'board' in parameters and parameters['board'] is not None:
+        # Notify the caller about the board presence (the list of boards is cached so this is cheap most of the time)
+        board = parameters.get('project', {}).get('board')
+        if board:
             try:
-                boards = stm32pio.util.get_platformio_boards(self.config.get('app', 'platformio_cmd'))
+                with stm32pio.trace.span('board lookup', board=board):
+                    board_is_known = stm32pio.util.platformio_boards_cache.contains(
+                        self.config.get('app', 'platformio_cmd'), board)
             except Exception as e:
                 self.logger.warning(f"There was an error while obtaining possible PlatformIO boards: {e}",
                                     exc_info=self.logger.isEnabledFor(logging.DEBUG))
-                boards = []
-            if parameters['board'] not in boards:
-                self.logger.warning(f"'{parameters['board']}' was not found in PlatformIO. "
-                                    "Run 'platformio boards' for possible names")
+                board_is_known = None
+            if board_is_known is False:  # None - cannot tell (already reported above or recently)
+                self.logger.warning(f"'{board}' was not found in PlatformIO. Run 'platformio boards' for possible "
+                                    "names")
+
+        self.cubemx_worker = instance_options['cubemx_worker']
+
+        # Finish the deletion of the files left by the interrupted 'clean' (no-op, if there are none)
+        stm32pio.util.trash_collector.collect(self.path.joinpath(stm32pio.settings.trash_dir_name))
 
         # Save the config on an instance destruction
         if instance_options['save_on_destruction']:
@@ -216,43 +457,159 @@ class Stm32pio:
         return f"Stm32pio project: {str(self.path)}"
 
 
+    @property
+    def history(self) -> 'stm32pio.history.ProjectHistory':
+        """Runs history of the project (see stm32pio.history), created on the first access"""
+        if self._history is None:
+            import stm32pio.history
+            self._history = stm32pio.history.ProjectHistory(self.path.joinpath(stm32pio.settings.service_dir_name))
+        return self._history
+
+
     @property
     def state(self) -> ProjectState:
-        """Constructing and returning the current state of the project (tweaked dict, see ProjectState docs)"""
+        """
+        Constructing and returning the current state of the project (tweaked dict, see ProjectState docs). The result is
+        cached per instance and re-validated against the modification times of the files and folders it depends on so
+        repeated reads cost only a few 'stat' calls. Use invalidate_state() to drop the cache explicitly
+        """
 
-        pio_is_initialized = False
-        with contextlib.suppress(Exception):  # we just want to know the status and don't care about the details
-            # Is present, is correct and is not empty
-            pio_is_initialized = len(self.platformio_ini_config.sections()) != 0
+        # The probe itself is performed outside the lock, the cache is only swapped as a whole under it. The result of
+        # the probe concurrent with invalidate_state() is not stored as it can be outdated already
+        with self._state_lock:
+            cache, generation = self._state_cache, self._state_generation
+
+        # Build artifacts locations depend on the 'platformio.ini' content so we remember them along with the state
+        firmware_files = cache[2] if cache is not None else []
+        cache_key = self._state_cache_key(firmware_files)
+        if cache is None or cache[0] != cache_key:
+            state, firmware_files = self._probe_state()
+            cache = (self._state_cache_key(firmware_files), state, firmware_files)
+            with self._state_lock:
+                if self._state_generation == generation:
+                    self._state_cache = cache
+        return ProjectState(cache[1])  # a copy, so the caller is free to modify it
+
+
+    def invalidate_state(self) -> None:
+        """Drop the cached state so the next 'state' read will probe the file system again"""
+        with self._state_lock:
+            self._state_cache = None
+            self._state_generation += 1
+
+
+    def _state_cache_key(self, firmware_files: List[pathlib.Path]) -> tuple:
+        """
+        Gather the modification times and sizes of all the file system entries the state depends on. Directories
+        modification times change when their entries are added or removed which is exactly what we're interested in
+        """
+
+        paths = [self.path, self.ioc_file, self.path.joinpath(stm32pio.settings.config_file_name),
+                 self.path.joinpath('Inc'), self.path.joinpath('Src'), self.path.joinpath('include'),
+                 self.path.joinpath('platformio.ini')] + firmware_files
+
+        key = [self.config.get('project', 'platformio_ini_patch_content', fallback=None)]
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                key.append((path, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                key.append((path, None))
+        return tuple(key)
 
+
+    def _probe_state(self) -> Tuple[ProjectState, List[pathlib.Path]]:
+        """
+        Single pass over the project folder determining what stages are fulfilled. Stops scanning as soon as all the
+        entries of interest are found
+
+        Returns:
+            the state and the list of the expected build artifacts (see _firmware_files)
+        """
+
+        wanted = {self.ioc_file.name, stm32pio.settings.config_file_name, 'Inc', 'Src', 'include', 'platformio.ini'}
+        found = {}
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.name in wanted:
+                    found[entry.name] = entry
+                    if len(found) == len(wanted):
+                        break
+
+        def is_file(name: str) -> bool:
+            return name in found and found[name].is_file()
+
+        def is_dir(name: str) -> bool:
+            return name in found and found[name].is_dir()
+
+        def is_non_empty_dir(name: str) -> bool:
+            if not is_dir(name):
+                return False
+            with os.scandir(found[name].path) as dir_entries:
+                return next(dir_entries, None) is not None  # the first entry is enough
+
+        # Parse 'platformio.ini' only once and use it for both the initialization and the patch checks
+        pio_is_initialized = False
         platformio_ini_is_patched = False
-        if pio_is_initialized:  # make no sense to proceed if there is something happened in the first place
+        firmware_files = []
+        if is_file('platformio.ini'):
             with contextlib.suppress(Exception):  # we just want to know the status and don't care about the details
-                platformio_ini_is_patched = self.platformio_ini_is_patched
+                platformio_ini = self.platformio_ini_config
+                firmware_files = self._firmware_files(platformio_ini)
+                # Is present, is correct and is not empty
+                pio_is_initialized = len(platformio_ini.sections()) != 0
+                if pio_is_initialized:  # make no sense to proceed if there is something happened in the first place
+                    platformio_ini_is_patched = self._platformio_ini_matches_patch(platformio_ini)
+
+        # The .ioc file is usually placed in the project folder but this is not a strict requirement
+        if self.ioc_file.parent == self.path:
+            ioc_file_is_present = is_file(self.ioc_file.name)
+        else:
+            ioc_file_is_present = self.ioc_file.is_file()
 
         # Create the temporary ordered dictionary and fill it with the conditions results arrays
         stages_conditions = collections.OrderedDict()
         stages_conditions[ProjectStage.UNDEFINED] = [True]
-        stages_conditions[ProjectStage.EMPTY] = [self.ioc_file.is_file()]
-        stages_conditions[ProjectStage.INITIALIZED] = [self.path.joinpath(stm32pio.settings.config_file_name).is_file()]
-        stages_conditions[ProjectStage.GENERATED] = [self.path.joinpath('Inc').is_dir() and
-                                                     len(list(self.path.joinpath('Inc').iterdir())) > 0,
-                                                     self.path.joinpath('Src').is_dir() and
-                                                     len(list(self.path.joinpath('Src').iterdir())) > 0]
+        stages_conditions[ProjectStage.EMPTY] = [ioc_file_is_present]
+        stages_conditions[ProjectStage.INITIALIZED] = [is_file(stm32pio.settings.config_file_name)]
+        stages_conditions[ProjectStage.GENERATED] = [is_non_empty_dir('Inc'), is_non_empty_dir('Src')]
         stages_conditions[ProjectStage.PIO_INITIALIZED] = [pio_is_initialized]
-        stages_conditions[ProjectStage.PATCHED] = [platformio_ini_is_patched,
-                                                   not self.path.joinpath('include').is_dir()]
-        # Hidden folder! Can be not visible in your file manager and cause a confusion
-        stages_conditions[ProjectStage.BUILT] = [
-            self.path.joinpath('.pio').is_dir() and
-            any([item.is_file() for item in self.path.joinpath('.pio').rglob('*firmware*')])]
+        stages_conditions[ProjectStage.PATCHED] = [platformio_ini_is_patched, not is_dir('include')]
+        # Look only for the exact artifacts paths, the build folder can contain thousands of other files
+        stages_conditions[ProjectStage.BUILT] = [any(file.is_file() for file in firmware_files)]
 
         # Fold arrays and save results in ProjectState instance
         conditions_results = ProjectState()
         for state, conditions in stages_conditions.items():
             conditions_results[state] = all(condition is True for condition in conditions)
 
-        return conditions_results
+        return conditions_results, firmware_files
+
+
+    def _firmware_files(self, platformio_ini: configparser.ConfigParser) -> List[pathlib.Path]:
+        """
+        Derive the expected build artifacts paths from the 'platformio.ini' config: every [env:NAME] section produces
+        BUILD_DIR/NAME/firmware.{elf,bin,hex} where BUILD_DIR is '.pio/build' by default (hidden folder! Can be not
+        visible in your file manager and cause a confusion) and can be customized by the 'build_dir' and 'workspace_dir'
+        options of the [platformio] section
+        """
+
+        workspace_dir = platformio_ini.get('platformio', 'workspace_dir', fallback='.pio')
+        build_dir = platformio_ini.get('platformio', 'build_dir', fallback='${platformio.workspace_dir}/build')
+        for variable, value in [('${platformio.workspace_dir}', workspace_dir), ('${PROJECT_DIR}', str(self.path)),
+                                ('$PROJECT_DIR', str(self.path))]:
+            build_dir = build_dir.replace(variable, value)
+        build_dir = self.path.joinpath(os.path.expanduser(build_dir))  # absolute path stays as it is
+
+        return [build_dir.joinpath(section[len('env:'):], f'firmware.{extension}')
+                for section in platformio_ini.sections() if section.startswith('env:')
+                for extension in ['elf', 'bin', 'hex']]
+
+
+    @property
+    def ioc(self) -> IocFile:
+        """Parsed .ioc file (shared and cached, see IocFile)"""
+        return IocFile.load(self.ioc_file)
 
 
     def _find_ioc_file(self, explicit_file: pathlib.Path = None) -> pathlib.Path:
@@ -292,16 +649,15 @@ class Stm32pio:
                     self.logger.warning(f"there are multiple .ioc files, {candidates[0].name} is selected")
                     result_file = candidates[0]
 
-        # Check for the file correctness
+        # Check for the file correctness (the content itself will be parsed on demand)
         try:
-            content = result_file.read_text()  # should be a text file
-            if len(content) == 0:
-                raise ValueError("the file is empty")
+            IocFile.load(result_file).check()
             return result_file
         except Exception as e:
             raise Exception(f"{result_file.name} is incorrect") from e
 
 
+    @stm32pio.trace.traced()
     def _load_config(self, runtime_parameters: Mapping[str, Any] = None) -> configparser.ConfigParser:
         """
         Prepare ConfigParser config for the project. Order of getting values (masking) (higher levels overwrites lower):
@@ -318,25 +674,24 @@ class Stm32pio:
 
         config = configparser.ConfigParser(interpolation=None)
 
-        # Fill with default values ...
-        config.read_dict(copy.deepcopy(stm32pio.settings.config_default))
+        # Fill with default values (the parser copies them so no need to protect the original) ...
+        config.read_dict(stm32pio.settings.config_default)
 
-        # ... then merge with user's config file values (if exist) ...
+        # ... then merge with user's config file values (if exist). The file is parsed once per process (see
+        # ConfigFile) ...
         self.logger.debug(f"searching for {stm32pio.settings.config_file_name}...")
-        config.read(self.path.joinpath(stm32pio.settings.config_file_name))
-
-        ini_config = configparser.ConfigParser(interpolation=None)
-        ini_config.read(self.path.joinpath(stm32pio.settings.config_file_name))
-        runtime_config = configparser.ConfigParser(interpolation=None)
-        runtime_config.read_dict(runtime_parameters)
-
-        if len(ini_config.sections()):
-            if len(runtime_config.sections()):
-                for ini_sect in ini_config.sections():
-                    if runtime_config.has_section(ini_sect):
-                        for ini_key, ini_value in ini_config.items(ini_sect):
-                            if runtime_config.get(ini_sect, ini_key, fallback=None) not in [None, ini_value]:
-                                self.logger.info(f"given '{ini_key}' has taken a precedence over the .ini one")
+        ini_file = ConfigFile.load(self.path.joinpath(stm32pio.settings.config_file_name))
+        ini_content = ini_file.content if ini_file is not None else {}
+        config.read_dict(ini_content)
+
+        if len(ini_content):
+            # Diff the file against the runtime values the same way the parser normalizes them (lowercase keys, string
+            # values)
+            for ini_sect, runtime_section in runtime_parameters.items():
+                for runtime_key, runtime_value in runtime_section.items():
+                    ini_value = ini_content.get(ini_sect, {}).get(config.optionxform(runtime_key))
+                    if runtime_value is not None and ini_value is not None and str(runtime_value) != ini_value:
+                        self.logger.info(f"given '{runtime_key}' has taken a precedence over the .ini one")
         else:
             self.logger.debug(f"no or empty {stm32pio.settings.config_file_name} config file, will use the default one")
 
@@ -371,12 +726,14 @@ class Stm32pio:
         try:
             with path.joinpath(stm32pio.settings.config_file_name).open(mode='w') as config_file:
                 config.write(config_file)
+            ConfigFile.invalidate(path.joinpath(stm32pio.settings.config_file_name))
             logger.debug(f"{stm32pio.settings.config_file_name} config file has been saved")
             return 0
         except Exception as e:
             logger.warning(f"cannot save the config: {e}", exc_info=logger.isEnabledFor(logging.DEBUG))
             return -1
 
+    @stm32pio.trace.traced()
     def save_config(self, parameters: Mapping[str, Mapping[str, Any]] = None) -> int:
         """
         Invokes base _save_config function. Preliminarily, updates the config with the given 'parameters' dictionary. It
@@ -397,69 +754,261 @@ class Stm32pio:
             parameters = {}
 
         self.config.read_dict(parameters)
+        self.invalidate_state()
         return self._save_config(self.config, self.path, self.logger)
 
 
-    def generate_code(self) -> int:
+    def _read_fingerprint(self, action: str) -> Optional[str]:
+        """
+        Get the fingerprint of the last successful 'action' run stored in the service folder of the project
+
+        Returns:
+            fingerprint string or None if there is no one (or the storage is unreadable)
+        """
+        import json
+        fingerprints_file = self.path.joinpath(stm32pio.settings.service_dir_name,
+                                               stm32pio.settings.fingerprints_file_name)
+        try:
+            return json.loads(fingerprints_file.read_text()).get(action)
+        except Exception:
+            return None
+
+    def _write_fingerprint(self, action: str, fingerprint: Optional[str]) -> None:
+        """
+        Store (or remove, if None is passed) the fingerprint of the 'action' in the service folder of the project.
+        Errors are not critical here: the worst consequence is an unnecessary re-run of the action next time
+        """
+        import json
+        service_dir = self.path.joinpath(stm32pio.settings.service_dir_name)
+        fingerprints_file = service_dir.joinpath(stm32pio.settings.fingerprints_file_name)
+        try:
+            try:
+                fingerprints = json.loads(fingerprints_file.read_text())
+            except (FileNotFoundError, ValueError):
+                fingerprints = {}
+            if fingerprint is None:
+                if fingerprints.pop(action, None) is None:
+                    return  # nothing to remove
+            else:
+                fingerprints[action] = fingerprint
+            stm32pio.util.ensure_service_dir(service_dir)
+            fingerprints_file.write_text(json.dumps(fingerprints, indent=4))
+        except Exception as e:
+            self.logger.debug(f"cannot save the fingerprint of '{action}': {e}",
+                              exc_info=self.logger.isEnabledFor(logging.DEBUG))
+
+
+    def _tool_versions(self, action: str) -> Mapping[str, str]:
+        """Versions of the tools the action depends on (cached, see stm32pio.util.ToolVersionsCache)"""
+        if action == 'generate_code':
+            tools = { 'java': (self.config.get('app', 'java_cmd'), ['-version']) }
+        elif action in ['pio_init', 'build']:
+            tools = { 'platformio': (self.config.get('app', 'platformio_cmd'), ['--version']) }
+        else:
+            tools = {}
+        return { tool: stm32pio.util.tool_versions_cache.get(command, version_args)
+                 for tool, (command, version_args) in tools.items() }
+
+    @contextlib.contextmanager
+    def _recorded(self, action: str):
+        """
+        Measure the enclosed run of the action and append it to the history (see stm32pio.history). The run is
+        considered failed if an exception has been raised or the block has set 'success' of the yielded dict to False
+        """
+        run = { 'success': True }
+        start, counter = time.time(), time.perf_counter()
+        try:
+            yield run
+        except BaseException:
+            run['success'] = False
+            raise
+        finally:
+            duration = time.perf_counter() - counter
+            try:
+                self.history.append(action, start, duration, run['success'], versions=self._tool_versions(action))
+            except Exception as e:  # statistics is not worth failing the action
+                self.logger.debug(f"cannot record '{action}' run into the history: {e}",
+                                  exc_info=self.logger.isEnabledFor(logging.DEBUG))
+
+
+    def _render_cubemx_script(self) -> str:
+        """Substitute the project paths into the CubeMX script template from the config"""
+        cubemx_script_template = string.Template(self.config.get('project', 'cubemx_script_content'))
+        return cubemx_script_template.substitute(ioc_file_absolute_path=self.ioc_file,
+                                                 project_dir_absolute_path=self.path)
+
+    def _generation_fingerprint(self, cubemx_script_content: str) -> str:
+        """
+        Digest of everything the CubeMX code generation depends on: the .ioc file content, the script passed to the
+        CubeMX and the CubeMX itself
+        """
+        import hashlib
+        digest = hashlib.sha256(self.ioc.digest.encode())
+        for part in [cubemx_script_content, self.config.get('app', 'cubemx_cmd')]:
+            digest.update(b'\0' + part.encode())
+        return digest.hexdigest()
+
+
+    @stm32pio.trace.traced()
+    def generate_code(self, force: bool = False) -> int:
         """
         Call STM32CubeMX app as 'java -jar' file to generate the code from the .ioc file. Pass the commands to the
         STM32CubeMX in a temp file.
 
+        The generation is skipped if neither the .ioc file, nor the CubeMX script, nor the CubeMX path haven't been
+        changed since the last successful run and the generated code is still in place.
+
+        Args:
+            force: run the CubeMX regardless of the fingerprint of the previous generation
+
         Returns:
             return code on success, raises an exception otherwise
         """
 
+        cubemx_script_content, fingerprint = self._prepare_generation(force)
+        if cubemx_script_content is None:
+            return 0  # skipped runs are not recorded into the history as they would distort the statistics
+
+        with self._recorded('generate_code'):
+            try:
+                if self._can_use_cubemx_worker():
+                    return_code, result_output = self.cubemx_worker.run_script(cubemx_script_content, self.logger)
+                else:
+                    return_code, result_output = self._run_cubemx_script(cubemx_script_content)
+            finally:
+                self.invalidate_state()
+
+            return self._finish_generation(return_code, result_output, fingerprint)
+
+
+    def _can_use_cubemx_worker(self) -> bool:
+        """Whether the code should be generated by the CubeMX worker (if any) or by the dedicated one-shot process"""
+        if self.cubemx_worker is None:
+            return False
+        elif not self.cubemx_worker.is_compatible(self.config.get('app', 'java_cmd'),
+                                                  self.config.get('app', 'cubemx_cmd')):
+            self.logger.debug("CubeMX worker has been started with another Java/CubeMX commands, use the dedicated "
+                              "process instead")
+            return False
+        elif not self.cubemx_worker.start(self.logger):
+            self.logger.debug("CubeMX worker cannot be started in the console mode, use the dedicated process instead")
+            return False
+        return True
+
+
+    def _prepare_generation(self, force: bool) -> Tuple[Optional[str], str]:
+        """
+        Common part of the sync and async (see stm32pio.aio) code generation preceding the CubeMX invocation
+
+        Returns:
+            CubeMX script content (None if the generation should be skipped) and the fingerprint of the generation
+        """
+
+        cubemx_script_content = self._render_cubemx_script()
+        fingerprint = self._generation_fingerprint(cubemx_script_content)
+        if not force and self._generation_is_up_to_date(fingerprint):
+            self.logger.info("the code is up-to-date (the .ioc file and the CubeMX parameters haven't been changed), "
+                             "skipping the generation. Force it if you need to")
+            return None, fingerprint
+
         self.logger.info("starting to generate a code from the CubeMX .ioc file...")
+        self._write_fingerprint('generate_code', None)  # the code is about to be changed, the old one is not valid
+        return cubemx_script_content, fingerprint
+
+
+    def _generation_is_up_to_date(self, fingerprint: str = None) -> bool:
+        """Whether the generated code is present and corresponds to the current .ioc file and CubeMX parameters"""
+        if fingerprint is None:
+            fingerprint = self._generation_fingerprint(self._render_cubemx_script())
+        return fingerprint == self._read_fingerprint('generate_code') and self.state[ProjectStage.GENERATED]
+
+
+    def _finish_generation(self, return_code: int, result_output: str, fingerprint: str) -> int:
+        """Common part of the sync and async code generation following the CubeMX invocation"""
+        if self._check_generation_result(return_code, result_output):
+            self._write_fingerprint('generate_code', fingerprint)
+        return return_code
+
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _cubemx_script_file(cubemx_script_content: str):
+        """Temporary file with the CubeMX script, yields its path"""
 
         # Use mkstemp() instead of the higher-level API for the compatibility with the Windows (see tempfile docs for
         # more details)
+        import tempfile
         cubemx_script_file, cubemx_script_name = tempfile.mkstemp()
 
         # We must remove the temp directory, so do not let any exception break our plans
         try:
             # buffering=0 leads to the immediate flushing on writing
             with open(cubemx_script_file, mode='w+b', buffering=0) as cubemx_script:
-                cubemx_script_template = string.Template(self.config.get('project', 'cubemx_script_content'))
-                cubemx_script_content = cubemx_script_template.substitute(ioc_file_absolute_path=self.ioc_file,
-                                                                          project_dir_absolute_path=self.path)
                 cubemx_script.write(cubemx_script_content.encode())  # should encode, since mode='w+b'
+                yield cubemx_script_name
+        finally:
+            pathlib.Path(cubemx_script_name).unlink()
+
+
+    def _cubemx_command(self, cubemx_script_name: str) -> List[str]:
+        # -q: read the commands from the file, -s: silent performance
+        return [self.config.get('app', 'java_cmd'), '-jar', self.config.get('app', 'cubemx_cmd'), '-q',
+                cubemx_script_name, '-s']
 
-                command_arr = [self.config.get('app', 'java_cmd'), '-jar', self.config.get('app', 'cubemx_cmd'), '-q',
-                               cubemx_script_name, '-s']  # -q: read the commands from the file, -s: silent performance
-                # Redirect the output of the subprocess into the logging module (with DEBUG level)
-                with stm32pio.util.LogPipe(self.logger, logging.DEBUG) as log:
+
+    def _run_cubemx_script(self, cubemx_script_content: str) -> Tuple[int, str]:
+        """
+        Start the new CubeMX process executing the given script
+
+        Returns:
+            return code and the output of the process
+        """
+
+        import subprocess
+        with self._cubemx_script_file(cubemx_script_content) as cubemx_script_name:
+            # Redirect the output of the subprocess into the logging module (with DEBUG level). The whole output is
+            # needed as the error markers can be anywhere (it is not that long, though)
+            with stm32pio.util.LogPipe(self.logger, logging.DEBUG, capture=stm32pio.util.LogPipeCapture.FULL) as log:
+                command_arr = self._cubemx_command(cubemx_script_name)
+                with stm32pio.trace.span('subprocess: CubeMX', category='subprocess', command=command_arr):
                     result = subprocess.run(command_arr, stdout=log.pipe, stderr=log.pipe)
-                    result_output = log.value
+            return result.returncode, log.value  # the pipe has been drained completely at this point
 
-        except Exception as e:
-            raise e  # re-raise an exception after the 'finally' block
-        finally:
-            pathlib.Path(cubemx_script_name).unlink()
+
+    def _check_generation_result(self, return_code: int, result_output: str) -> bool:
+        """
+        Analyze the CubeMX output as its return code is not enough to determine the success
+
+        Returns:
+            True if the success is confirmed by the output, False if the result is undefined (but, probably, correct).
+            Raises an exception on errors
+        """
 
         error_msg = "code generation error"
-        if result.returncode == 0:
+        if return_code == 0:
             # CubeMX 0 return code doesn't necessarily means the correct generation (e.g. migration dialog has appeared
             # and 'Cancel' was chosen, or CubeMX_version < ioc_file_version), should analyze the output
-            if 'Code succesfully generated' in result_output:
+            if _cubemx_success_marker in result_output:
                 self.logger.info("successful code generation")
-                return result.returncode
+                return True
             else:
                 # GUESSING
-                error_lines = [line for line in result_output.splitlines(keepends=True) if '[ERROR]' in line]
+                error_lines = [line for line in result_output.splitlines(keepends=True) if _cubemx_error_marker in line]
                 if len(error_lines):
                     self.logger.error(error_lines, extra={ 'from_subprocess': True })
                     raise Exception(error_msg)
                 else:
                     self.logger.warning("Undefined result from the CubeMX (neither error or success symptoms were "
                                         "found in the logs). Keep going but there might be an error")
-                    return result.returncode
+                    return False
         else:
             # Most likely the 'java' error (e.g. no CubeMX is present)
-            self.logger.error(f"Return code is {result.returncode}. Output:\n\n{result_output}",
+            self.logger.error(f"Return code is {return_code}. Output:\n\n{result_output}",
                               extra={ 'from_subprocess': True })
             raise Exception(error_msg)
 
 
+    @stm32pio.trace.traced()
     def pio_init(self) -> int:
         """
         Call PlatformIO CLI to initialize a new project. It uses parameters (path, board) collected before so the
@@ -469,6 +1018,19 @@ class Stm32pio:
             return code of the PlatformIO on success, raises an exception otherwise
         """
 
+        import subprocess
+        command_arr = self._prepare_pio_init()
+        with self._recorded('pio_init'):
+            with stm32pio.trace.span('subprocess: PlatformIO init', category='subprocess', command=command_arr):
+                result = subprocess.run(command_arr, encoding='utf-8', stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+            self.invalidate_state()
+            return self._check_pio_init_result(result.returncode, result.stdout)
+
+
+    def _prepare_pio_init(self) -> List[str]:
+        """Common part of the sync and async (see stm32pio.aio) initialization, returns the PlatformIO command"""
+
         self.logger.info("starting PlatformIO project initialization...")
 
         try:
@@ -484,20 +1046,21 @@ class Stm32pio:
                        self.config.get('project', 'board'), '-O', 'framework=stm32cube']
         if not self.logger.isEnabledFor(logging.DEBUG):
             command_arr.append('--silent')
+        return command_arr
 
-        result = subprocess.run(command_arr, encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
+    def _check_pio_init_result(self, return_code: int, result_output: str) -> int:
         error_msg = "PlatformIO project initialization error"
-        if result.returncode == 0:
+        if return_code == 0:
             # PlatformIO returns 0 even on some errors (e.g. no '--board' argument)
-            if 'error' in result.stdout.lower():  # GUESSING
-                self.logger.error(result.stdout, extra={ 'from_subprocess': True })
+            if 'error' in result_output.lower():  # GUESSING
+                self.logger.error(result_output, extra={ 'from_subprocess': True })
                 raise Exception(error_msg)
-            self.logger.debug(result.stdout, extra={ 'from_subprocess': True })
+            self.logger.debug(result_output, extra={ 'from_subprocess': True })
             self.logger.info("successful PlatformIO project initialization")
-            return result.returncode
+            return return_code
         else:
-            self.logger.error(f"Return code is {result.returncode}. Output:\n\n{result.stdout}",
+            self.logger.error(f"Return code is {return_code}. Output:\n\n{result_output}",
                               extra={ 'from_subprocess': True })
             raise Exception(error_msg)
 
@@ -541,9 +1104,19 @@ class Stm32pio:
         except Exception as e:
             raise Exception("Cannot determine is project patched: 'platformio.ini' file is incorrect") from e
 
-        patch_config = configparser.ConfigParser(interpolation=None)  # our patch has the INI config format, too
+        return self._platformio_ini_matches_patch(platformio_ini)
+
+
+    def _platformio_ini_matches_patch(self, platformio_ini: configparser.ConfigParser) -> bool:
+        """
+        Compare the already parsed 'platformio.ini' config against the patch. Raises if the patch itself is incorrect
+
+        Returns:
+            boolean indicating a result
+        """
+
         try:
-            patch_config.read_string(self.config.get('project', 'platformio_ini_patch_content'))
+            patch_config = _parse_patch(self.config.get('project', 'platformio_ini_patch_content'))
         except Exception as e:
             raise Exception("Cannot determine is project patched: desired patch content is invalid (should satisfy "
                             "INI-format requirements)") from e
@@ -562,6 +1135,7 @@ class Stm32pio:
         return True
 
 
+    @stm32pio.trace.traced()
     def patch(self) -> None:
         """
         Patch the 'platformio.ini' config file by a user's patch. By default, it sets the created earlier (by CubeMX
@@ -570,56 +1144,88 @@ class Stm32pio:
         violated. In the end, removes an old empty folders.
         """
 
-        self.logger.debug("patching 'platformio.ini' file...")
-
-        if self.platformio_ini_is_patched:
-            self.logger.info("'platformio.ini' has been already patched")
-        else:
-            platformio_ini_config = self.platformio_ini_config  # existing .ini file
+        import shutil
+        with self._recorded('patch'):
+            self.logger.debug("patching 'platformio.ini' file...")
 
-            patch_config = configparser.ConfigParser(interpolation=None)  # our patch has the INI config format, too
-            patch_config.read_string(self.config.get('project', 'platformio_ini_patch_content'))
+            if self.platformio_ini_is_patched:
+                self.logger.info("'platformio.ini' has been already patched")
+            else:
+                platformio_ini_config = self.platformio_ini_config  # existing .ini file
 
-            # Merge 2 configs
-            for patch_section in patch_config.sections():
-                if not platformio_ini_config.has_section(patch_section):
-                    self.logger.debug(f"[{patch_section}] section was added")
-                    platformio_ini_config.add_section(patch_section)
-                for patch_key, patch_value in patch_config.items(patch_section):
-                    self.logger.debug(f"set [{patch_section}]{patch_key} = {patch_value}")
-                    platformio_ini_config.set(patch_section, patch_key, patch_value)
+                patch_config = _parse_patch(self.config.get('project', 'platformio_ini_patch_content'))
 
-            # Save, overwriting (node='w') the original file (deletes all comments!)
-            with self.path.joinpath('platformio.ini').open(mode='w') as platformio_ini_file:
-                platformio_ini_config.write(platformio_ini_file)
-                self.logger.debug("'platformio.ini' has been patched")
+                # Merge 2 configs
+                for patch_section in patch_config.sections():
+                    if not platformio_ini_config.has_section(patch_section):
+                        self.logger.debug(f"[{patch_section}] section was added")
+                        platformio_ini_config.add_section(patch_section)
+                    for patch_key, patch_value in patch_config.items(patch_section):
+                        self.logger.debug(f"set [{patch_section}]{patch_key} = {patch_value}")
+                        platformio_ini_config.set(patch_section, patch_key, patch_value)
 
-        try:
-            shutil.rmtree(self.path.joinpath('include'))
-            self.logger.debug("'include' folder has been removed")
-        except Exception:
-            self.logger.info("cannot delete 'include' folder", exc_info=self.logger.isEnabledFor(logging.DEBUG))
+                # Save, overwriting (node='w') the original file (deletes all comments!)
+                with self.path.joinpath('platformio.ini').open(mode='w') as platformio_ini_file:
+                    platformio_ini_config.write(platformio_ini_file)
+                    self.logger.debug("'platformio.ini' has been patched")
 
-        # Remove 'src' directory too but on case-sensitive file systems 'Src' == 'src' == 'SRC' so we need to check
-        if not self.path.joinpath('SRC').is_dir():
             try:
-                shutil.rmtree(self.path.joinpath('src'))
-                self.logger.debug("'src' folder has been removed")
+                shutil.rmtree(self.path.joinpath('include'))
+                self.logger.debug("'include' folder has been removed")
             except Exception:
-                self.logger.info("cannot delete 'src' folder", exc_info=self.logger.isEnabledFor(logging.DEBUG))
+                self.logger.info("cannot delete 'include' folder", exc_info=self.logger.isEnabledFor(logging.DEBUG))
 
-        self.logger.info("project has been patched")
+            # Remove 'src' directory too but on case-sensitive file systems 'Src' == 'src' == 'SRC' so we need to check
+            if not self.path.joinpath('SRC').is_dir():
+                try:
+                    shutil.rmtree(self.path.joinpath('src'))
+                    self.logger.debug("'src' folder has been removed")
+                except Exception:
+                    self.logger.info("cannot delete 'src' folder", exc_info=self.logger.isEnabledFor(logging.DEBUG))
 
+            self.invalidate_state()
+            self.logger.info("project has been patched")
 
-    def build(self) -> int:
+
+    @stm32pio.trace.traced()
+    def build(self, force: bool = False) -> int:
         """
         Initiate a build of the PlatformIO project by the PlatformIO ('run' command). PlatformIO prints warning and
-        error messages by itself to the STDERR so there is no need to catch it and output by us
+        error messages by itself to the STDERR so there is no need to catch it and output by us. The build is skipped if
+        nothing has been changed since the last successful one (see _build_fingerprint()) or its result is found in the
+        firmware cache (see _restore_firmware())
+
+        Args:
+            force: run PlatformIO even if the firmware is up-to-date
 
         Returns:
             passes a return code of the PlatformIO
         """
 
+        import subprocess
+        skip, fingerprint, cache_key = self._lookup_build(force)
+        if skip:
+            return 0  # skipped runs are not recorded into the history as they would distort the statistics
+
+        command_arr, log_level = self._prepare_build()
+        with self._recorded('build') as run:
+            # The result is determined by the return code only so there is no need to store the (possibly huge) output
+            with stm32pio.util.LogPipe(self.logger, log_level, capture=stm32pio.util.LogPipeCapture.NONE) as log, \
+                    stm32pio.trace.span('subprocess: PlatformIO build', category='subprocess', command=command_arr):
+                result = subprocess.run(command_arr, stdout=log.pipe, stderr=log.pipe)
+            self.invalidate_state()
+            run['success'] = result.returncode == 0
+            return self._check_build_result(result.returncode, fingerprint, cache_key)
+
+
+    def _prepare_build(self) -> Tuple[List[str], int]:
+        """
+        Common part of the sync and async (see stm32pio.aio) build
+
+        Returns:
+            PlatformIO command and the logging level for its output
+        """
+
         self.logger.info("starting PlatformIO project build...")
 
         command_arr = [self.config.get('app', 'platformio_cmd'), 'run', '-d', str(self.path)]
@@ -629,14 +1235,177 @@ class Stm32pio:
         # In the non-verbose mode (logging.INFO) there would be a '--silent' option so if the PlatformIO will decide to
         # output something then it's really important and we use logging.WARNING as a level
         log_level = logging.DEBUG if self.logger.isEnabledFor(logging.DEBUG) else logging.WARNING
-        with stm32pio.util.LogPipe(self.logger, log_level) as log:
-            result = subprocess.run(command_arr, stdout=log.pipe, stderr=log.pipe)
+        return command_arr, log_level
+
+
+    def _lookup_build(self, force: bool) -> Tuple[bool, str, Optional[str]]:
+        """
+        Common part of the sync and async (see stm32pio.aio) build preceding the PlatformIO invocation: check whether
+        the build is needed at all and whether its result can be taken from the firmware cache. The forced build is
+        always performed by the PlatformIO (its result still goes to the cache)
+
+        Returns:
+            whether the build should be skipped, the fingerprint of the build inputs and the firmware cache key (None if
+            the cache is disabled)
+        """
+
+        fingerprint = self._build_fingerprint()
+        if not force and self._build_is_up_to_date(fingerprint):
+            self.logger.info("the firmware is up-to-date (nothing has been changed since the last successful build), "
+                             "skipping the build. Force it if you need to")
+            return True, fingerprint, None
+
+        self._write_fingerprint('build', None)  # the firmware is about to be changed, the old one is not valid
+        restored, cache_key = self._restore_firmware(restore=not force)
+        if restored:
+            self._write_fingerprint('build', fingerprint)
+        return restored, fingerprint, cache_key
+
+
+    def _build_fingerprint(self) -> str:
+        """
+        Cheap digest of the build inputs: the modification times and sizes of the source files (see
+        settings.firmware_source_dirs, the content is not read), 'platformio.ini' content, the board and the PlatformIO
+        executable. PlatformIO spends seconds to figure out there is nothing to do so comparing this to the last
+        successful build is much faster
+        """
+        import hashlib
+        digest = hashlib.sha256()
+        with contextlib.suppress(OSError):  # missing file is a valid state, the build will just fail
+            digest.update(self.path.joinpath('platformio.ini').read_bytes())
+        for part in [self.config.get('project', 'board'),
+                     stm32pio.util.executable_identity(self.config.get('app', 'platformio_cmd'))]:
+            digest.update(b'\0' + part.encode())
+
+        def walk(directory: str) -> None:
+            try:
+                with os.scandir(directory) as entries:
+                    entries = sorted(entries, key=lambda entry: entry.name)
+            except OSError:  # e.g. no such folder
+                return
+            for entry in entries:
+                if entry.is_dir():
+                    walk(entry.path)
+                else:
+                    stat = entry.stat()
+                    digest.update(f'\0{os.path.relpath(entry.path, self.path)}\0{stat.st_size}\0{stat.st_mtime_ns}'
+                                  .encode())
+
+        for source_dir in stm32pio.settings.firmware_source_dirs:
+            walk(str(self.path.joinpath(source_dir)))
+        return digest.hexdigest()
+
+
+    def _build_is_up_to_date(self, fingerprint: str = None) -> bool:
+        """Whether the firmware is present and has been built from the current sources and 'platformio.ini'"""
+        if fingerprint is None:
+            fingerprint = self._build_fingerprint()
+        return fingerprint == self._read_fingerprint('build') and self.state[ProjectStage.BUILT]
+
 
-        if result.returncode == 0:
+    def _check_build_result(self, return_code: int, fingerprint: str = None, cache_key: str = None) -> int:
+        """
+        Common part of the sync and async build following the PlatformIO invocation: report the result, remember the
+        fingerprint of the successful build and put the firmware into the cache (if the key is given, see
+        _restore_firmware())
+        """
+        if return_code == 0:
             self.logger.info("successful PlatformIO build")
+            if fingerprint is not None:
+                self._write_fingerprint('build', fingerprint)
+            if cache_key is not None:
+                self._store_firmware(cache_key)
         else:
             self.logger.error("PlatformIO build error")
-        return result.returncode
+        return return_code
+
+
+    @property
+    def firmware_cache(self) -> Optional['stm32pio.firmware_cache.FirmwareCache']:
+        """Firmware cache configured in the 'app' config section or None if disabled (see stm32pio.firmware_cache)"""
+        cache_dir = self.config.get('app', 'firmware_cache_dir', fallback='')
+        if cache_dir == '':
+            return None
+        import stm32pio.firmware_cache
+        max_size = int(float(self.config.get('app', 'firmware_cache_max_size')) * 1024 * 1024)
+        # Relative path is relative to the project, absolute path stays as it is
+        return stm32pio.firmware_cache.FirmwareCache(self.path.joinpath(os.path.expanduser(cache_dir)), max_size)
+
+
+    def _firmware_cache_key(self) -> str:
+        """
+        Digest of everything the build artifacts depend on: the sources (see settings.firmware_source_dirs),
+        'platformio.ini', the board and the PlatformIO version. Note that the toolchain packages are determined by
+        PlatformIO itself, so pin the platform version in the 'platformio.ini' to make the cache fully reliable
+        """
+        import hashlib
+        digest = hashlib.sha256()
+
+        def add(name: str, content: bytes) -> None:  # length-prefixed so the different parts can't be confused
+            digest.update(f'{name}\0{len(content)}\0'.encode())
+            digest.update(content)
+
+        add('board', self.config.get('project', 'board').encode())
+        add('platformio', self._tool_versions('build').get('platformio', 'unknown').encode())
+        add('platformio.ini', self.path.joinpath('platformio.ini').read_bytes())
+        for source_dir in stm32pio.settings.firmware_source_dirs:
+            for root, dir_names, file_names in os.walk(self.path.joinpath(source_dir)):
+                dir_names.sort()  # the walking order should not depend on the file system
+                for file_name in sorted(file_names):
+                    file = pathlib.Path(root, file_name)
+                    add(file.relative_to(self.path).as_posix(), file.read_bytes())
+        return digest.hexdigest()
+
+
+    def _restore_firmware(self, restore: bool = True) -> Tuple[bool, Optional[str]]:
+        """
+        Look up the firmware cache (if enabled) before the build. Cache problems are never fatal: the build is simply
+        performed as usual
+
+        Args:
+            restore: whether to take the firmware from the cache or only compute the key to store the new one under
+
+        Returns:
+            whether the firmware has been restored (so the build is not needed) and the key to store the build results
+            under (None if the cache is disabled or not available)
+        """
+        firmware_cache = self.firmware_cache
+        if firmware_cache is None:
+            return False, None
+
+        with stm32pio.trace.span('firmware cache lookup'):
+            try:
+                firmware_files = self._firmware_files(self.platformio_ini_config)
+                if len(firmware_files) == 0:
+                    return False, None
+                cache_key = self._firmware_cache_key()
+                if not restore:
+                    return False, cache_key
+                restored = firmware_cache.restore(cache_key, firmware_files[0].parent.parent)
+            except Exception as e:
+                self.logger.warning(f"firmware cache is not available: {e}",
+                                    exc_info=self.logger.isEnabledFor(logging.DEBUG))
+                return False, None
+
+        if restored is None:
+            self.logger.debug(f"firmware cache miss: {cache_key}")
+            return False, cache_key
+
+        self.invalidate_state()
+        self.logger.info(f"firmware has been restored from the cache ({cache_key}), PlatformIO build is skipped")
+        return True, cache_key
+
+
+    def _store_firmware(self, cache_key: str) -> None:
+        """Put the just built firmware into the cache (see _restore_firmware())"""
+        try:
+            firmware_files = [file for file in self._firmware_files(self.platformio_ini_config) if file.is_file()]
+            # Paths relative to the build folder: 'ENV/firmware.EXT'
+            self.firmware_cache.store(cache_key, { file.relative_to(file.parent.parent).as_posix(): file
+                                                   for file in firmware_files })
+        except Exception as e:
+            self.logger.warning(f"cannot store the firmware in the cache: {e}",
+                                exc_info=self.logger.isEnabledFor(logging.DEBUG))
 
 
     def start_editor(self, editor_command: str) -> int:
@@ -652,6 +1421,8 @@ class Stm32pio:
             passes a return code of the command
         """
 
+        import shlex
+        import subprocess
         sanitized_input = shlex.quote(editor_command)
 
         self.logger.info(f'starting an editor "{sanitized_input}"...')
@@ -668,18 +1439,348 @@ class Stm32pio:
             return e.returncode
 
 
-    def clean(self) -> None:
-        """
-        Clean-up the project folder preserving only an '.ioc' file
+    @stm32pio.trace.traced()
+    def clean(self, wait: bool = False) -> None:
         """
+        Clean-up the project folder preserving only an '.ioc' file and the stm32pio own data: the service folder (the
+        actions history is kept, the fingerprints are dropped as the results they describe are gone) and the firmware
+        cache, if it is configured to be inside the project. The entries are moved into the hidden trash folder (see
+        settings.trash_dir_name) which is a quick rename on the same filesystem, so the project is clean right after
+        the call. The actual deletion is done in the background (see stm32pio.util.TrashCollector), along with the trash
+        left by the interrupted runs
 
-        for child in self.path.iterdir():
-            if child.name != f"{self.path.name}.ioc":
-                if child.is_dir():
-                    shutil.rmtree(child, ignore_errors=True)
-                    self.logger.debug(f"del {child}/")
-                elif child.is_file():
-                    child.unlink()
-                    self.logger.debug(f"del {child}")
+        Args:
+            wait: block until the files are actually deleted
+        """
 
+        import shutil
+        trash_dir = self.path.joinpath(stm32pio.settings.trash_dir_name)
+        preserved = [f"{self.path.name}.ioc", trash_dir.name, stm32pio.settings.service_dir_name]
+        firmware_cache = self.firmware_cache
+        if firmware_cache is not None:
+            with contextlib.suppress(ValueError):  # outside the project
+                preserved.extend(firmware_cache.path.resolve().relative_to(self.path.resolve()).parts[:1])
+
+        with contextlib.suppress(FileNotFoundError):
+            self.path.joinpath(stm32pio.settings.service_dir_name, stm32pio.settings.fingerprints_file_name).unlink()
+
+        # Every call gets its own subfolder so the entries of the same name from the different runs don't clash
+        with stm32pio.util.trash_collector.portion(trash_dir) as portion:
+            for child in self.path.iterdir():
+                if child.name not in preserved:
+                    suffix = '/' if child.is_dir() else ''
+                    try:
+                        os.replace(child, portion.joinpath(child.name))
+                    except OSError:  # e.g. some file is opened on Windows, fall back to the immediate deletion
+                        if child.is_dir():
+                            shutil.rmtree(child, ignore_errors=True)
+                        else:
+                            with contextlib.suppress(OSError):
+                                child.unlink()
+                    self.logger.debug(f"del {child}{suffix}")
+
+        self.invalidate_state()
+        if wait:
+            stm32pio.util.trash_collector.wait(trash_dir)
         self.logger.info("project has been cleaned")
+
+
+    @stm32pio.trace.traced()
+    def plan(self, with_build: bool = False, force: bool = False) -> List[PipelineStep]:
+        """
+        Decide which actions are needed to take the project to the PATCHED (or BUILT) stage from its current state. The
+        stages already fulfilled are skipped so the interrupted (e.g. failed) pipeline resumes from where it has
+        stopped. Nothing is changed on disk
+
+        Args:
+            with_build: include the PlatformIO build
+            force: regenerate the code (and rebuild the firmware) even if it is up-to-date
+
+        Returns:
+            list of PipelineStep's (all of them, see their 'run' field)
+        """
+
+        state = self.state
+        steps = []
+
+        if force:
+            steps.append(PipelineStep('generate_code', ProjectStage.GENERATED, True, "forced"))
+        elif not state[ProjectStage.GENERATED]:
+            steps.append(PipelineStep('generate_code', ProjectStage.GENERATED, True, "the code hasn't been generated"))
+        elif not self._generation_is_up_to_date():
+            steps.append(PipelineStep('generate_code', ProjectStage.GENERATED, True,
+                                      "the code doesn't match the current .ioc file and CubeMX parameters"))
+        else:
+            steps.append(PipelineStep('generate_code', ProjectStage.GENERATED, False, "the code is up-to-date"))
+
+        # The code regeneration doesn't touch the PlatformIO files so these are checked on their own
+        if state[ProjectStage.PIO_INITIALIZED]:
+            steps.append(PipelineStep('pio_init', ProjectStage.PIO_INITIALIZED, False,
+                                      "PlatformIO project is already initialized"))
+        else:
+            steps.append(PipelineStep('pio_init', ProjectStage.PIO_INITIALIZED, True,
+                                      "PlatformIO project hasn't been initialized"))
+
+        if steps[-1].run:  # PlatformIO creates its default folders again so the patch should be reapplied
+            steps.append(PipelineStep('patch', ProjectStage.PATCHED, True, "PlatformIO project is about to be created"))
+        elif state[ProjectStage.PATCHED]:
+            steps.append(PipelineStep('patch', ProjectStage.PATCHED, False, "the project is already patched"))
+        else:
+            steps.append(PipelineStep('patch', ProjectStage.PATCHED, True, "the project hasn't been patched"))
+
+        if with_build:
+            if force:
+                steps.append(PipelineStep('build', ProjectStage.BUILT, True, "forced"))
+            elif any(step.run for step in steps):
+                steps.append(PipelineStep('build', ProjectStage.BUILT, True, "the project is about to be changed"))
+            elif not state[ProjectStage.BUILT]:
+                steps.append(PipelineStep('build', ProjectStage.BUILT, True, "the firmware hasn't been built"))
+            elif not self._build_is_up_to_date():
+                steps.append(PipelineStep('build', ProjectStage.BUILT, True,
+                                          "the sources or 'platformio.ini' have been changed since the last build"))
+            else:
+                steps.append(PipelineStep('build', ProjectStage.BUILT, False, "the firmware is up-to-date"))
+
+        return steps
+
+
+    @stm32pio.trace.traced()
+    def run_pipeline(self, with_build: bool = False, force: bool = False,
+                     actions: Mapping[str, Callable[[], Any]] = None) -> List[PipelineStep]:
+        """
+        Execute the plan (see plan()) step by step. The first failed step stops the pipeline with an exception, next
+        call will continue from it
+
+        Args:
+            with_build, force: see plan()
+            actions: replacements for the steps methods (e.g. to limit the number of simultaneous builds), by name
+
+        Returns:
+            the executed plan
+        """
+
+        steps = self.plan(with_build=with_build, force=force)
+        for step in steps:
+            if not step.run:
+                self.logger.info(f"skipping '{step.action}': {step.reason}")
+                continue
+            if actions is not None and step.action in actions:
+                action = actions[step.action]
+            elif step.action in ['generate_code', 'build']:
+                action = functools.partial(getattr(self, step.action), force=force)
+            else:
+                action = getattr(self, step.action)
+            result = action()
+            if step.action == 'build' and result != 0:
+                raise Exception("PlatformIO build error")
+        return steps
+
+
+
+class CubeMXWorker:
+    """
+    Long-living STM32CubeMX process started in the interactive console mode ('-i' option) and accepting the script
+    commands via its STDIN. Starting the JVM and loading the CubeMX database take the most of the code generation time
+    so sharing a single worker between the projects (or subsequent generations of the same project) saves it. Scripts
+    are executed one at a time (the worker is thread-safe). The process is started lazily on the first script:
+
+        with stm32pio.lib.CubeMXWorker('java', '/path/to/STM32CubeMX') as worker:
+            for path in paths:
+                stm32pio.lib.Stm32pio(path, instance_options={ 'cubemx_worker': worker }).generate_code()
+
+    The console prints the 'MX>' prompt when it is ready for the next command, so the prompt is the end-of-command
+    marker: the script is completed when every its command has been answered by the prompt. The first prompt is the
+    startup probe as well. If it doesn't appear in time (e.g. this CubeMX version shows the UI instead of the console)
+    the worker is considered not headless, the process is stopped and the projects fall back to the one-shot CubeMX
+    processes (see Stm32pio._can_use_cubemx_worker()). On error or timeout of the script the process is stopped (its
+    internal state is unknown at this point) and will be restarted on the next script.
+    """
+
+    prompt = 'MX>'
+
+    def __init__(self, java_cmd: str, cubemx_cmd: str, timeout: float = None, startup_timeout: float = None):
+        """
+        Args:
+            java_cmd: command to start the Java
+            cubemx_cmd: path to the CubeMX executable JAR
+            timeout: seconds to wait for the script completion (see settings.py for the default value)
+            startup_timeout: seconds to wait for the first prompt (see settings.py for the default value)
+        """
+        self.java_cmd = java_cmd
+        self.cubemx_cmd = cubemx_cmd
+        self.timeout = timeout if timeout is not None else stm32pio.settings.cubemx_worker_timeout
+        self.startup_timeout = startup_timeout if startup_timeout is not None else \
+            stm32pio.settings.cubemx_worker_startup_timeout
+
+        self.headless = None  # unknown until the first start, then whether the startup probe has succeeded
+        self.process = None
+        self._output = None  # queue.Queue of the decoded output chunks filled by the reading thread, None marks the EOF
+        self._pending = ''  # incomplete line of the output
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> 'CubeMXWorker':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def is_compatible(self, java_cmd: str, cubemx_cmd: str) -> bool:
+        """Whether the worker is running the same Java and CubeMX the project is configured to use"""
+        return java_cmd == self.java_cmd and cubemx_cmd == self.cubemx_cmd
+
+    @property
+    def command(self) -> List[str]:
+        """Arguments of the process (-i: interactive console mode)"""
+        return [self.java_cmd, '-jar', self.cubemx_cmd, '-i']
+
+    @staticmethod
+    def _read_output(stream, output: queue.Queue) -> None:
+        """Routine of the reading thread. Reads the chunks as they come as the prompt is not followed by a newline"""
+        import codecs
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while True:
+            chunk = os.read(stream.fileno(), 65536)
+            text = decoder.decode(chunk, final=chunk == b'')
+            if text:
+                output.put(text)
+            if chunk == b'':
+                break
+        output.put(None)
+        stream.close()
+
+    def _read_until_prompts(self, count: int, timeout: float, logger: logging.Logger, output: List[str]) -> str:
+        """
+        Consume the output until the given number of prompts has been received. Complete lines are logged (DEBUG level)
+        and appended to the 'output' list
+
+        Returns:
+            'ok', 'timeout' or 'eof'
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            while True:  # handle everything received so far
+                while self._pending.startswith(self.prompt):
+                    count -= 1
+                    self._pending = self._pending[len(self.prompt):].lstrip(' ')
+                line, newline, rest = self._pending.partition('\n')
+                if not newline:
+                    break
+                self._pending = rest
+                line = line.rstrip('\r')
+                if line.strip():
+                    output.append(f'{line}\n')
+                    logger.debug(line, extra={ 'from_subprocess': True })
+            if count <= 0:
+                return 'ok'
+
+            try:
+                chunk = self._output.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                return 'timeout'
+            if chunk is None:
+                if self._pending.strip():
+                    output.append(f'{self._pending}\n')
+                    logger.debug(self._pending, extra={ 'from_subprocess': True })
+                self._pending = ''
+                return 'eof'
+            self._pending += chunk
+
+    @stm32pio.trace.traced('CubeMXWorker: JVM start', category='subprocess')
+    def _start(self, logger: logging.Logger) -> bool:
+        """Start the process and wait for its first prompt (the startup probe). Returns whether it has succeeded"""
+        import subprocess
+        logger.debug("starting the CubeMX worker process...")
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+        self._output = queue.Queue()
+        self._pending = ''
+        threading.Thread(target=self._read_output, args=(self.process.stdout, self._output), daemon=True).start()
+
+        result = self._read_until_prompts(1, self.startup_timeout, logger, [])
+        if result != 'ok':
+            logger.debug(f"CubeMX worker hasn't shown the console prompt ({result}), it will not be used")
+            self._stop()
+        self.headless = result == 'ok'
+        return self.headless
+
+    def _stop(self) -> None:
+        """Forcibly terminate the process"""
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def _ensure_started(self, logger: logging.Logger) -> bool:
+        """Should be called under the lock"""
+        if self.process is not None and self.process.poll() is None:
+            # Output of the previous script (if any) is not related to this one
+            with contextlib.suppress(queue.Empty):
+                while True:
+                    if self._output.get_nowait() is None:  # the process has exited in the meantime
+                        self.process.wait()
+                        self.process = None
+                        break
+            self._pending = ''
+        if self.process is None or self.process.poll() is not None:
+            return self._start(logger)
+        return True
+
+    def start(self, logger: logging.Logger) -> bool:
+        """
+        Start the process (if it isn't running yet)
+
+        Returns:
+            whether the worker is usable, i.e. the process has started in the console mode. A worker that has failed to
+            do so is not restarted
+        """
+        with self._lock:
+            if self.headless is False:
+                return False
+            return self._ensure_started(logger)
+
+    @stm32pio.trace.traced()
+    def run_script(self, script: str, logger: logging.Logger) -> Tuple[int, str]:
+        """
+        Execute the CubeMX script (same as the one passed via the '-q' option). The 'exit' command is ignored as the
+        process should stay alive. The output is redirected into the given logger (with DEBUG level)
+
+        Returns:
+            return code (0 if every command has been completed) and the output of this script
+        """
+
+        with self._lock:
+            if not self._ensure_started(logger):
+                return -1, "CubeMX worker cannot be started in the console mode"
+
+            commands = [line for line in script.splitlines() if line.strip() and line.strip().lower() != 'exit']
+            try:
+                self.process.stdin.write(''.join(f'{command}\n' for command in commands).encode('utf-8'))
+                self.process.stdin.flush()
+            except OSError as e:
+                self._stop()
+                return -1, f"cannot pass the commands to the CubeMX worker: {e}"
+
+            output = []
+            result = self._read_until_prompts(len(commands), self.timeout, logger, output)
+            if result == 'timeout':
+                self._stop()
+                output.append(f"CubeMX worker has not completed the script in {self.timeout} seconds\n")
+                return -1, ''.join(output)
+            elif result == 'eof':
+                return_code = self.process.wait()
+                self.process = None
+                return return_code if return_code != 0 else -1, ''.join(output)  # has exited prematurely anyway
+            return 0, ''.join(output)  # the caller analyzes the output for the success/error markers
+
+    def close(self) -> None:
+        """Ask the process to exit gracefully (kill it if this doesn't help)"""
+        import subprocess
+        with self._lock:
+            if self.process is not None and self.process.poll() is None:
+                try:
+                    self.process.stdin.write(b'exit\n')
+                    self.process.stdin.close()
+                    self.process.wait(timeout=10)
+                except (OSError, subprocess.TimeoutExpired):
+                    self._stop()
+            self.process = None
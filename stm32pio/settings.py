@@ -1,12 +1,12 @@
+# This module is imported by every CLI call so keep it free of heavy imports (see tests.test_cli.test_import_time)
 import collections
-import inspect
 import pathlib
-import platform
+import sys
 
-import stm32pio.lib
 
-
-my_os = platform.system()
+# Same values as platform.system() gives but without importing the 'platform' module
+my_os = { 'darwin': 'Darwin', 'linux': 'Linux', 'win32': 'Windows', 'cygwin': 'Windows' }.get(sys.platform,
+                                                                                              sys.platform)
 
 config_default = collections.OrderedDict(
     app={
@@ -25,15 +25,23 @@ config_default = collections.OrderedDict(
             # Linux (Ubuntu) default: home directory
             str(pathlib.Path.home().joinpath("STM32CubeMX/STM32CubeMX")) if my_os == 'Linux' else
             # Windows default: Program Files
-            "C:/Program Files/STMicroelectronics/STM32Cube/STM32CubeMX/STM32CubeMX.exe" if my_os == 'Windows' else None
+            "C:/Program Files/STMicroelectronics/STM32Cube/STM32CubeMX/STM32CubeMX.exe" if my_os == 'Windows' else None,
+
+        # (optional) Folder of the firmware cache (see stm32pio.firmware_cache). Builds having exactly the same sources,
+        # 'platformio.ini', board and PlatformIO version are restored from it instead of running PlatformIO. Point
+        # it to some shared location (e.g. the CI cache) to reuse the builds across the projects copies. Empty value
+        # disables the cache
+        'firmware_cache_dir': '',
+
+        # (default is OK) Total size limit of the firmware cache, megabytes. Least recently used builds are evicted
+        'firmware_cache_max_size': '512'
     },
     project={
         # (default is OK) See CubeMX user manual PDF (UM1718) to get other useful options
-        'cubemx_script_content': inspect.cleandoc('''
-            config load ${ioc_file_absolute_path}
-            generate code ${project_dir_absolute_path}
-            exit
-        ''') + '\n',
+        'cubemx_script_content':
+            'config load ${ioc_file_absolute_path}\n'
+            'generate code ${project_dir_absolute_path}\n'
+            'exit\n',
 
         # Override the defaults to comply with CubeMX project structure. This should meet INI-style requirements. You
         # can include existing sections, too (e.g.
@@ -42,11 +50,10 @@ config_default = collections.OrderedDict(
         #   key = value
         #
         # will add a 'key' parameter)
-        'platformio_ini_patch_content': inspect.cleandoc('''
-            [platformio]
-            include_dir = Inc
-            src_dir = Src
-        ''') + '\n',
+        'platformio_ini_patch_content':
+            '[platformio]\n'
+            'include_dir = Inc\n'
+            'src_dir = Src\n',
 
         # Runtime-determined values
         'board': '',
@@ -56,6 +63,60 @@ config_default = collections.OrderedDict(
 
 config_file_name = 'stm32pio.ini'
 
+# Hidden folder inside the project to keep the service data (e.g. fingerprints of the last successful actions). It is
+# not meant to be edited by a user
+service_dir_name = '.stm32pio'
+fingerprints_file_name = 'fingerprints.json'
+
+# 'clean' moves the doomed entries into this hidden folder in the project (a fast rename on the same filesystem) and
+# they are deleted in the background by that many threads (see stm32pio.util.TrashCollector)
+trash_dir_name = '.stm32pio-trash'
+trash_removal_jobs = 4
+
+# Folders of the project the firmware depends on (along with the 'platformio.ini', the board and the PlatformIO). Their
+# content is a part of the firmware cache key and their files modification times and sizes are compared to the last
+# successful build to skip the unnecessary ones
+firmware_source_dirs = ['Src', 'Inc', 'Drivers', 'Middlewares', 'lib']
+
+# Actions available for the 'batch' subcommand (see stm32pio.batch)
+batch_actions = ['init', 'generate', 'new', 'status', 'clean']
+
+# History of the actions runs (see stm32pio.history) in the service folder. Only the last records are kept. The size of
+# the record (bytes) is an estimation used to decide when to count the records without reading the file on every append
+history_file_name = 'history.jsonl'
+history_max_records = 1000
+history_record_size = 200
+
+# PlatformIO boards list is cached in the user cache folder (see stm32pio.util.PlatformIOBoardsCache). TTL is in
+# seconds, the outdated list is still used while the new one is being obtained in the background. Failed queries are
+# remembered too (for the shorter period) so the missing/broken PlatformIO doesn't slow down every project instantiation
+platformio_boards_cache_file_name = 'platformio_boards.json'
+platformio_boards_cache_ttl = 24 * 60 * 60
+platformio_boards_cache_failure_ttl = 5 * 60
+
+# Versions of the tools (for the actions history) are cached in the user cache folder too, per the tool executable
+tool_versions_cache_file_name = 'tool_versions.json'
+
+# Persistent CubeMX worker (see stm32pio.lib.CubeMXWorker): seconds to wait for a script to complete and seconds to wait
+# for the console prompt after the start (the worker is not used if it doesn't appear)
+cubemx_worker_timeout = 10 * 60
+cubemx_worker_startup_timeout = 60
+
+# Number of the last subprocess output lines stored by stm32pio.util.LogPipe in the LogPipeCapture.TAIL mode
+log_pipe_tail_lines = 100
+# Seconds stm32pio.util.LogPipe waits for the rest of the output on exit. The pipe doesn't reach the EOF while someone
+# (e.g. a daemon spawned by the tool) still holds its writable end so the wait should be bounded
+log_pipe_drain_timeout = 5
+
+# Seconds to wait for the child process to exit after the termination request when the asyncio action is cancelled (see
+# stm32pio.aio). It is killed afterwards
+async_terminate_timeout = 5
+
+# Watch mode (see stm32pio.watch): seconds of the silence after the last file system event to wait before the run and
+# seconds between the polls when inotify is not available
+watch_debounce = 0.5
+watch_poll_interval = 1
+
 # Longest name (not necessarily a method so a little bit tricky...)
 # log_fieldwidth_function = max([len(member) for member in dir(stm32pio.lib.Stm32pio)]) + 1
 log_fieldwidth_function = 25 + 1
@@ -0,0 +1,160 @@
+"""
+Lightweight tracing of where the time goes: the project actions, their stages and subprocesses are recorded as the
+nested timing spans and can be exported in the Chrome trace_event JSON format (open it in chrome://tracing, Perfetto UI
+(https://ui.perfetto.dev) or any other compatible viewer). Spans of the different threads (e.g. of the batch runs) are
+placed on their own tracks so the critical path is clearly visible.
+
+Tracing is off by default and costs next to nothing in this case. Enable it for some block of code:
+
+    with stm32pio.trace.tracing('trace.json'):
+        project = stm32pio.lib.Stm32pio('path/to/project')
+        project.run_pipeline(with_build=True)
+
+or install your own Tracer via set_tracer() to process the events in some other way. CLI: use the '--trace FILE' option.
+
+Note: the spans are tied to the threads so the coroutines of stm32pio.aio are not instrumented (concurrent tasks share
+the single thread and would produce the overlapping, non-nested spans). The underlying sync operations still are.
+"""
+
+import contextlib
+import functools
+import os
+import pathlib
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Union
+
+
+class Tracer:
+    """
+    Thread-safe collector of the trace events. The events are kept in memory until written with write() or obtained
+    via the 'events' property
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events: List[Dict[str, Any]] = []
+        self._named_threads = set()
+        self._pid = os.getpid()
+        self._start = time.perf_counter()  # all timestamps are relative to this moment
+
+    def _timestamp(self) -> float:
+        """Microseconds since the tracer creation (the unit of the trace_event format)"""
+        return (time.perf_counter() - self._start) * 1e6
+
+    def _add(self, event: Dict[str, Any]) -> None:
+        thread = threading.current_thread()
+        with self._lock:
+            if thread.ident not in self._named_threads:  # metadata event so the viewer shows the thread names
+                self._named_threads.add(thread.ident)
+                self._events.append({ 'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': thread.ident,
+                                      'args': { 'name': thread.name } })
+            self._events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str = 'stm32pio', **args):
+        """
+        Record the execution time of the enclosed block as a 'complete' event. The args dict is yielded so the block can
+        add something to it. Exceptions are noted in the args too
+        """
+        start = self._timestamp()
+        try:
+            yield args
+        except BaseException as e:
+            args['exception'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self._add({ 'name': name, 'cat': category, 'ph': 'X', 'ts': start, 'dur': self._timestamp() - start,
+                        'pid': self._pid, 'tid': threading.get_ident(), 'args': args })
+
+    def instant(self, name: str, category: str = 'stm32pio', **args) -> None:
+        """Record a single point in time"""
+        self._add({ 'name': name, 'cat': category, 'ph': 'i', 's': 't', 'ts': self._timestamp(), 'pid': self._pid,
+                    'tid': threading.get_ident(), 'args': args })
+
+    @property
+    def events(self) -> List[Dict[str, Any]]:
+        """Copy of the recorded events"""
+        with self._lock:
+            return list(self._events)
+
+    def write(self, path: Union[str, pathlib.Path]) -> None:
+        """Save the events as the Chrome trace_event JSON file"""
+        import json
+        pathlib.Path(path).expanduser().write_text(
+            json.dumps({ 'traceEvents': self.events, 'displayTimeUnit': 'ms' }, default=str))
+
+
+_tracer: Optional[Tracer] = None  # active tracer, None means the tracing is off
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+
+def set_tracer(tracer: Optional[Tracer]) -> Optional[Tracer]:
+    """
+    Install the tracer (None to turn the tracing off)
+
+    Returns:
+        the previous one
+    """
+    global _tracer
+    previous, _tracer = _tracer, tracer
+    return previous
+
+
+@contextlib.contextmanager
+def tracing(path: Union[str, pathlib.Path] = None):
+    """
+    Trace the enclosed block with the new tracer (yielded) and save the result to the given file, if any. The previous
+    tracer is restored afterwards
+    """
+    tracer = Tracer()
+    previous = set_tracer(tracer)
+    try:
+        yield tracer
+    finally:
+        set_tracer(previous)
+        if path is not None:
+            tracer.write(path)
+
+
+def span(name: str, category: str = 'stm32pio', **args):
+    """Span of the active tracer or a no-op context manager if the tracing is off"""
+    tracer = _tracer
+    if tracer is None:
+        return _null_span
+    return tracer.span(name, category=category, **args)
+
+
+def traced(name: str = None, category: str = 'stm32pio') -> Callable:
+    """
+    Decorator recording every call of the function as a span. For the methods of the objects having the 'path'
+    attribute (e.g. Stm32pio) it is added to the span args so the projects are distinguishable
+
+    Args:
+        name: name of the span, qualified name of the function by default
+        category: category of the span
+    """
+    def decorator(function: Callable) -> Callable:
+        span_name = name if name is not None else function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return function(*args, **kwargs)
+            with tracer.span(span_name, category=category) as span_args:
+                try:
+                    return function(*args, **kwargs)
+                finally:  # look afterwards so the constructors are covered too
+                    path = getattr(args[0], 'path', None) if len(args) else None
+                    if path is not None:
+                        span_args['project'] = str(path)
+
+        return wrapper
+    return decorator
+
+
+_null_span = contextlib.nullcontext() if hasattr(contextlib, 'nullcontext') else contextlib.suppress()  # Python 3.6
@@ -2,17 +2,28 @@
 Some auxiliary entities not falling into other categories
 """
 
+import codecs
+import collections
 import contextlib
 import enum
+import io
 import json
+import locale
 import logging
 import os
-import subprocess
+import pathlib
+import queue
 import threading
+import time
 import traceback
 import warnings
 from typing import Any, List, Mapping, MutableMapping, Tuple, Optional
 
+# subprocess and tempfile are imported locally by the functions spawning the tools and writing the caches, respectively.
+# This module is loaded by every CLI call and most of them (e.g. 'stm32pio status') need neither of them
+import stm32pio.settings
+import stm32pio.trace
+
 module_logger = logging.getLogger(__name__)  # this file logger
 
 
@@ -51,7 +62,8 @@ class ProjectLoggerAdapter(logging.LoggerAdapter):
                                                          { 'project_id': id(self) })
 
     It will automatically mix in 'project_id' (and any other property) to every LogRecord (whether you supply 'extra' in
-    your log call or not)
+    your log call or not). If the 'prefix' is given in the context data it will be prepended to every message (useful
+    when the output of multiple projects is interleaved, e.g. in the batch mode)
     """
     def process(self, msg: Any, kwargs: MutableMapping[str, Any]) -> Tuple[Any, MutableMapping[str, Any]]:
         """Inject context data (both from the adapter and the log call)"""
@@ -59,6 +71,8 @@ class ProjectLoggerAdapter(logging.LoggerAdapter):
             kwargs['extra'].update(self.extra)
         else:
             kwargs['extra'] = self.extra
+        if 'prefix' in self.extra:
+            msg = f"{self.extra['prefix']} {msg}"
         return msg, kwargs
 
 
@@ -151,12 +165,87 @@ class DispatchingFormatter(logging.Formatter):
 
 
 
+class LogPipeCapture(enum.Enum):
+    """How much of the output LogPipe should store for the caller (everything is logged anyway)"""
+    NONE = enum.auto()  # nothing, use when the result is determined by other means (e.g. a return code)
+    TAIL = enum.auto()  # last N lines only (bounded memory)
+    FULL = enum.auto()  # the whole output
+
+
 class LogPipeRC:
     """Small class suitable for passing to the caller when the LogPipe context manager is invoked"""
-    value = ''  # string accumulating all incoming messages
 
-    def __init__(self, fd: int):
+    def __init__(self, fd: int, output: 'OutputLogger'):
         self.pipe = fd  # writable half of os.pipe
+        self.output = output
+
+    @property
+    def value(self) -> str:
+        """String of the captured messages. The lines are joined on every call so it is better to save the result"""
+        return self.output.value
+
+
+class OutputLogger:
+    """
+    Decode the binary chunks of some stream (e.g. subprocess output) into the lines, log them and store according to
+    the capture mode. Used by LogPipe and by the asyncio API (see stm32pio.aio)
+    """
+
+    def __init__(self, logger: logging.Logger, level: Optional[int], capture: LogPipeCapture = LogPipeCapture.FULL,
+                 tail_lines: int = stm32pio.settings.log_pipe_tail_lines, encoding: str = None):
+        """
+        Args:
+            logger: logger to redirect the messages to
+            level: logging level of the messages (None to only store them)
+            capture: what to store for the caller, see LogPipeCapture
+            tail_lines: number of the last lines to store for LogPipeCapture.TAIL
+            encoding: encoding of the incoming stream (locale one by default as for the text files)
+        """
+
+        self.logger = logger
+        self.level = level
+
+        # Decode the binary chunks as they come. The line endings are normalized like the text mode files do
+        self.decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(encoding or locale.getpreferredencoding(False))(errors='replace'),
+            translate=True)
+        self.pending = ''  # incomplete line from the previous chunks
+
+        if capture == LogPipeCapture.FULL:
+            self.lines = []
+        elif capture == LogPipeCapture.TAIL:
+            self.lines = collections.deque(maxlen=tail_lines)
+        else:
+            self.lines = None
+        # The lines can still be appended by the reading thread while the caller reads the value (e.g. LogPipe doesn't
+        # wait for the end of the output forever)
+        self._lock = threading.Lock()
+
+    @property
+    def value(self) -> str:
+        if self.lines is None:
+            return ''
+        with self._lock:
+            lines = list(self.lines)  # snapshot, iterating the deque being changed raises an error
+        return ''.join(lines)
+
+    def _consume(self, line: str):
+        if self.lines is not None:
+            with self._lock:
+                self.lines.append(line)  # accumulate the output
+        if self.level is not None:
+            self.logger.log(self.level, line.strip('\n'), extra={ 'from_subprocess': True })  # mark the message origin
+
+    def feed(self, chunk: bytes):
+        """Process the next chunk of the stream. An empty one means EOF so the rest is flushed"""
+        final = chunk == b''
+        lines = (self.pending + self.decoder.decode(chunk, final=final)).splitlines(keepends=True)
+        self.pending = lines.pop() if len(lines) and not lines[-1].endswith('\n') else ''
+        for line in lines:
+            self._consume(line)
+        if final and self.pending:
+            self._consume(self.pending)
+            self.pending = ''
 
 
 class LogPipe(threading.Thread, contextlib.AbstractContextManager):
@@ -164,19 +253,21 @@ class LogPipe(threading.Thread, contextlib.AbstractContextManager):
     The thread combined with a context manager to provide a nice way to temporarily redirect something's stream output
     into the logging module. One straightforward application is to suppress subprocess STDOUT and/or STDERR streams and
     wrap them into the logging mechanism as it is now for any other message in your app. Also, store the incoming
-    messages in the string for using it after an execution
+    messages (all of them or only the last ones, see LogPipeCapture) for using it after an execution
     """
 
-    def __init__(self, logger: logging.Logger, level: int, *args, **kwargs):
+    def __init__(self, logger: logging.Logger, level: int, *args, capture: LogPipeCapture = LogPipeCapture.FULL,
+                 tail_lines: int = stm32pio.settings.log_pipe_tail_lines, encoding: str = None, **kwargs):
+        """
+        Args:
+            logger, level, capture, tail_lines, encoding: see OutputLogger
+        """
+        kwargs.setdefault('daemon', True)  # the reader can outlive the context (see __exit__)
         super().__init__(*args, **kwargs)
 
-        self.logger = logger
-        self.level = level
-
         self.fd_read, self.fd_write = os.pipe()  # create 2 ends of the pipe and setup the reading one
-        self.pipe_reader = os.fdopen(self.fd_read)
-
-        self.rc = LogPipeRC(self.fd_write)  # "remote control"
+        self.output = OutputLogger(logger, level, capture=capture, tail_lines=tail_lines, encoding=encoding)
+        self.rc = LogPipeRC(self.fd_write, self.output)  # "remote control"
 
     def __enter__(self) -> LogPipeRC:
         """
@@ -190,30 +281,401 @@ class LogPipe(threading.Thread, contextlib.AbstractContextManager):
         """
         Routine of the thread, logging everything
         """
-        for line in iter(self.pipe_reader.readline, ''):  # stops the iterator when empty string will occur
-            self.rc.value += line  # accumulate the string
-            self.logger.log(self.level, line.strip('\n'), extra={ 'from_subprocess': True })  # mark the message origin
-        self.pipe_reader.close()
+        while True:
+            chunk = os.read(self.fd_read, 65536)
+            self.output.feed(chunk)
+            if chunk == b'':  # EOF, all writers have been closed
+                break
+        os.close(self.fd_read)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """
         The exception will be passed forward, if present, so we don't need to do something with that. The following
-        tear-down process will be done anyway
+        tear-down process will be done anyway. Closing the writable end makes the reading thread to finish so we wait
+        for it to have all the output consumed on exit. The wait is bounded as the pipe can be inherited by some other
+        process (e.g. a daemon spawned by the subprocess) keeping it open. The reader finishes in the background then
         """
         os.close(self.fd_write)
+        self.join(timeout=stm32pio.settings.log_pipe_drain_timeout)
+        if self.is_alive():
+            self.output.logger.warning("the output pipe is still held open by another process (probably a background "
+                                       "child of the tool), not waiting for the rest of the output")
+
+
+def ensure_service_dir(service_dir: pathlib.Path) -> pathlib.Path:
+    """Create the service folder of the project (see settings.service_dir_name), if there is no one yet"""
+    if not service_dir.is_dir():
+        service_dir.mkdir(exist_ok=True)
+        service_dir.joinpath('.gitignore').write_text('*\n')  # do not let it get into the user's VCS
+    return service_dir
+
+
+def user_cache_dir() -> pathlib.Path:
+    """Platform-specific folder for the application cache files (it is not created by this function)"""
+    system = stm32pio.settings.my_os
+    if system == 'Windows':
+        base = pathlib.Path(os.environ.get('LOCALAPPDATA', pathlib.Path.home().joinpath('AppData', 'Local')))
+        return base.joinpath('stm32pio', 'Cache')
+    elif system == 'Darwin':
+        return pathlib.Path.home().joinpath('Library', 'Caches', 'stm32pio')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home().joinpath('.cache')
+        return pathlib.Path(base).joinpath('stm32pio')
+
+
+def executable_identity(command: str) -> str:
+    """
+    Key identifying the executable: the command itself, its resolved path and the modification time. Tool upgrades
+    change it so it is suitable for the caches of the tool-related data
+    """
+    import shutil
+    executable = shutil.which(command)
+    if executable is not None:
+        with contextlib.suppress(OSError):
+            return f"{command}|{executable}|{os.stat(executable).st_mtime_ns}"
+    return command  # e.g. the command with arguments
 
 
-def get_platformio_boards(platformio_cmd) -> List[str]:
+@stm32pio.trace.traced('subprocess: PlatformIO boards', category='subprocess')
+def query_platformio_boards(platformio_cmd: str) -> List[str]:
     """
     Obtain the PlatformIO boards list. As we interested only in STM32 ones, cut off all the others.
 
     IMPORTANT NOTE: PlatformIO can go to the Internet from time to time when it decides that its cache is out of date.
-    So it can take a long time to execute.
+    So it can take a long time to execute. Consider to use the cached version, get_platformio_boards()
     """
 
+    import subprocess
     # Windows 7, as usual, correctly works only with shell=True...
     result = subprocess.run(f"{platformio_cmd} boards --json-output stm32cube",
                             encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, check=True)
 
     boards = json.loads(result.stdout)
     return [board['id'] for board in boards]
+
+
+class PlatformIOBoardsCache:
+    """
+    Persistent (on-disk, in the user cache folder) cache of the PlatformIO boards lists. Entries are keyed by the
+    PlatformIO command and the identity (resolved path and modification time) of its executable so the PlatformIO
+    upgrade invalidates them. The entry older than TTL is still returned while the fresh one is being obtained in the
+    background thread (stale-while-revalidate approach). Only the very first request for the given command blocks.
+
+    The failed request is remembered as well (negative caching): for the next failure_ttl seconds the PlatformIO isn't
+    queried again for this executable and the callers are told the answer is unknown instead (see contains()).
+
+    Boards are also indexed in memory as sets so contains() is O(1).
+    """
+
+    def __init__(self, path: pathlib.Path = None, ttl: float = None, failure_ttl: float = None):
+        """
+        Args:
+            path: JSON file to store the cache in (see user_cache_dir() for the default location)
+            ttl: seconds for the entry to be considered fresh (see settings.py for the default value)
+            failure_ttl: seconds to not repeat the failed request for (see settings.py for the default value)
+        """
+        self.path = path if path is not None else \
+            user_cache_dir().joinpath(stm32pio.settings.platformio_boards_cache_file_name)
+        self.ttl = ttl if ttl is not None else stm32pio.settings.platformio_boards_cache_ttl
+        self.failure_ttl = failure_ttl if failure_ttl is not None else \
+            stm32pio.settings.platformio_boards_cache_failure_ttl
+
+        self._entries = {}  # key: { 'timestamp': float, 'boards': list, 'index': set }
+        self._failures = {}  # key: { 'timestamp': float, 'error': str }
+        self._refreshing = set()  # keys that are currently being updated in the background
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(platformio_cmd: str) -> str:
+        return executable_identity(platformio_cmd)
+
+    def _load(self) -> dict:
+        try:
+            return json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, key: str, record: dict) -> None:
+        """Put the record on disk (should be called under the lock)"""
+        try:
+            stored = self._load()
+            stored[key] = record
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Write to the temp file first and then replace the original one so the concurrent readers (e.g. the
+            # other stm32pio processes) never see the partially written file
+            import tempfile
+            with tempfile.NamedTemporaryFile(mode='w', dir=self.path.parent, delete=False) as temp_file:
+                json.dump(stored, temp_file)
+            os.replace(temp_file.name, self.path)
+        except OSError as e:
+            module_logger.debug(f"cannot save PlatformIO boards cache: {e}")
+
+    def _fetch(self, platformio_cmd: str, key: str) -> dict:
+        """Query the PlatformIO and save the result (either the boards or the failure) both in memory and on disk"""
+        try:
+            boards = query_platformio_boards(platformio_cmd)
+        except Exception as e:
+            failure = { 'timestamp': time.time(), 'error': str(e) }
+            with self._lock:
+                if key not in self._entries:  # the stale list (if any) is still better than nothing
+                    self._failures[key] = failure
+                    self._save(key, failure)
+            raise
+        entry = { 'timestamp': time.time(), 'boards': boards, 'index': set(boards) }
+        with self._lock:
+            self._entries[key] = entry
+            self._failures.pop(key, None)
+            self._save(key, { 'timestamp': entry['timestamp'], 'boards': boards })
+        return entry
+
+    def _refresh(self, platformio_cmd: str, key: str) -> None:
+        """Routine of the background updating thread"""
+        try:
+            self._fetch(platformio_cmd, key)
+        except Exception as e:
+            module_logger.debug(f"cannot refresh PlatformIO boards cache: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _get_entry(self, platformio_cmd: str) -> Optional[dict]:
+        """Returns None if the last request has failed recently (the failure has already been reported then)"""
+        key = self._key(platformio_cmd)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            failure = self._failures.get(key)
+            if entry is None and failure is None:
+                stored = self._load().get(key)
+                if stored is not None and 'boards' in stored:
+                    entry = { 'timestamp': stored['timestamp'], 'boards': stored['boards'],
+                              'index': set(stored['boards']) }
+                    self._entries[key] = entry
+                elif stored is not None:
+                    failure = self._failures[key] = stored
+
+        if entry is None:
+            if failure is not None and time.time() - failure['timestamp'] < self.failure_ttl:
+                module_logger.debug(f"PlatformIO boards request has failed recently, not repeating it: "
+                                    f"{failure['error']}")
+                return None
+            return self._fetch(platformio_cmd, key)  # nothing to show so we have to wait
+
+        if time.time() - entry['timestamp'] > self.ttl:
+            with self._lock:
+                if key not in self._refreshing:
+                    self._refreshing.add(key)
+                    threading.Thread(target=self._refresh, args=(platformio_cmd, key), daemon=True).start()
+        return entry
+
+    def get(self, platformio_cmd: str) -> List[str]:
+        """Boards list (a copy) for the given PlatformIO command"""
+        entry = self._get_entry(platformio_cmd)
+        if entry is None:
+            raise Exception(f"PlatformIO boards request has failed recently: "
+                            f"{self._failures[self._key(platformio_cmd)]['error']}")
+        return list(entry['boards'])
+
+    def contains(self, platformio_cmd: str, board: str) -> Optional[bool]:
+        """
+        Check whether the board is known to the PlatformIO
+
+        Returns:
+            None if it is unknown as the PlatformIO request has failed recently (the first failure is raised)
+        """
+        entry = self._get_entry(platformio_cmd)
+        return board in entry['index'] if entry is not None else None
+
+
+platformio_boards_cache = PlatformIOBoardsCache()  # shared default instance (doesn't touch the disk until used)
+
+
+def get_platformio_boards(platformio_cmd: str, use_cache: bool = True) -> List[str]:
+    """
+    Obtain the PlatformIO boards list (STM32 ones only). By default, the persistent cache is used (see
+    PlatformIOBoardsCache) so the PlatformIO is only invoked when there is no cached list yet
+    """
+    if use_cache:
+        return platformio_boards_cache.get(platformio_cmd)
+    else:
+        return query_platformio_boards(platformio_cmd)
+
+
+class ToolVersionsCache:
+    """
+    Persistent (on-disk, in the user cache folder) cache of the tools versions. Asking the tool (e.g. 'platformio
+    --version' or 'java -version') is relatively slow so it is done once per the executable identity (see
+    executable_identity()): the entry stays valid until the tool is upgraded
+    """
+
+    def __init__(self, path: pathlib.Path = None):
+        """
+        Args:
+            path: JSON file to store the cache in (see user_cache_dir() for the default location)
+        """
+        self.path = path if path is not None else \
+            user_cache_dir().joinpath(stm32pio.settings.tool_versions_cache_file_name)
+        self._entries = None  # loaded lazily
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def query(command: str, version_args: List[str]) -> str:
+        """Ask the tool about its version, the first line of its output is returned ('unknown' on errors)"""
+        import subprocess
+        try:
+            result = subprocess.run([command] + version_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    encoding='utf-8', errors='replace', timeout=60)
+        except (OSError, subprocess.SubprocessError):
+            return 'unknown'
+        lines = [line.strip() for line in result.stdout.splitlines() if line.strip()]
+        return lines[0] if result.returncode == 0 and len(lines) else 'unknown'
+
+    def get(self, command: str, version_args: List[str]) -> str:
+        key = f"{executable_identity(command)}|{' '.join(version_args)}"
+        with self._lock:
+            if self._entries is None:
+                try:
+                    self._entries = json.loads(self.path.read_text())
+                except (OSError, ValueError):
+                    self._entries = {}
+            if key in self._entries:
+                return self._entries[key]
+
+        version = self.query(command, version_args)
+        with self._lock:
+            self._entries[key] = version
+            if version != 'unknown':  # let it try again in the next session
+                try:
+                    self.path.parent.mkdir(parents=True, exist_ok=True)
+                    import tempfile
+                    with tempfile.NamedTemporaryFile(mode='w', dir=self.path.parent, delete=False) as temp_file:
+                        json.dump({ key: value for key, value in self._entries.items() if value != 'unknown' },
+                                  temp_file)
+                    os.replace(temp_file.name, self.path)
+                except OSError as e:
+                    module_logger.debug(f"cannot save tool versions cache: {e}")
+        return version
+
+
+tool_versions_cache = ToolVersionsCache()  # shared default instance (doesn't touch the disk until used)
+
+
+class TrashCollector:
+    """
+    Deletes the content of the trash folders (see Stm32pio.clean()) in the background. Every collect() call takes all
+    the entries of the folder which are not being deleted yet and hands them to the daemon threads, so the caller
+    returns immediately. Daemon threads don't hold the process on exit: the unfinished entries just stay in the trash
+    and are picked up by the next collect() call (of this or another process). Big folders are split into a number of
+    subtrees deleted in parallel
+    """
+
+    def __init__(self, jobs: int = stm32pio.settings.trash_removal_jobs):
+        """
+        Args:
+            jobs: number of the deleting threads per collect() call
+        """
+        self.jobs = jobs
+        self._lock = threading.Lock()
+        self._claimed = set()  # entries being deleted right now
+        self._threads: MutableMapping[pathlib.Path, List[threading.Thread]] = {}  # trash folder: collecting threads
+
+    @contextlib.contextmanager
+    def portion(self, trash_dir: pathlib.Path):
+        """
+        New (empty) subfolder of the trash folder to move the doomed entries into, yields its path. It is not touched by
+        the collection until the block is exited and then the collection is started
+        """
+        import tempfile
+        with self._lock:  # so the trash folder is not removed right between the creation of it and of the subfolder
+            trash_dir.mkdir(exist_ok=True)
+            path = pathlib.Path(tempfile.mkdtemp(prefix='clean-', dir=trash_dir))
+            self._claimed.add(path)
+        try:
+            yield path
+        finally:
+            with self._lock:
+                self._claimed.discard(path)
+            self.collect(trash_dir)
+
+    def collect(self, trash_dir: pathlib.Path) -> None:
+        """Start the deletion of everything in the trash folder (no-op if there is no such folder)"""
+        with self._lock:
+            try:
+                entries = [entry for entry in trash_dir.iterdir() if entry not in self._claimed]
+            except OSError:  # usually, there is simply no trash
+                return
+            if len(entries) == 0:
+                self._remove_empty(trash_dir)
+                return
+            self._claimed.update(entries)
+            thread = threading.Thread(target=self._remove, args=(trash_dir, entries), daemon=True,
+                                      name=f'TrashCollector-{trash_dir}')
+            threads = [thread for thread in self._threads.get(trash_dir, []) if thread.is_alive()]
+            self._threads[trash_dir] = threads + [thread]
+            thread.start()
+
+    def wait(self, trash_dir: pathlib.Path) -> None:
+        """Block until all the current deletions of the folder content are finished"""
+        with self._lock:
+            threads = list(self._threads.get(trash_dir, []))
+        for thread in threads:
+            thread.join()
+
+    def _split(self, entries: List[pathlib.Path], levels: int = 3) -> List[pathlib.Path]:
+        """
+        Replace the folders by their content a few levels deep so the parallel threads have something to share (e.g.
+        '.pio' folder is usually the only big one and would be deleted by the single thread otherwise)
+        """
+        units = entries
+        for _ in range(levels):
+            expanded = []
+            for unit in units:
+                if unit.is_dir() and not unit.is_symlink():
+                    try:
+                        expanded.extend(list(unit.iterdir()))
+                        continue
+                    except OSError:
+                        pass
+                expanded.append(unit)
+            units = expanded
+        return units
+
+    def _remove_empty(self, trash_dir: pathlib.Path) -> None:
+        """Remove the trash folder itself if nothing is left (should be called under the lock)"""
+        if not any(entry.parent == trash_dir for entry in self._claimed):
+            with contextlib.suppress(OSError):  # not empty (e.g. a new portion has arrived), will be removed later
+                trash_dir.rmdir()
+
+    def _remove(self, trash_dir: pathlib.Path, entries: List[pathlib.Path]) -> None:
+        import shutil
+        units = queue.Queue()
+        for unit in self._split(entries):
+            units.put(unit)
+
+        def worker():
+            while True:
+                try:
+                    unit = units.get_nowait()
+                except queue.Empty:
+                    return
+                if unit.is_dir() and not unit.is_symlink():
+                    shutil.rmtree(unit, ignore_errors=True)
+                else:
+                    with contextlib.suppress(OSError):
+                        unit.unlink()
+
+        workers = [threading.Thread(target=worker, daemon=True) for _ in range(self.jobs)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        for entry in entries:  # the emptied folders skeleton
+            shutil.rmtree(entry, ignore_errors=True)
+        with self._lock:
+            self._claimed.difference_update(entries)
+            self._remove_empty(trash_dir)
+        module_logger.debug(f"trash has been collected: {trash_dir}")
+
+
+trash_collector = TrashCollector()  # shared default instance
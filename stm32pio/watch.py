@@ -0,0 +1,338 @@
+"""
+Watch mode: regenerate the code and rebuild the project automatically when its files are changed (see ProjectWatcher)
+"""
+
+import asyncio
+import contextlib
+import ctypes
+import ctypes.util
+import functools
+import logging
+import os
+import pathlib
+import platform
+import struct
+from typing import Dict, List, Optional, Set
+
+import stm32pio.aio
+import stm32pio.lib
+import stm32pio.settings
+import stm32pio.util
+
+
+class PollingWatcher:
+    """
+    Fallback file system watcher comparing the modification times and sizes of the watched entries on every call. Works
+    everywhere but costs a walk over the trees per poll
+    """
+
+    fileno = None  # nothing to wait on, poll with some interval instead
+
+    def __init__(self, files: List[pathlib.Path], trees: List[pathlib.Path]):
+        """
+        Args:
+            files: separate files to watch (they may not exist yet)
+            trees: folders to watch recursively (they may not exist yet)
+        """
+        self.files = files
+        self.trees = trees
+        self.snapshot = self._take_snapshot()
+
+    def _take_snapshot(self) -> Dict[pathlib.Path, tuple]:
+        snapshot = {}
+        for file in self.files:
+            with contextlib.suppress(OSError):
+                stat = os.stat(file)
+                snapshot[file] = (stat.st_mtime_ns, stat.st_size)
+        for tree in self.trees:
+            for dir_path, dir_names, file_names in os.walk(tree):
+                for name in dir_names + file_names:
+                    path = pathlib.Path(dir_path).joinpath(name)
+                    with contextlib.suppress(OSError):
+                        stat = os.stat(path)
+                        snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def read_changes(self) -> Set[pathlib.Path]:
+        """Paths changed (created, modified, deleted) since the previous call"""
+        snapshot = self._take_snapshot()
+        changes = {path for path in snapshot.keys() | self.snapshot.keys()
+                   if snapshot.get(path) != self.snapshot.get(path)}
+        self.snapshot = snapshot
+        return changes
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher:
+    """
+    Linux inotify-based file system watcher (libc is used via ctypes so no additional dependencies are required). The
+    events are accumulated by the kernel so read_changes() is cheap and non-blocking, use 'fileno' to wait for them
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    _event_header = struct.Struct('iIII')  # wd, mask, cookie, len (followed by the name of 'len' bytes)
+
+    def __init__(self, files: List[pathlib.Path], trees: List[pathlib.Path]):
+        """
+        Args:
+            files: separate files to watch (their parent folders are actually watched so the files may not exist yet)
+            trees: folders to watch recursively (they may not exist yet)
+        """
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fileno = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fileno == -1:
+            raise OSError(ctypes.get_errno(), "inotify_init1 has failed")
+
+        self.trees = trees
+        self.watches: Dict[int, pathlib.Path] = {}  # watch descriptor: folder
+        # Folders containing the watched files and trees: names of interest
+        self.parents: Dict[pathlib.Path, Set[str]] = {}
+        for path in files + trees:
+            self.parents.setdefault(path.parent, set()).add(path.name)
+        for parent in self.parents:
+            self._add_watch(parent)
+        for tree in trees:
+            self._add_tree(tree)
+
+    def _add_watch(self, path: pathlib.Path) -> None:
+        wd = self.libc.inotify_add_watch(self.fileno, os.fsencode(path), self.MASK)
+        if wd != -1:
+            self.watches[wd] = path
+        # else: the folder has gone already, there will be an event about it anyway
+
+    def _add_tree(self, tree: pathlib.Path) -> None:
+        for dir_path, _, _ in os.walk(tree):
+            self._add_watch(pathlib.Path(dir_path))
+
+    def _in_trees(self, path: pathlib.Path) -> bool:
+        return any(path == tree or tree in path.parents for tree in self.trees)
+
+    def read_changes(self) -> Set[pathlib.Path]:
+        """Paths changed (created, modified, deleted) since the previous call"""
+        changes = set()
+        while True:
+            try:
+                data = os.read(self.fileno, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self._event_header.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + self._event_header.size:
+                                        offset + self._event_header.size + length].rstrip(b'\0'))
+                offset += self._event_header.size + length
+
+                if mask & self.IN_Q_OVERFLOW:  # some events were lost, consider everything as changed
+                    changes.update(self.trees)
+                    changes.update(parent.joinpath(name) for parent, names in self.parents.items() for name in names)
+                    continue
+                if mask & self.IN_IGNORED:  # the watched folder has been removed
+                    self.watches.pop(wd, None)
+                    continue
+                folder = self.watches.get(wd)
+                if folder is None or not name:
+                    continue
+
+                path = folder.joinpath(name)
+                if name in self.parents.get(folder, ()) or self._in_trees(path):
+                    changes.add(path)
+                    if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO) and self._in_trees(path):
+                        self._add_tree(path)  # new sub-folder (or the tree itself has appeared)
+        return changes
+
+    def close(self) -> None:
+        if self.fileno is not None:
+            os.close(self.fileno)
+            self.fileno = None
+
+
+def create_watcher(files: List[pathlib.Path], trees: List[pathlib.Path], polling: bool = False,
+                   logger: logging.Logger = None):
+    """Get the most efficient watcher available on this platform (InotifyWatcher or PollingWatcher)"""
+    if not polling and platform.system() == 'Linux':
+        try:
+            return InotifyWatcher(files, trees)
+        except Exception as e:
+            if logger is not None:
+                logger.debug(f"inotify is not available ({e}), fall back to polling")
+    return PollingWatcher(files, trees)
+
+
+class ProjectWatcher:
+    """
+    Monitor the .ioc file (and 'Inc', 'Src' trees, if the build is requested) of the project and run the stale stages
+    of the pipeline (see Stm32pio.plan()) on changes. Bursts of events (e.g. the CubeMX saving a file in several steps,
+    or an editor saving many files) are debounced into the single run. The in-flight run is cancelled when a newer
+    change arrives (so the running build is not wasting the time on the outdated sources anymore).
+
+    The code generated by ourselves doesn't trigger the new runs. The sources changes coming during the generation can't
+    be told apart from the generated ones, though, so they are put aside and the plan is checked once again after the
+    run (e.g. the user has edited a file after the build has been fingerprinted).
+    """
+
+    def __init__(self, project: stm32pio.lib.Stm32pio, with_build: bool = False,
+                 debounce: float = stm32pio.settings.watch_debounce,
+                 poll_interval: float = stm32pio.settings.watch_poll_interval, polling: bool = False):
+        """
+        Args:
+            project: project to watch
+            with_build: build the project after the generation and rebuild it on the 'Inc', 'Src' changes
+            debounce: seconds of the silence after the last event to wait before starting the run
+            poll_interval: seconds between the polls (when inotify is not available or polling is forced)
+            polling: force the polling
+        """
+
+        self.project = stm32pio.aio.AsyncStm32pio(project)
+        self.logger = project.logger
+        self.with_build = with_build
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+
+        self.trees = [project.path.joinpath('Inc'), project.path.joinpath('Src')] if with_build else []
+        self.watcher = create_watcher([project.ioc_file], self.trees, polling=polling, logger=self.logger)
+        self.generating = False  # the code generated by ourselves should be ignored
+        self.pending: Set[pathlib.Path] = set()  # changes that came at the moment we were ignoring others
+        self.deferred: Set[pathlib.Path] = set()  # sources changes during the generation, see _recheck()
+        self.wakeup: Optional[asyncio.Future] = None
+        self.runs = 0  # number of the completed (successfully or not) runs
+
+    def _filter(self, changes: Set[pathlib.Path]) -> Set[pathlib.Path]:
+        if self.generating:
+            in_trees = {path for path in changes if any(path == tree or tree in path.parents for tree in self.trees)}
+            self.deferred |= in_trees
+            return changes - in_trees
+        return changes
+
+    async def _recheck(self) -> None:
+        """Turn the changes put aside during the generation into the new run if the project is still not up-to-date"""
+        deferred, self.deferred = self.deferred, set()
+        if not deferred:
+            return
+        plan = await stm32pio.aio.get_running_loop().run_in_executor(
+            None, functools.partial(self.project.plan, with_build=self.with_build))
+        if any(step.run for step in plan):
+            self.logger.info("sources have been changed during the code generation")
+            self.pending |= deferred
+            self._wake_up()
+
+    def _wake_up(self) -> None:
+        if self.wakeup is not None and not self.wakeup.done():
+            self.wakeup.set_result(None)
+
+    async def _wait(self) -> None:
+        """Wait for the watcher events (or the next poll) or for the explicit wake-up"""
+        loop = stm32pio.aio.get_running_loop()
+        self.wakeup = loop.create_future()
+        if self.watcher.fileno is not None:
+            loop.add_reader(self.watcher.fileno, self._wake_up)
+        try:
+            await asyncio.wait_for(self.wakeup, timeout=None if self.watcher.fileno is not None else self.poll_interval)
+        except asyncio.TimeoutError:
+            pass  # time to poll
+        finally:
+            if self.watcher.fileno is not None:
+                loop.remove_reader(self.watcher.fileno)
+            self.wakeup = None
+
+    async def _next_changes(self) -> Set[pathlib.Path]:
+        """Wait for the changes of interest"""
+        while True:
+            if self.pending:
+                changes, self.pending = self.pending, set()
+                return changes
+            await self._wait()
+            changes = self._filter(self.watcher.read_changes())
+            if changes:
+                return changes
+
+    async def _debounced_changes(self) -> Set[pathlib.Path]:
+        """Wait for the changes and collect all of them until there is a quiet period"""
+        changes = await self._next_changes()
+        while True:
+            try:
+                changes |= await asyncio.wait_for(self._next_changes(), timeout=self.debounce)
+            except asyncio.TimeoutError:
+                return changes
+
+    async def _generate_code(self) -> int:
+        self.generating = True
+        try:
+            return await self.project.generate_code()
+        finally:
+            # Drop the events caused by the generation, keep the others (e.g. the .ioc file has been saved again)
+            self.pending |= self._filter(self.watcher.read_changes())
+            self.generating = False
+            if self.pending:
+                self._wake_up()
+
+    async def _run(self) -> None:
+        try:
+            await self.project.run_pipeline(with_build=self.with_build,
+                                            actions={ 'generate_code': self._generate_code })
+            await self._recheck()
+            self.logger.info("the project is up-to-date, waiting for the changes...")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Failed run doesn't re-check the deferred changes (it would most likely fail the same way again). The plan
+            # is based on the project state, not on the events, so the next run will catch these changes up anyway
+            stm32pio.util.log_current_exception(self.logger)
+            self.logger.info("waiting for the changes...")
+        finally:
+            self.deferred.clear()
+            self.runs += 1
+
+    async def watch(self, initial_run: bool = True) -> None:
+        """
+        Main coroutine, runs until cancelled
+
+        Args:
+            initial_run: bring the project up-to-date right away (otherwise wait for the first change)
+        """
+
+        run: Optional[asyncio.Future] = asyncio.ensure_future(self._run()) if initial_run else None
+        if not initial_run:
+            self.logger.info("waiting for the changes...")
+        try:
+            while True:
+                changes = await self._debounced_changes()
+                self.logger.info(f"changes detected: {', '.join(sorted(str(path) for path in changes)[:5])}"
+                                 f"{' and more' if len(changes) > 5 else ''}")
+                if run is not None and not run.done():
+                    self.logger.info("cancelling the outdated run...")
+                    run.cancel()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await run
+                run = asyncio.ensure_future(self._run())
+        finally:
+            if run is not None and not run.done():
+                run.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await run
+            self.watcher.close()
+
+
+def watch(project: stm32pio.lib.Stm32pio, with_build: bool = False, polling: bool = False) -> None:
+    """Blocking version of the ProjectWatcher.watch(), runs until interrupted (e.g. by Ctrl+C)"""
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(ProjectWatcher(project, with_build=with_build, polling=polling).watch())
+    try:
+        loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            loop.run_until_complete(task)
+    finally:
+        loop.close()
@@ -4,19 +4,21 @@
 import argparse
 import collections
 import inspect
+import itertools
 import logging
+import os
 import pathlib
 import platform
 import sys
 import threading
 import time
 import weakref
-from typing import List, Callable, Optional, Any, Mapping, MutableMapping, Iterator
+from typing import List, Callable, Optional, Any, Mapping, MutableMapping, Set, Tuple
 
 try:
     from PySide2.QtCore import QUrl, Property, QAbstractListModel, QModelIndex, QObject, Qt, Slot, Signal, QThread,\
         qInstallMessageHandler, QtInfoMsg, QtWarningMsg, QtCriticalMsg, QtFatalMsg, QThreadPool, QRunnable,\
-        QStringListModel, QSettings
+        QStringListModel, QSettings, QFileSystemWatcher
     if platform.system() == 'Linux':
         # Most UNIX systems does not provide QtDialogs implementation so the program should be 'linked' against
         # the QApplication...
@@ -49,13 +51,45 @@ except ModuleNotFoundError:
 ProjectID = int
 
 
+class LogRecordsBuffer:
+    """
+    collections.deque of the log records combined with the threading.Condition to wake up the consumer (LoggingWorker)
+    as soon as something has arrived (so it doesn't need to poll the buffer)
+    """
+
+    def __init__(self):
+        self.records = collections.deque()
+        self.condition = threading.Condition()
+
+    def append(self, record: logging.LogRecord) -> None:
+        with self.condition:
+            self.records.append(record)
+            self.condition.notify()
+
+    def __len__(self):
+        return len(self.records)
+
+
+class NotifyingEvent(threading.Event):
+    """threading.Event also notifying the given condition on set() so the waiter of that condition can react on it"""
+
+    def __init__(self, condition: threading.Condition):
+        super().__init__()
+        self.condition = condition
+
+    def set(self) -> None:
+        super().set()
+        with self.condition:
+            self.condition.notify_all()
+
+
 class BuffersDispatchingHandler(logging.Handler):
     """
-    Every user's project using its own buffer (collections.deque) to store logs. This simple logging.Handler subclass
+    Every user's project using its own buffer (LogRecordsBuffer) to store logs. This simple logging.Handler subclass
     finds and puts an incoming record into the corresponding buffer
     """
 
-    buffers: MutableMapping[ProjectID, collections.deque] = {}  # the dictionary of projects' ids and theirs buffers
+    buffers: MutableMapping[ProjectID, LogRecordsBuffer] = {}  # the dictionary of projects' ids and theirs buffers
 
     def emit(self, record: logging.LogRecord) -> None:
         if hasattr(record, 'project_id'):
@@ -80,37 +114,61 @@ class LoggingWorker(QObject):
     conveniently received by any Qt entity. Also, the level of the message is attaching so the reader can
     interpret them differently.
 
+    The worker sleeps until the new records arrive. Then it takes everything available and sends it as a single chunk
+    (limited by the number of records and by the time spent on the formatting) so the sparse messages are delivered
+    immediately while the floods (e.g. verbose build) don't overwhelm the GUI thread with the separate signals.
+
     Can be controlled by two threading.Event's:
         stopped - on activation, leads to thread termination
         can_flush_log - use this to temporarily save the logs in an internal buffer while waiting for some event to
             occurs (for example GUI widgets to load), and then flush them when the time has come
     """
 
-    sendLog = Signal(str, int)
+    sendLogBatch = Signal('QVariantList')  # [[message, level], ...]
+
+    BATCH_MAX_RECORDS = 500  # maximum number of the records in a single chunk
+    BATCH_MAX_TIME = 0.1  # seconds, send the chunk if its formatting takes longer than this
 
     def __init__(self, project_id: ProjectID, parent: QObject = None):
         super().__init__(parent=parent)
 
         self.project_id = project_id
-        self.buffer = collections.deque()
+        self.buffer = LogRecordsBuffer()
         projects_logger_handler.buffers[project_id] = self.buffer  # register our buffer
 
-        self.stopped = threading.Event()
-        self.can_flush_log = threading.Event()
+        # Setting these wakes the worker up
+        self.stopped = NotifyingEvent(self.buffer.condition)
+        self.can_flush_log = NotifyingEvent(self.buffer.condition)
 
         self.thread = QThread()
         self.moveToThread(self.thread)
         self.thread.started.connect(self.routine)
         self.thread.start()
 
+    def _take_batch(self) -> List[list]:
+        """Pop and format the available records respecting the chunk limits"""
+        batch = []
+        start = time.monotonic()
+        while len(batch) < self.BATCH_MAX_RECORDS and time.monotonic() - start < self.BATCH_MAX_TIME:
+            try:
+                record = self.buffer.records.popleft()
+            except IndexError:
+                break
+            batch.append([projects_logger_handler.format(record), record.levelno])
+        return batch
+
     def routine(self) -> None:
         """
-        The worker constantly querying the buffer on the new log messages availability
+        The worker waits for the new log messages and sends them in chunks
         """
-        while not self.stopped.wait(timeout=0.050):
-            if self.can_flush_log.is_set() and len(self.buffer):
-                record = self.buffer.popleft()
-                self.sendLog.emit(projects_logger_handler.format(record), record.levelno)
+        condition = self.buffer.condition
+        while True:
+            with condition:
+                condition.wait_for(lambda: self.stopped.is_set() or
+                                           (self.can_flush_log.is_set() and len(self.buffer) > 0))
+                if self.stopped.is_set():
+                    break
+            self.sendLogBatch.emit(self._take_batch())  # format and send outside of the lock so loggers don't wait
         # TODO: maybe we should flush all remaining logs before termination
         projects_logger_handler.buffers.pop(self.project_id)  # unregister our buffer
         module_logger.debug(f"exit LoggingWorker of project id {self.project_id}")
@@ -123,14 +181,15 @@ class ProjectListItem(QObject):
     The core functionality class - the wrapper around the Stm32pio class suitable for the project GUI representation
     """
 
-    logAdded = Signal(str, int, arguments=['message', 'level'])  # send the log message to the front-end
+    logsAdded = Signal('QVariantList', arguments=['records'])  # send the chunk of [message, level] to the front-end
 
     actionStarted = Signal(str, arguments=['action'])
     actionFinished = Signal(str, bool, arguments=['action', 'success'])
 
 
     def __init__(self, project_args: List[any] = None, project_kwargs: Mapping[str, Any] = None,
-                 from_startup: bool = False, parent: QObject = None):
+                 from_startup: bool = False, on_initialized: Callable[['ProjectListItem'], None] = None,
+                 parent: QObject = None):
         """
         Instance construction is split into 2 phases: the wrapper setup and inner Stm32pio class initialization. The
         latter one is taken out to the separated thread as it is, potentially, a time-consuming operation. This thread
@@ -142,6 +201,8 @@ class ProjectListItem(QObject):
             project_kwargs: dictionary of keyword arguments that will be passed to the Stm32pio constructor
             from_startup: mark that this project comes from the beginning of the app life (e.g. from the NV-storage) so
                 it can be treated differently on the GUI side
+            on_initialized: function to call (from the initialization thread) when the Stm32pio part has been
+                initialized, whether successful or not
             parent: Qt parent
         """
 
@@ -153,16 +214,14 @@ class ProjectListItem(QObject):
             project_kwargs = {}
 
         self._from_startup = from_startup
+        self._on_initialized = on_initialized
 
         underlying_logger = logging.getLogger('stm32pio_gui.projects')
         self.logger = stm32pio.util.ProjectLoggerAdapter(underlying_logger, { 'project_id': id(self) })
         self.logging_worker = LoggingWorker(project_id=id(self))
-        self.logging_worker.sendLog.connect(self.logAdded)
+        self.logging_worker.sendLogBatch.connect(self.logsAdded)
 
-        # QThreadPool can automatically queue new incoming tasks if a number of them are larger than maxThreadCount
-        self.workers_pool = QThreadPool(parent=self)
-        self.workers_pool.setMaxThreadCount(1)
-        self.workers_pool.setExpiryTimeout(-1)  # tasks wait forever for the available spot
+        # Actions are queued and run by the shared ActionScheduler (one at a time for this project)
         self._current_action = ''
 
         # These values are valid only until the Stm32pio project initialize itself (or failed to) (see init_project)
@@ -171,7 +230,20 @@ class ProjectListItem(QObject):
         self._state = { 'LOADING': True }  # pseudo-stage (not present in the ProjectStage enum but is used from QML)
         self._current_stage = 'Loading...'
 
+        # After the initialization, the state is computed in background and the getters return the last snapshot (so
+        # QML never waits for the file system). See refresh_state()
+        self._state_update_lock = threading.Lock()  # serializes the computations
+        self._state_refresh_lock = threading.Lock()
+        self._state_refresh_pending = False
+        # Trigger the refresh on the project files changes. Populated after the initialization in the GUI thread
+        self._fs_watcher = QFileSystemWatcher(parent=self)
+        self._fs_watcher.directoryChanged.connect(self._fileSystemChanged)
+        self._fs_watcher.fileChanged.connect(self._fileSystemChanged)
+        self.projectInitialized.connect(self._watchProjectFiles)
+
         self.qml_ready = threading.Event()  # the front and the back both should know when each other is initialized
+        self.removed = False  # set (under the ProjectsIndex lock) when the item is removed from the list
+        self.initialized = threading.Event()  # set when init_project is finished, whether successful or not
 
         # Register some kind of the deconstruction handler (later, after the project initialization, see init_project)
         self._finalizer = None
@@ -180,6 +252,9 @@ class ProjectListItem(QObject):
             project_kwargs['instance_options'] = { 'logger': self.logger }
         elif 'logger' not in project_kwargs['instance_options']:
             project_kwargs['instance_options']['logger'] = self.logger
+        # All projects share a single CubeMX process if a user has opted in (it will be started on the first demand)
+        if settings.get('persistent_cubemx') and 'cubemx_worker' not in project_kwargs['instance_options']:
+            project_kwargs['instance_options']['cubemx_worker'] = cubemx_worker
 
         # Start the Stm32pio part initialization right after. It can take some time so we schedule it in a dedicated
         # thread
@@ -206,14 +281,20 @@ class ProjectListItem(QObject):
             self._state = { 'INIT_ERROR': True }  # pseudo-stage
             self._current_stage = 'Initializing error'
         else:
-            # Successful initialization. These values should not be used anymore but we "reset" them anyway
+            # Successful initialization. The name is not used anymore but we "reset" it anyway
             self._name = 'Project'
-            self._state = {}
-            self._current_stage = 'Initialized'
+            try:
+                self._update_state(notify=False)  # we are in the background already, the GUI is notified below
+            except Exception:
+                stm32pio.util.log_current_exception(self.logger)
+            self.projectInitialized.emit()
         finally:
             # Register some kind of the deconstruction handler
-            self._finalizer = weakref.finalize(self, self.at_exit, self.workers_pool, self.logging_worker,
+            self._finalizer = weakref.finalize(self, self.at_exit, id(self), self.logging_worker,
                                                self.name if self.project is None else str(self.project))
+            if self._on_initialized is not None:
+                self._on_initialized(self)
+            self.initialized.set()
             self.qml_ready.wait()  # wait for the GUI to initialize (which one is earlier, actually, back or front)
             self.nameChanged.emit()  # in any case we should notify the GUI part about the initialization ending
             self.stageChanged.emit()
@@ -221,14 +302,14 @@ class ProjectListItem(QObject):
 
 
     @staticmethod
-    def at_exit(workers_pool: QThreadPool, logging_worker: LoggingWorker, name: str):
+    def at_exit(project_id: ProjectID, logging_worker: LoggingWorker, name: str):
         """
         The instance deconstruction handler is meant to be used with weakref.finalize() conforming with the requirement
         to have no reference to the target object (so it doesn't contain any instance reference and also is decorated as
         'staticmethod')
         """
         # Wait forever for all the jobs to complete. Currently, we cannot abort them gracefully
-        workers_pool.waitForDone(msecs=-1)
+        action_scheduler.wait_idle(project_id)
         logging_worker.stopped.set()  # post the event in the logging worker to inform it...
         logging_worker.thread.wait()  # ...and wait for it to exit, too
         module_logger.info(f"destroyed {name} ProjectListItem")
@@ -257,33 +338,76 @@ class ProjectListItem(QObject):
         else:
             return self._name
 
-    stateChanged = Signal()
-    @Property('QVariant', notify=stateChanged)
-    def state(self) -> dict:
+    projectInitialized = Signal()  # internal, emitted from the initialization thread on success
+
+    def _update_state(self, notify: bool = True) -> None:
         """
-        Get the current project state in the appropriate Qt form. Update the cached 'current stage' value as a side
-        effect
+        Compute the state of the project and store it as a snapshot for the Qt properties. Notify the GUI only if
+        something has actually changed. Blocking, do not call it from the GUI thread (see refresh_state())
         """
-        if self.project is not None:
-            state = self.project.state
-
-            # Side-effect: caching the current stage at the same time to avoid the flooding of calls to the 'state'
-            # getter (many IO operations). Requests to 'state' and 'stage' are usually goes together so there is no need
-            # to necessarily keeps them separated
-            self._current_stage = str(state.current_stage)
+        with self._state_update_lock:
+            with self._state_refresh_lock:
+                self._state_refresh_pending = False  # the newer requests should be served by the next run
 
+            state = self.project.state
+            current_stage = str(state.current_stage)
             state.pop(stm32pio.lib.ProjectStage.UNDEFINED)  # exclude UNDEFINED key
             # Convert to {string: boolean} dict (will be translated into the JavaScript object)
-            return { stage.name: value for stage, value in state.items() }
-        else:
-            return self._state
+            snapshot = { stage.name: value for stage, value in state.items() }
+
+            state_changed = snapshot != self._state
+            stage_changed = current_stage != self._current_stage
+            self._state = snapshot
+            self._current_stage = current_stage
+
+        if notify and state_changed:
+            self.stateChanged.emit()
+        if notify and stage_changed:
+            self.stageChanged.emit()
+
+    def refresh_state(self) -> None:
+        """Schedule the state re-computation in background. Requests coming in a row are served by a single run"""
+        if self.project is None:
+            return
+        with self._state_refresh_lock:
+            if self._state_refresh_pending:
+                return
+            self._state_refresh_pending = True
+        # Failures are not paused on: the probe is cheap and is repeated anyway while the pool is shared with the actions
+        QThreadPool.globalInstance().start(Worker(self._update_state, logger=self.logger, pause_on_failure=False))
+
+    @Slot()
+    def _watchProjectFiles(self):
+        """Watch the entries the project state depends on (the folders are watched for the entries list changes)"""
+        if self.project is None:
+            return
+        candidates = [self.project.path, self.project.path.joinpath('Inc'), self.project.path.joinpath('Src'),
+                      self.project.path.joinpath('platformio.ini')]
+        watched = set(self._fs_watcher.directories() + self._fs_watcher.files())
+        paths = [str(path) for path in candidates if str(path) not in watched and path.exists()]
+        if len(paths):
+            self._fs_watcher.addPaths(paths)
+
+    @Slot(str)
+    def _fileSystemChanged(self, _: str):
+        self._watchProjectFiles()  # e.g. 'Inc' folder has been created or 'platformio.ini' has been re-created
+        self.refresh_state()
+
+    stateChanged = Signal()
+    @Property('QVariant', notify=stateChanged)
+    def state(self) -> dict:
+        """
+        Get the current project state in the appropriate Qt form. This is the cached snapshot, it is updated in
+        background on the actions completion and the file system changes (stateChanged is emitted then)
+        """
+        return self._state
 
     stageChanged = Signal()
     @Property(str, notify=stageChanged)
     def currentStage(self) -> str:
         """
         Get the current stage the project resides in.
-        Note: this returns a cached value. Cache updates every time the state property got requested
+        Note: this returns a cached value, see 'state'
         """
         return self._current_stage
 
@@ -295,6 +419,20 @@ class ProjectListItem(QObject):
         """
         return self._current_action
 
+    @Slot(str, result=float)
+    def expectedDuration(self, action: str) -> float:
+        """
+        Typical duration of the action (seconds) according to the history of the previous runs (see stm32pio.history)
+        or -1 if it is unknown (e.g. the action has never been performed yet)
+        """
+        if self.project is None:
+            return -1
+        try:
+            duration = self.project.history.expected_duration(action)
+        except Exception:
+            duration = None
+        return duration if duration is not None else -1
+
     @Slot(str)
     def actionStartedSlot(self, action: str):
         """Pass the corresponding signal from the worker, perform related tasks"""
@@ -307,14 +445,13 @@ class ProjectListItem(QObject):
     @Slot(str, bool)
     def actionFinishedSlot(self, action: str, success: bool):
         """Pass the corresponding signal from the worker, perform related tasks"""
-        if not success:
-            # Clear the queue - stop further execution (cancel planned tasks if an error had happened)
-            self.workers_pool.clear()
+        # Note: on failure, the scheduler has already dropped the rest of the project queue
         self.actionFinished.emit(action, success)
         # Currently, this property should be reset AFTER emitting the 'actionFinished' signal (because QML will query it
         # when the signal will be handled in StateMachine) (probably, should be resolved later as it is bad to be bound
         # to such a specific logic)
         self._current_action = ''
+        self.refresh_state()  # after the reset, so QML will process the possible change as usual
 
     @Slot()
     def qmlLoaded(self):
@@ -333,13 +470,11 @@ class ProjectListItem(QObject):
             args: list of positional arguments for this action
         """
 
-        worker = Worker(getattr(self.project, action), args, self.logger)
+        worker = Worker(getattr(self.project, action), args, self.logger, pause_on_failure=False)
         worker.started.connect(self.actionStartedSlot)
-        worker.finished.connect(self.actionFinishedSlot)
-        worker.finished.connect(self.stateChanged)
-        worker.finished.connect(self.stageChanged)
+        worker.finished.connect(self.actionFinishedSlot)  # the state is refreshed there
 
-        self.workers_pool.start(worker)  # will automatically place to the queue
+        action_scheduler.submit(id(self), worker)  # will automatically place to the queue
 
 
 
@@ -354,12 +489,13 @@ class Worker(QObject, QRunnable):
 
 
     def __init__(self, func: Callable[[List[Any]], Optional[int]], args: List[Any] = None,
-                 logger: logging.Logger = None, parent: QObject = None):
+                 logger: logging.Logger = None, pause_on_failure: bool = True, parent: QObject = None):
         """
         Args:
             func: function to run. It should return 0 or None for the call to be considered successful
             args: the list of positional arguments. They will be unpacked and passed to the function
             logger: optional logger to report about the occurred exception
+            pause_on_failure: hold the thread for a while after the failure (see run())
             parent: Qt object
         """
         QObject.__init__(self, parent=parent)
@@ -368,7 +504,9 @@ class Worker(QObject, QRunnable):
         self.func = func
         self.args = args if args is not None else []
         self.logger = logger
+        self.pause_on_failure = pause_on_failure
         self.name = func.__name__
+        self.success = None  # result, set after the run
 
 
     def run(self):
@@ -386,9 +524,10 @@ class Worker(QObject, QRunnable):
         else:
             success = False
 
+        self.success = success
         self.finished.emit(self.name, success)  # notify the caller
 
-        if not success:
+        if not success and self.pause_on_failure:
             # Pause the thread and, therefore, the parent QThreadPool queue so the caller can decide whether we should
             # proceed or stop. This should not cause any problems as we've already perform all necessary tasks and this
             # just delaying the QRunnable removal from the pool
@@ -397,6 +536,173 @@ class Worker(QObject, QRunnable):
 
 
 
+class ActionScheduler(QObject):
+    """
+    The single queue of the actions of all projects. Actions of the same project are performed one by one in the order
+    of their submission while different projects run in parallel. The heaviest actions (CubeMX code generation and
+    PlatformIO build) are additionally limited by the number of simultaneous jobs (see set_limits()). The project having
+    the focus in GUI (see 'focused') goes first, others are served in the order of their requests.
+
+    If some action fails, the rest of the queue of its project is dropped.
+    """
+
+    CATEGORIES = { 'generate_code': 'cubemx', 'build': 'build' }  # limited actions
+
+    def __init__(self, parent: QObject = None):
+        super().__init__(parent=parent)
+
+        # Concurrency is controlled by the scheduler itself so the pool is just a supplier of the threads
+        self.pool = QThreadPool(parent=self)
+        self.pool.setMaxThreadCount(64)
+        self.pool.setExpiryTimeout(-1)
+
+        self.limits = { 'cubemx': 1, 'build': 1 }
+        self.focused: Optional[ProjectID] = None
+
+        self._lock = threading.Condition()
+        self._sequence = itertools.count()  # submission order
+        self._queues: MutableMapping[ProjectID, collections.deque] = {}  # project: deque of (number, Worker)
+        self._running: MutableMapping[ProjectID, Worker] = {}
+        self._used = collections.Counter()  # category: number of the running jobs
+
+    def set_limits(self, cubemx: int = None, build: int = None) -> None:
+        with self._lock:
+            if cubemx is not None:
+                self.limits['cubemx'] = max(1, int(cubemx))
+            if build is not None:
+                self.limits['build'] = max(1, int(build))
+        self._dispatch()
+
+    def focus(self, project_id: Optional[ProjectID]) -> None:
+        """Prioritize the actions of the given project"""
+        with self._lock:
+            self.focused = project_id
+        self._dispatch()
+
+    def submit(self, project_id: ProjectID, worker: Worker) -> None:
+        with self._lock:
+            self._queues.setdefault(project_id, collections.deque()).append((next(self._sequence), worker))
+        self._dispatch()
+
+    def clear(self, project_id: ProjectID) -> None:
+        """Drop the queued (not running) actions of the project"""
+        with self._lock:
+            self._queues.pop(project_id, None)
+            self._lock.notify_all()
+
+    def wait_idle(self, project_id: ProjectID) -> None:
+        """Block until the project has nothing to run"""
+        with self._lock:
+            self._lock.wait_for(lambda: project_id not in self._running and not self._queues.get(project_id))
+
+    def _category(self, worker: Worker) -> Optional[str]:
+        return self.CATEGORIES.get(worker.name)
+
+    def _dispatch(self) -> None:
+        """Start everything that can be started at the moment"""
+        with self._lock:
+            while True:
+                candidates = []
+                for project_id, queue in self._queues.items():
+                    if len(queue) == 0 or project_id in self._running:
+                        continue
+                    number, worker = queue[0]
+                    category = self._category(worker)
+                    if category is not None and self._used[category] >= self.limits[category]:
+                        continue
+                    candidates.append(((project_id != self.focused, number), project_id))
+                if len(candidates) == 0:
+                    break
+
+                _, project_id = min(candidates)
+                _, worker = self._queues[project_id].popleft()
+                self._running[project_id] = worker
+                category = self._category(worker)
+                if category is not None:
+                    self._used[category] += 1
+                self.pool.start(_ScheduledJob(self, project_id, worker))
+
+    def _done(self, project_id: ProjectID, worker: Worker) -> None:
+        """Called from the job thread on its completion"""
+        with self._lock:
+            self._running.pop(project_id, None)
+            category = self._category(worker)
+            if category is not None:
+                self._used[category] -= 1
+            if not worker.success:
+                self._queues.pop(project_id, None)  # stop further execution (cancel planned tasks)
+            self._lock.notify_all()
+        self._dispatch()
+
+
+class _ScheduledJob(QRunnable):
+    """Run the worker and report to the scheduler afterwards"""
+
+    def __init__(self, scheduler: ActionScheduler, project_id: ProjectID, worker: Worker):
+        super().__init__()
+        self.scheduler = scheduler
+        self.project_id = project_id
+        self.worker = worker
+
+    def run(self):
+        try:
+            self.worker.run()
+        finally:
+            self.scheduler._done(self.project_id, self.worker)
+
+
+class ProjectsIndex:
+    """
+    Lookup table of the projects list items by their identities so the duplicates can be found in O(1). Every item is
+    registered under its (st_dev, st_ino) pair (robust to the links, case-insensitive file systems and so on) and under
+    its normalized path string (for the paths that don't exist). The paths are resolved the same way the Stm32pio does
+    (e.g. the .ioc file stands for its parent folder). Thread-safe
+    """
+
+    Key = Tuple
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items: MutableMapping[ProjectsIndex.Key, ProjectListItem] = {}
+        self._keys: MutableMapping[int, Set[ProjectsIndex.Key]] = {}  # id(item): all its keys (for the removal)
+
+    @staticmethod
+    def keys_of(path: str) -> Set[Key]:
+        try:
+            resolved = pathlib.Path(path).expanduser().resolve(strict=True)
+            if resolved.is_file() and resolved.suffix == '.ioc':
+                resolved = resolved.parent
+            stat = os.stat(resolved)
+            return { ('inode', stat.st_dev, stat.st_ino), ('path', os.path.normcase(str(resolved))) }
+        except OSError:
+            return { ('path', os.path.normcase(os.path.abspath(os.path.expanduser(path)))) }
+
+    def find(self, path: str) -> Optional[ProjectListItem]:
+        keys = self.keys_of(path)
+        with self._lock:
+            return next((self._items[key] for key in keys if key in self._items), None)
+
+    def add(self, item: ProjectListItem, path: str) -> None:
+        """
+        Register the item under the keys of the path (can be called several times for the same item). The removed items
+        are ignored (e.g. the initialization thread finishes after the item has been removed from the list)
+        """
+        keys = self.keys_of(path)
+        with self._lock:
+            if item.removed:
+                return
+            for key in keys:
+                self._items[key] = item
+            self._keys.setdefault(id(item), set()).update(keys)
+
+    def remove(self, item: ProjectListItem) -> None:
+        with self._lock:
+            item.removed = True
+            for key in self._keys.pop(id(item), set()):
+                if self._items.get(key) is item:
+                    del self._items[key]
+
+
 class ProjectsList(QAbstractListModel):
     """
     QAbstractListModel implementation - describe basic operations and delegate all main functionality to the
@@ -419,6 +725,12 @@ class ProjectsList(QAbstractListModel):
         self.workers_pool.setMaxThreadCount(1)  # only 1 active worker at a time
         self.workers_pool.setExpiryTimeout(-1)  # tasks wait forever for the available spot
 
+        self.index = ProjectsIndex()  # for the duplicates search
+
+        # Several save requests coming while the previous one is still queued are served by a single write
+        self._save_lock = threading.Lock()
+        self._save_pending = False
+
     @Slot(int, result=ProjectListItem)
     def get(self, index: int):
         """
@@ -428,6 +740,11 @@ class ProjectsList(QAbstractListModel):
         if index in range(len(self.projects)):
             return self.projects[index]
 
+    @Slot(int)
+    def focusProject(self, index: int):
+        """The project at the index has been selected in GUI so its actions should go first"""
+        action_scheduler.focus(id(self.projects[index]) if index in range(len(self.projects)) else None)
+
     def rowCount(self, parent=None, *args, **kwargs):
         return len(self.projects)
 
@@ -440,16 +757,24 @@ class ProjectsList(QAbstractListModel):
         Get correct projects and save them to Settings. Intended to be run in a thread
         """
 
-        # Wait for all projects to be loaded (project.init_project is finished), whether successful or not
-        while not all(project.name != 'Loading...' for project in self.projects):
-            pass
+        # Wait for all projects to be loaded (project.init_project is finished), whether successful or not. The list can
+        # be changed meanwhile, so repeat until there is no new ones
+        while True:
+            projects = list(self.projects)
+            for project in projects:
+                project.initialized.wait()
+            with self._save_lock:
+                if projects == self.projects:
+                    # From now on, new requests should be served by another write as the list is going to be captured
+                    self._save_pending = False
+                    break
 
         settings.beginGroup('app')
         settings.remove('projects')  # clear the current saved list
 
         settings.beginWriteArray('projects')
         # Only correct ones (inner Stm32pio instance has been successfully constructed)
-        projects_to_save = [project for project in self.projects if project.project is not None]
+        projects_to_save = [project for project in projects if project.project is not None]
         for idx, project in enumerate(projects_to_save):
             settings.setArrayIndex(idx)
             # This ensures that we always save paths in pathlib form
@@ -460,25 +785,18 @@ class ProjectsList(QAbstractListModel):
         module_logger.info(f"{len(projects_to_save)} projects have been saved to Settings")  # total amount
 
     def saveInSettings(self) -> None:
-        """Spawn a thread to wait for all projects and save them in background"""
+        """Spawn a thread to wait for all projects and save them in background (if there is no such one already)"""
+        with self._save_lock:
+            if self._save_pending:
+                return  # the queued save will capture the current list anyway
+            self._save_pending = True
         w = Worker(self._saveInSettings, logger=module_logger)
         self.workers_pool.start(w)
 
-    def each_project_is_duplicate_of(self, path: str) -> Iterator[bool]:
-        """
-        Returns generator yielding an answer to the question "Is current project is a duplicate of one represented by a
-        given path?" for every project in this model, one by one.
-
-        Logic explanation: At a given time some projects (e.g., when we add a bunch of projects, recently added ones)
-        can be not instantiated yet so we cannot extract their project.path property and need to check before comparing.
-        In this case, simply evaluate strings. Also, samefile will even raise, if the given path doesn't exist.
-        """
-        for list_item in self.projects:
-            try:
-                yield (list_item.project is not None and list_item.project.path.samefile(pathlib.Path(path))) or \
-                      path == list_item.name  # simply check strings if a path isn't available
-            except OSError:
-                yield False
+    def _reconcile(self, list_item: ProjectListItem) -> None:
+        """Register the resolved path of the just initialized project (it may differ from the given one)"""
+        if list_item.project is not None:  # the items removed while loading are ignored by the index itself
+            self.index.add(list_item, str(list_item.project.path))
 
     def addListItem(self, path: str, list_item_kwargs: Mapping[str, Any] = None, go_to_this: bool = False) -> None:
         """
@@ -496,9 +814,9 @@ class ProjectsList(QAbstractListModel):
         else:
             list_item_kwargs = {}
 
-        duplicate_index = next((idx for idx, is_duplicated in enumerate(self.each_project_is_duplicate_of(path))
-                                if is_duplicated), -1)
-        if duplicate_index > -1:
+        duplicate = self.index.find(path)
+        if duplicate is not None and not duplicate.removed:  # stale entries are not considered
+            duplicate_index = self.projects.index(duplicate)
             # Just added project is already in the list so abort the addition
             module_logger.warning(f"This project is already in the list: {path}")
 
@@ -524,7 +842,9 @@ class ProjectsList(QAbstractListModel):
 
         # The project is ready to be appended to the model right after the main constructor (wrapper) finished. The
         # underlying Stm32pio class will be initialized soon later in the dedicated thread
+        list_item_kwargs['on_initialized'] = self._reconcile
         project = ProjectListItem(**list_item_kwargs)
+        self.index.add(project, path)
         self.projects.append(project)
 
         self.endInsertRows()
@@ -567,6 +887,7 @@ class ProjectsList(QAbstractListModel):
         self.beginRemoveRows(QModelIndex(), index, index)
         project = self.projects.pop(index)
         self.endRemoveRows()
+        self.index.remove(project)
 
         if project.project is not None:
             # Re-save the settings only if this project was correct and therefore is saved in the settings
@@ -586,7 +907,10 @@ class Settings(QSettings):
     DEFAULTS = {
         'editor': '',
         'verbose': False,
-        'notifications': True
+        'notifications': True,
+        'persistent_cubemx': False,
+        'cubemx_jobs': 1,  # maximum number of simultaneous code generations across all projects
+        'build_jobs': 2  # maximum number of simultaneous PlatformIO builds across all projects
     }
 
     def __init__(self, prefix: str, defaults: Mapping[str, Any] = None, qs_args: List[Any] = None,
@@ -702,6 +1026,7 @@ def main(sys_argv: List[str] = None) -> int:
     app.setOrganizationName('ussserrr')
     app.setApplicationName('stm32pio')
     app.setWindowIcon(QIcon(str(MODULE_PATH.joinpath('icons/icon.svg'))))
+    app.aboutToQuit.connect(cubemx_worker.close)
 
     global settings
 
@@ -713,7 +1038,12 @@ def main(sys_argv: List[str] = None) -> int:
         formatter.verbosity = stm32pio.util.Verbosity.VERBOSE if value else stm32pio.util.Verbosity.NORMAL
 
     settings = Settings(prefix='app/settings/', qs_kwargs={ 'parent': app },
-                        external_triggers={ 'verbose': verbose_setter })
+                        external_triggers={
+                            'verbose': verbose_setter,
+                            'cubemx_jobs': lambda value: action_scheduler.set_limits(cubemx=value),
+                            'build_jobs': lambda value: action_scheduler.set_limits(build=value)
+                        })
+    action_scheduler.set_limits(cubemx=settings.get('cubemx_jobs'), build=settings.get('build_jobs'))
 
     # Use "singleton" real logger for all projects just wrapping it into the LoggingAdapter for every project
     projects_logger = logging.getLogger('stm32pio_gui.projects')
@@ -744,7 +1074,7 @@ def main(sys_argv: List[str] = None) -> int:
     qmlRegisterType(Settings, 'Settings', 1, 0, 'Settings')
 
     projects_model = ProjectsList(parent=engine)
-    boards_model = QStringListModel(parent=engine)
+    boards_model = QStringListModel(['None'], parent=engine)  # filled in background, see below
 
     engine.rootContext().setContextProperty('appVersion', stm32pio.app.__version__)
     engine.rootContext().setContextProperty('Logging', stm32pio.util.logging_levels)
@@ -757,42 +1087,49 @@ def main(sys_argv: List[str] = None) -> int:
     main_window = engine.rootObjects()[0]
 
 
-    # Getting PlatformIO boards can take a long time when the PlatformIO cache is outdated but it is important to have
-    # them before the projects list is restored, so we start a dedicated loading thread. We actually can add other
-    # start-up operations here if there will be a need to. Use the same Worker class to spawn the thread at the pool
-    def loading():
-        boards = ['None'] + stm32pio.util.get_platformio_boards('platformio')
-        boards_model.setStringList(boards)
-
-    def loaded(_: str, success: bool):
-        try:
-            # Qt objects cannot be parented from the different thread so we restore the projects list in the main thread
-            for path in restored_projects_paths:
-                projects_model.addListItem(path, go_to_this=False, list_item_kwargs={
-                   'from_startup': True,
-                   'parent': projects_model
-                })
-
-            # At the end, append (or jump to) a CLI-provided project, if there is one
-            if args is not None:
-                list_item_kwargs = {
-                    'from_startup': True,
-                    'parent': projects_model
-                }
-                if args.board:
-                    list_item_kwargs['project_kwargs'] = { 'parameters': { 'project': { 'board': args.board } } }  # pizdec konechno...
-                projects_model.addListItem(str(pathlib.Path(args.path)), go_to_this=True,
-                                           list_item_kwargs=list_item_kwargs)
-                projects_model.saveInSettings()
-        except Exception:
-            stm32pio.util.log_current_exception(module_logger)
-            success = False
-
-        main_window.backendLoaded.emit(success)  # inform the GUI
-
-    loader = Worker(loading, logger=module_logger)
-    loader.finished.connect(loaded)
-    QThreadPool.globalInstance().start(loader)
+    # Qt objects cannot be parented from the different thread so we restore the projects list right here, in the main
+    # thread. Projects are initialized in their own threads anyway so this doesn't block the window
+    success = True
+    try:
+        for path in restored_projects_paths:
+            projects_model.addListItem(path, go_to_this=False, list_item_kwargs={
+               'from_startup': True,
+               'parent': projects_model
+            })
+
+        # At the end, append (or jump to) a CLI-provided project, if there is one
+        if args is not None:
+            list_item_kwargs = {
+                'from_startup': True,
+                'parent': projects_model
+            }
+            if args.board:
+                list_item_kwargs['project_kwargs'] = { 'parameters': { 'project': { 'board': args.board } } }  # pizdec konechno...
+            projects_model.addListItem(str(pathlib.Path(args.path)), go_to_this=True,
+                                       list_item_kwargs=list_item_kwargs)
+            projects_model.saveInSettings()
+    except Exception:
+        stm32pio.util.log_current_exception(module_logger)
+        success = False
+
+    main_window.backendLoaded.emit(success)  # inform the GUI
+
+
+    # Getting PlatformIO boards can take a long time when the PlatformIO cache is outdated, so nothing waits for them:
+    # the list is obtained in background and the boards model (containing only 'None' at the moment) is filled as soon
+    # as it is ready. Use the same Worker class to spawn the thread at the pool
+    fetched_boards: List[str] = []
+
+    def fetch_boards():
+        fetched_boards.extend(stm32pio.util.get_platformio_boards('platformio'))
+
+    def boards_fetched(_: str, fetch_success: bool):
+        if fetch_success:
+            boards_model.setStringList(['None'] + fetched_boards)  # in the main thread, as the model belongs to it
+
+    boards_fetcher = Worker(fetch_boards, logger=module_logger)
+    boards_fetcher.finished.connect(boards_fetched)
+    QThreadPool.globalInstance().start(boards_fetcher)
 
     return app.exec_()
 
@@ -804,6 +1141,9 @@ module_logger = logging.getLogger(f'stm32pio_gui.{__name__}')  # use it as a con
 projects_logger_handler = BuffersDispatchingHandler()  # a storage of the buffers for the logging messages of all
                                                        # current projects (see its docs for more info)
 settings = QSettings()  # placeholder, will be replaced in main()
+action_scheduler = ActionScheduler()  # runs the actions of all projects (see its docs)
+cubemx_worker = stm32pio.lib.CubeMXWorker(  # the process is started lazily so it costs nothing until is used
+    stm32pio.settings.config_default['app']['java_cmd'], stm32pio.settings.config_default['app']['cubemx_cmd'])
 
 
 
@@ -97,6 +97,49 @@ ApplicationWindow {
                 text: "Get messages about completed project actions when the app is in the background"
             }
 
+            Label {
+                Layout.preferredWidth: 140
+                text: 'Persistent CubeMX'
+            }
+            CheckBox {
+                id: persistentCubemx
+                leftPadding: -3
+            }
+            Item { Layout.preferredWidth: 140 }  // spacer
+            Text {
+                Layout.preferredWidth: 250
+                wrapMode: Text.Wrap
+                color: 'dimgray'
+                text: "Keep a single CubeMX process running and reuse it for the code generation of all projects (applies to the newly added projects)"
+            }
+
+            Label {
+                Layout.preferredWidth: 140
+                text: 'CubeMX jobs'
+            }
+            SpinBox {
+                id: cubemxJobs
+                from: 1
+                to: 16
+            }
+
+            Label {
+                Layout.preferredWidth: 140
+                text: 'Build jobs'
+            }
+            SpinBox {
+                id: buildJobs
+                from: 1
+                to: 16
+            }
+            Item { Layout.preferredWidth: 140 }  // spacer
+            Text {
+                Layout.preferredWidth: 250
+                wrapMode: Text.Wrap
+                color: 'dimgray'
+                text: "Maximum number of the code generations and builds running at the same time across all projects"
+            }
+
             Text {
                 Layout.columnSpan: 2
                 Layout.maximumWidth: 250
@@ -112,11 +155,17 @@ ApplicationWindow {
                 editor.text = settings.get('editor');
                 verbose.checked = settings.get('verbose');
                 notifications.checked = settings.get('notifications');
+                persistentCubemx.checked = settings.get('persistent_cubemx');
+                cubemxJobs.value = parseInt(settings.get('cubemx_jobs'));
+                buildJobs.value = parseInt(settings.get('build_jobs'));
             }
         }
         onAccepted: {
             settings.set('editor', editor.text);
             settings.set('verbose', verbose.checked);
+            settings.set('persistent_cubemx', persistentCubemx.checked);
+            settings.set('cubemx_jobs', cubemxJobs.value);
+            settings.set('build_jobs', buildJobs.value);
             if (settings.get('notifications') !== notifications.checked) {
                 settings.set('notifications', notifications.checked);
                 sysTrayIcon.visible = notifications.checked;
@@ -476,7 +525,10 @@ ApplicationWindow {
 
             Connections {
                 target: projectsListView
-                onCurrentIndexChanged: projectsWorkspaceView.currentIndex = projectsListView.currentIndex
+                onCurrentIndexChanged: {
+                    projectsWorkspaceView.currentIndex = projectsListView.currentIndex;
+                    projectsModel.focusProject(projectsListView.currentIndex);  // its actions go first
+                }
             }
             Repeater {
                 // Use similar to ListView pattern (same projects model, Loader component)
@@ -544,9 +596,9 @@ ApplicationWindow {
                                 } else {
                                     const config = project.config;
                                     if (Object.keys(config['project']).length && !config['project']['board']) {
-                                        project.logAdded('WARNING  STM32 PlatformIO board is not specified, it will be needed on PlatformIO ' +
-                                                         'project creation. You can set it in "stm32pio.ini" file in the project directory',
-                                                         Logging.WARNING);
+                                        project.logsAdded([['WARNING  STM32 PlatformIO board is not specified, it will be needed on PlatformIO ' +
+                                                            'project creation. You can set it in "stm32pio.ini" file in the project directory',
+                                                            Logging.WARNING]]);
                                     }
                                     mainOrInitScreen.currentIndex = 1;  // show main view
                                 }
@@ -599,6 +651,16 @@ ApplicationWindow {
                                                 }
                                             }
                                         }
+                                        /*
+                                           Boards list is fetched in background so it can arrive while the user is
+                                           already typing here. Keep the entered text on the model reset
+                                        */
+                                        property string textBeforeReset: ''
+                                        Connections {
+                                            target: boardsModel
+                                            onModelAboutToBeReset: board.textBeforeReset = board.editText
+                                            onModelReset: board.editText = board.textBeforeReset
+                                        }
                                         Component.onCompleted: {
                                             // Board can be already specified in the config, in this case we should paste it
                                             const config = project.config;
@@ -663,9 +725,9 @@ ApplicationWindow {
                                             }
                                         }]);
                                         if (board.editText === board.textAt(0)) {
-                                            project.logAdded('WARNING  STM32 PlatformIO board is not specified, it will be needed on PlatformIO ' +
-                                                             'project creation. You can set it in "stm32pio.ini" file in the project directory',
-                                                             Logging.WARNING);
+                                            project.logsAdded([['WARNING  STM32 PlatformIO board is not specified, it will be needed on PlatformIO ' +
+                                                                'project creation. You can set it in "stm32pio.ini" file in the project directory',
+                                                                Logging.WARNING]]);
                                         }
 
                                         if (runCheckBox.checked) {
@@ -773,17 +835,28 @@ ApplicationWindow {
                                         display: model.icon ? AbstractButton.IconOnly : AbstractButton.TextOnly
                                         icon.source: model.icon || ''
                                         ToolTip {
-                                            visible: mouseArea.containsMouse
+                                            id: actionToolTip
+                                            property string staticText: ''
+                                            visible: mouseArea.containsMouse && text !== ''
                                             Component.onCompleted: {
-                                                text = '';
                                                 if (model.icon) {
-                                                    text += model.name;
+                                                    staticText += model.name;
                                                 }
                                                 if (model.tooltip) {
-                                                    text += text ? `<br>${model.tooltip}` : model.tooltip;
+                                                    staticText += staticText ? `<br>${model.tooltip}` : model.tooltip;
                                                 }
-                                                if (!model.icon && !model.tooltip) {
-                                                    this.destroy();
+                                                text = staticText;
+                                            }
+                                            Connections {
+                                                target: mouseArea
+                                                onContainsMouseChanged: {
+                                                    if (mouseArea.containsMouse) {
+                                                        // Estimation from the history of the previous runs
+                                                        const expected = project.expectedDuration(model.action);
+                                                        const hint = expected >= 0 ?
+                                                            `Usually takes ~${expected < 10 ? expected.toFixed(1) : Math.round(expected)} s` : '';
+                                                        actionToolTip.text = [actionToolTip.staticText, hint].filter(Boolean).join('<br>');
+                                                    }
                                                 }
                                             }
                                         }
@@ -1041,16 +1114,20 @@ ApplicationWindow {
                                         font.pointSize: 10  // different on different platforms, Qt's bug
                                         font.weight: Font.DemiBold
                                         textFormat: TextEdit.RichText
+                                        function formatRecord(message, level) {
+                                            if (level === Logging.WARNING) {
+                                                return '<font color="goldenrod"><pre style="white-space: pre-wrap">' + message + '</pre></font>';
+                                            } else if (level >= Logging.ERROR) {
+                                                return '<font color="indianred"><pre style="white-space: pre-wrap">' + message + '</pre></font>';
+                                            } else {
+                                                return '<pre style="white-space: pre-wrap">' + message + '</pre>';
+                                            }
+                                        }
                                         Connections {
                                             target: project
-                                            onLogAdded: {
-                                                if (level === Logging.WARNING) {
-                                                    log.append('<font color="goldenrod"><pre style="white-space: pre-wrap">' + message + '</pre></font>');
-                                                } else if (level >= Logging.ERROR) {
-                                                    log.append('<font color="indianred"><pre style="white-space: pre-wrap">' + message + '</pre></font>');
-                                                } else {
-                                                    log.append('<pre style="white-space: pre-wrap">' + message + '</pre>');
-                                                }
+                                            onLogsAdded: {
+                                                // The whole chunk is appended at once as every append() re-layouts the text
+                                                log.append(records.map(record => log.formatRecord(record[0], record[1])).join(''));
                                             }
                                         }
                                     }
@@ -0,0 +1,262 @@
+"""
+Performance benchmarks of the stm32pio own overhead. The real CubeMX, Java and PlatformIO are replaced by the stubs (see
+'stubs' folder) so the numbers don't depend on the tools and can be compared between the versions of stm32pio. This is
+not a part of the regular test suite, run it explicitly (from the repo root, same as the tests):
+
+    $  python -m tests.benchmark -o before.json
+    ... (make changes) ...
+    $  python -m tests.benchmark -o after.json --compare before.json
+
+Results are written as JSON: every benchmark reports the timings of its repetitions (min, median, mean, in seconds) and
+some benchmarks add their own figures (e.g. 'lines_per_second').
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import os
+import pathlib
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Mapping
+from unittest import mock
+
+import stm32pio.app
+import stm32pio.lib
+import stm32pio.util
+
+# Provides test constants
+from tests.test import *
+
+
+BENCHMARKS: Dict[str, Callable[[int], Mapping[str, Any]]] = {}  # name: function(repeat) -> results
+
+HUGE_TREE_FILES = 20000  # number of the files in the artificial '.pio' folder of the "huge" project
+
+
+def benchmark(function):
+    """Register the function as a benchmark"""
+    BENCHMARKS[function.__name__[len('bench_'):]] = function
+    return function
+
+
+def timings(samples: List[float]) -> Dict[str, Any]:
+    return {
+        'repeat': len(samples),
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'mean': statistics.mean(samples)
+    }
+
+
+def measure(function: Callable[[], Any], repeat: int, setup: Callable[[], Any] = None) -> Dict[str, Any]:
+    """Call the function 'repeat' times (running the optional setup before every call outside of the measurement)"""
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return timings(samples)
+
+
+def fresh_fixture() -> None:
+    """Copy the test project to the temp directory, same as CustomTestCase.setUp() does"""
+    shutil.rmtree(FIXTURE_PATH, ignore_errors=True)
+    shutil.copytree(TEST_PROJECT_PATH, FIXTURE_PATH)
+
+
+def complete_fixture() -> stm32pio.lib.Stm32pio:
+    """Fresh fixture brought to the BUILT stage by the stubs"""
+    fresh_fixture()
+    project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=STUBS_PARAMETERS)
+    project.save_config()
+    project.run_pipeline(with_build=True)
+    return project
+
+
+@contextlib.contextmanager
+def tools_timer():
+    """
+    Sum up the time spent in the subprocesses (i.e. the tools) so it can be excluded from the measurement. Yields the
+    one-element list holding the accumulated seconds
+    """
+    spent = [0.0]
+    original_run = subprocess.run
+
+    def timed_run(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original_run(*args, **kwargs)
+        finally:
+            spent[0] += time.perf_counter() - start
+
+    with mock.patch('subprocess.run', timed_run):
+        yield spent
+
+
+@contextlib.contextmanager
+def discarded_logs(name: str = 'stm32pio'):
+    """Let every message of the logger (and its children) be formed but go nowhere (verbose mode without the output)"""
+    logger = logging.getLogger(name)
+    state = logger.level, logger.propagate, logger.handlers
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.handlers = [logging.NullHandler()]
+    try:
+        yield logger
+    finally:
+        logger.level, logger.propagate, logger.handlers = state
+
+
+@benchmark
+def bench_construction(repeat: int) -> Mapping[str, Any]:
+    """Stm32pio instance construction for the existing project (config file, .ioc file lookup and so on)"""
+    complete_fixture()
+    return measure(lambda: stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=STUBS_PARAMETERS), repeat)
+
+
+@benchmark
+def bench_load_config(repeat: int) -> Mapping[str, Any]:
+    """Stm32pio._load_config() alone (the file is present)"""
+    project = complete_fixture()
+    return measure(lambda: project._load_config(STUBS_PARAMETERS), repeat)
+
+
+def state_probe(repeat: int) -> Mapping[str, Any]:
+    project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=STUBS_PARAMETERS)
+    if not project.state[stm32pio.lib.ProjectStage.BUILT]:
+        raise Exception(f"unexpected state of the benchmark project:\n{project.state}")
+    return {
+        'cold': measure(lambda: project.state, repeat, setup=project.invalidate_state),  # full probe
+        'cached': measure(lambda: project.state, repeat)  # only the validation of the cache
+    }
+
+
+@benchmark
+def bench_state_small(repeat: int) -> Mapping[str, Any]:
+    """'state' property latency for the freshly built project"""
+    complete_fixture()
+    return state_probe(repeat)
+
+
+@benchmark
+def bench_state_huge(repeat: int) -> Mapping[str, Any]:
+    """'state' property latency for the project having a lot of files in its '.pio' folder (e.g. after many builds)"""
+    complete_fixture()
+    files_per_dir = 500
+    for dir_number in range(HUGE_TREE_FILES // files_per_dir):
+        build_dir = FIXTURE_PATH.joinpath('.pio', 'build', TEST_PROJECT_BOARD, 'src', f'dir_{dir_number}')
+        build_dir.mkdir(parents=True)
+        for file_number in range(files_per_dir):
+            build_dir.joinpath(f'object_{file_number}.o').write_bytes(b'')
+    results = dict(state_probe(repeat))
+    results['files'] = HUGE_TREE_FILES
+    return results
+
+
+@benchmark
+def bench_log_pipe(repeat: int) -> Mapping[str, Any]:
+    """LogPipe throughput: lines written into the pipe are logged by a (discarding) handler"""
+    lines = 100000
+    chunk = b''.join(f"Compiling .pio/build/object_{number}.o\n".encode() for number in range(1000))
+
+    def pump():
+        with stm32pio.util.LogPipe(logger, logging.DEBUG, capture=stm32pio.util.LogPipeCapture.FULL) as log:
+            for _ in range(lines // 1000):
+                os.write(log.pipe, chunk)
+
+    with discarded_logs('stm32pio.benchmark') as logger:
+        results = measure(pump, repeat)
+    results['lines'] = lines
+    results['lines_per_second'] = lines / results['median']
+    return results
+
+
+@benchmark
+def bench_new(repeat: int) -> Mapping[str, Any]:
+    """
+    End-to-end 'stm32pio new --with-build' via CLI. The time of the tools (stubs) is measured separately and
+    subtracted, the rest is our own overhead
+    """
+    samples_total, samples_overhead = [], []
+    # Make the stubs as talkative as the real tools are so the output handling is a part of the measurement
+    stub_output = mock.patch.dict(os.environ, { 'STM32PIO_STUB_LINES': '1000' })
+    for _ in range(repeat):
+        fresh_fixture()
+        stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=STUBS_PARAMETERS).save_config()
+        with stub_output, discarded_logs(), tools_timer() as tools_time:
+            start = time.perf_counter()
+            return_code = stm32pio.app.main(sys_argv=['new', '-d', str(FIXTURE_PATH), '-b', TEST_PROJECT_BOARD,
+                                                      '--with-build'],
+                                            should_setup_logging=False)
+            total = time.perf_counter() - start
+        if return_code != 0:
+            raise Exception(f"'new' has failed with the return code {return_code}")
+        samples_total.append(total)
+        samples_overhead.append(total - tools_time[0])
+    return {
+        'total': timings(samples_total),
+        'overhead': timings(samples_overhead)
+    }
+
+
+def compare(results: Mapping[str, Any], baseline: Mapping[str, Any], path: str = '') -> None:
+    """Print the relative change of every median (the baseline is the results file of another run)"""
+    for key, value in results.items():
+        if key not in baseline:
+            continue
+        if isinstance(value, dict):
+            compare(value, baseline[key], f'{path}{key}.')
+        elif key == 'median' and baseline[key]:
+            print(f"{path}{key}: {baseline[key]:.6f} -> {value:.6f} s ({(value / baseline[key] - 1) * 100:+.1f}%)")
+
+
+def main(sys_argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="stm32pio benchmarks (the tools are replaced by the stubs)")
+    parser.add_argument('-o', '--output', help="JSON file to write the results to", default='benchmark.json')
+    parser.add_argument('-n', '--repeat', help="number of the repetitions of every benchmark", type=int, default=10)
+    parser.add_argument('-b', '--benchmark', help="run only the given benchmarks", nargs='+',
+                        choices=list(BENCHMARKS.keys()))
+    parser.add_argument('--compare', help="JSON results of a previous run to compare with")
+    args = parser.parse_args(sys_argv)
+
+    if not STUBS_SUPPORTED:
+        print("The stubs are not supported on this platform", file=sys.stderr)
+        return 1
+
+    results = {
+        'meta': {
+            'stm32pio': stm32pio.app.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': datetime.datetime.now().isoformat(),
+            'repeat': args.repeat
+        },
+        'benchmarks': {}
+    }
+    try:
+        for name in (args.benchmark or BENCHMARKS.keys()):
+            print(f"{name}...", flush=True)
+            results['benchmarks'][name] = BENCHMARKS[name](args.repeat)
+    finally:
+        shutil.rmtree(FIXTURE_PATH, ignore_errors=True)
+
+    pathlib.Path(args.output).write_text(json.dumps(results, indent=4))
+    print(f"results have been written to {args.output}")
+
+    if args.compare:
+        compare(results['benchmarks'], json.loads(pathlib.Path(args.compare).read_text())['benchmarks'])
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
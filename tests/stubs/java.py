@@ -0,0 +1,61 @@
+"""
+Stand-in for the 'java -jar STM32CubeMX' invocation. Understands both the script mode (-q FILE) and the interactive one
+(-i, commands are read from STDIN), also 'java -version'. 'generate code' creates minimal Inc/Src folders and prints the
+same success line as the real CubeMX does. Tune the behavior with environment variables:
+
+    STM32PIO_STUB_DELAY: seconds to sleep before the generation (emulates the JVM startup and the generation itself)
+    STM32PIO_STUB_LINES: number of the additional output lines to print
+"""
+
+import os
+import pathlib
+import sys
+import time
+
+
+def execute(command: str) -> None:
+    name, _, argument = command.strip().partition(' ')
+    if name == 'config' and argument.startswith('load '):
+        ioc_file = pathlib.Path(argument[len('load '):].strip())
+        if not ioc_file.is_file():
+            print(f"[ERROR] cannot load {ioc_file}", flush=True)
+        else:
+            print(f"Loading {ioc_file}", flush=True)
+    elif name == 'generate' and argument.startswith('code '):
+        project_dir = pathlib.Path(argument[len('code '):].strip())
+        time.sleep(float(os.environ.get('STM32PIO_STUB_DELAY', 0)))
+        for line_number in range(int(os.environ.get('STM32PIO_STUB_LINES', 0))):
+            print(f"[INFO] generating file {line_number}")
+        project_dir.joinpath('Inc').mkdir(exist_ok=True)
+        project_dir.joinpath('Src').mkdir(exist_ok=True)
+        project_dir.joinpath('Inc', 'main.h').write_text("/* main.h */\n")
+        main_c = project_dir.joinpath('Src', 'main.c')
+        if not main_c.exists():
+            main_c.write_text("int main(void)\n{\n  while (1)\n  {\n  }\n}\n")
+        print("Code succesfully generated", flush=True)
+
+
+def main() -> int:
+    args = sys.argv[1:]
+    if args[:1] == ['-version']:  # same as the real one, prints to STDERR
+        print('openjdk version "11.0.2" 2019-01-15 (stub)', file=sys.stderr)
+        return 0
+    print("Starting STM32CubeMX (stub)", flush=True)
+    if '-q' in args:
+        script = pathlib.Path(args[args.index('-q') + 1]).read_text()
+        for command in script.splitlines():
+            if command.strip() == 'exit':
+                break
+            execute(command)
+    elif '-i' in args:
+        print("MX>", flush=True)
+        for command in sys.stdin:
+            if command.strip() == 'exit':
+                break
+            execute(command)
+            print("MX>", flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""
+Stand-in for the PlatformIO CLI. Supports the subset of commands stm32pio is using: 'init', 'run', 'boards' and
+'--version'. Tune the behavior with environment variables:
+
+    STM32PIO_STUB_DELAY: seconds to sleep before the 'run' command finishes (emulates the compilation)
+    STM32PIO_STUB_LINES: number of the additional output lines to print on 'run'
+"""
+
+import json
+import os
+import pathlib
+import sys
+import time
+
+
+BOARDS = ['nucleo_f031k6', 'nucleo_f429zi', 'discovery_f4', 'bluepill_f103c8']
+
+
+def main() -> int:
+    args = sys.argv[1:]
+
+    if args[:1] == ['--version']:
+        print("PlatformIO, version 4.3.4 (stub)")
+
+    elif args[:1] == ['boards']:
+        print(json.dumps([{ 'id': board, 'name': board.upper() } for board in BOARDS]))
+
+    elif args[:1] == ['init']:
+        project_dir = pathlib.Path(args[args.index('-d') + 1])
+        board = args[args.index('-b') + 1]
+        if board not in BOARDS:
+            print(f"Error: Unknown board ID '{board}'")
+            return 1
+        for directory in ['include', 'src', 'lib', 'test']:
+            project_dir.joinpath(directory).mkdir(exist_ok=True)
+        platformio_ini = project_dir.joinpath('platformio.ini')
+        if not platformio_ini.exists():
+            platformio_ini.write_text(f"[env:{board}]\nplatform = ststm32\nboard = {board}\nframework = stm32cube\n")
+
+    elif args[:1] == ['run']:
+        project_dir = pathlib.Path(args[args.index('-d') + 1])
+        platformio_ini = project_dir.joinpath('platformio.ini')
+        if not platformio_ini.is_file():
+            print("Error: Not a PlatformIO project", file=sys.stderr)
+            return 1
+        time.sleep(float(os.environ.get('STM32PIO_STUB_DELAY', 0)))
+        for line_number in range(int(os.environ.get('STM32PIO_STUB_LINES', 0))):
+            print(f"Compiling .pio/build/object_{line_number}.o")
+        envs = [line.strip()[len('[env:'):-1] for line in platformio_ini.read_text().splitlines()
+                if line.strip().startswith('[env:')]
+        for env in envs:
+            build_dir = project_dir.joinpath('.pio', 'build', env)
+            build_dir.mkdir(parents=True, exist_ok=True)
+            for extension in ['elf', 'bin']:
+                build_dir.joinpath(f'firmware.{extension}').write_bytes(b'\x7fELF')
+
+    else:
+        print(f"Error: unknown command {args}", file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
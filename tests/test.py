@@ -16,12 +16,14 @@ To get the test coverage install and use 'coverage' package:
 import inspect
 import logging
 import pathlib
+import platform
 import shutil
 import sys
 import tempfile
 import unittest
 
 import stm32pio.app
+import stm32pio.util
 
 
 TEST_PROJECT_PATH = pathlib.Path('stm32pio-test-project').resolve(strict=True)
@@ -48,6 +50,32 @@ STM32PIO_MAIN_SCRIPT: str = inspect.getfile(stm32pio.app)
 # Absolute path to the Python executable (no need to guess whether it's 'python' or 'python3' and so on)
 PYTHON_EXEC: str = sys.executable
 
+# Executable stand-ins for the Java (CubeMX) and PlatformIO CLI (see 'stubs' folder) allowing to run some tests without
+# the real tools. These are tiny shell wrappers so they are available on POSIX systems only
+STUBS_SUPPORTED = platform.system() != 'Windows'
+STUBS_PATH = pathlib.Path(TEMP_DIR.name).joinpath('stubs')
+STUBS_PATH.mkdir()
+for stub_name in ['java', 'platformio']:
+    stub_script = pathlib.Path(__file__).parent.joinpath('stubs', f'{stub_name}.py').resolve()
+    stub = STUBS_PATH.joinpath(stub_name)
+    stub.write_text(f'#!/bin/sh\nexec "{PYTHON_EXEC}" "{stub_script}" "$@"\n')
+    stub.chmod(0o755)
+# Use it as a 'parameters' argument for the Stm32pio constructor to point the project to the stubs
+STUBS_PARAMETERS = {
+    'app': {
+        'java_cmd': str(STUBS_PATH.joinpath('java')),
+        'platformio_cmd': str(STUBS_PATH.joinpath('platformio')),
+        'cubemx_cmd': 'STM32CubeMX'  # ignored by the stub
+    },
+    'project': {
+        'board': TEST_PROJECT_BOARD
+    }
+}
+
+# Do not touch the user's cache during the tests
+stm32pio.util.platformio_boards_cache.path = pathlib.Path(TEMP_DIR.name).joinpath('platformio_boards.json')
+stm32pio.util.tool_versions_cache.path = pathlib.Path(TEMP_DIR.name).joinpath('tool_versions.json')
+
 print(f"The file of 'stm32pio.app' module: {STM32PIO_MAIN_SCRIPT}")
 print(f"Python executable: {PYTHON_EXEC} {sys.version}")
 print(f"Temp test fixture path: {FIXTURE_PATH}")
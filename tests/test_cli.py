@@ -70,6 +70,62 @@ class TestCLI(CustomTestCase):
         # .ioc file should be preserved
         self.assertTrue(FIXTURE_PATH.joinpath(f"{FIXTURE_PATH.name}.ioc").is_file(), msg="Missing .ioc file")
 
+    @unittest.skipUnless(STUBS_SUPPORTED, "stub tools are not available on this platform")
+    def test_batch(self):
+        """
+        Create several projects in parallel using the stub tools (they are set in the projects' configs) and check the
+        summary and the resulting stages
+        """
+        paths = [FIXTURE_PATH]
+        for suffix in ['second', 'third']:
+            path = FIXTURE_PATH.with_name(f'{FIXTURE_PATH.name}-{suffix}')
+            shutil.copytree(FIXTURE_PATH, path)
+            self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+            paths.append(path)
+        for path in paths:
+            stm32pio.lib.Stm32pio(path, parameters=STUBS_PARAMETERS).save_config()
+
+        buffer_stdout = io.StringIO()
+        with contextlib.redirect_stdout(buffer_stdout):
+            return_code = stm32pio.app.main(sys_argv=['batch', 'new', '--with-build', '-j', '3', '--build-jobs', '1',
+                                                      str(FIXTURE_PATH.parent.joinpath(f'{FIXTURE_PATH.name}*'))],
+                                            should_setup_logging=False)
+
+        self.assertEqual(return_code, 0, msg="Non-zero return code")
+        self.assertIn(f"3 of 3 projects succeeded", buffer_stdout.getvalue(), msg="Summary is missing or incorrect")
+        for path in paths:
+            with self.subTest(path=path):
+                self.assertEqual(stm32pio.lib.Stm32pio(path).state.current_stage, stm32pio.lib.ProjectStage.BUILT)
+
+    def test_new_plan(self):
+        """
+        Dry run should list all the actions for the fresh project and change nothing
+        """
+        buffer_stdout = io.StringIO()
+        with contextlib.redirect_stdout(buffer_stdout):
+            return_code = stm32pio.app.main(sys_argv=['new', '-d', str(FIXTURE_PATH), '--with-build', '--plan'],
+                                            should_setup_logging=False)
+        self.assertEqual(return_code, 0, msg="Non-zero return code")
+        for action in ['generate_code', 'pio_init', 'patch', 'build']:
+            self.assertIn(f"[run]   {action}", buffer_stdout.getvalue(), msg=f"'{action}' is not planned")
+        self.assertEqual([child.name for child in FIXTURE_PATH.iterdir()], [f"{FIXTURE_PATH.name}.ioc"],
+                         msg="Project has been changed by the dry run")
+
+    @unittest.skipUnless(STUBS_SUPPORTED, "stub tools are not available on this platform")
+    def test_stats(self):
+        """
+        Statistics should be shown for the performed actions
+        """
+        stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=STUBS_PARAMETERS).run_pipeline(with_build=True)
+
+        buffer_stdout = io.StringIO()
+        with contextlib.redirect_stdout(buffer_stdout):
+            return_code = stm32pio.app.main(sys_argv=['stats', '-d', str(FIXTURE_PATH), '--action', 'build'],
+                                            should_setup_logging=False)
+        self.assertEqual(return_code, 0, msg="Non-zero return code")
+        self.assertRegex(buffer_stdout.getvalue(), r'build\s+1\s+0\s', msg="Build run is not in the statistics")
+        self.assertNotIn('generate_code', buffer_stdout.getvalue(), msg="Statistics is not filtered by the action")
+
     def test_generate(self):
         return_code = stm32pio.app.main(sys_argv=['generate', '-d', str(FIXTURE_PATH)], should_setup_logging=False)
         self.assertEqual(return_code, 0, msg="Non-zero return code")
@@ -205,3 +261,41 @@ class TestCLI(CustomTestCase):
                     last_stage_pos = match.start()
 
         self.assertEqual(matches_counter, len(stm32pio.lib.ProjectStage) - 1)  # UNDEFINED stage should not be printed
+
+    def test_import_time(self):
+        """
+        'status' is called a lot (e.g. by the shell prompts and the editors integrations) so it should start fast. Check
+        that it doesn't load the modules of the heavy actions and fits into the import time budget (the modules loaded
+        by the bare interpreter are not taken into account)
+        """
+
+        def imports(*args):
+            result = subprocess.run([PYTHON_EXEC, '-X', 'importtime', *args], stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE, encoding='utf-8')
+            modules = {}  # name: self time, us
+            for line in result.stderr.splitlines():
+                match = re.match(r'^import time:\s+(\d+) \|\s+\d+ \|(\s+)(\S+)$', line)
+                if match:
+                    modules[match.group(3)] = int(match.group(1))
+            return modules
+
+        interpreter_modules = imports('-c', 'pass')
+        status_modules = imports(STM32PIO_MAIN_SCRIPT, 'status', '-d', str(FIXTURE_PATH))
+        self.assertIn('stm32pio.lib', status_modules, msg="Unexpected output of '-X importtime'")
+
+        for module in ['asyncio', 'subprocess', 'statistics', 'stm32pio.history', 'stm32pio.batch', 'stm32pio.watch']:
+            with self.subTest(module=module):
+                self.assertNotIn(module, status_modules, msg=f"'{module}' should not be loaded by 'status'")
+
+        # The CLI itself can't avoid some of them (e.g. argparse loads shutil) so check the library separately. The
+        # tracing module is needed by the decorators at the definition time but it has no dependencies of its own
+        library_modules = imports('-c', 'import stm32pio.lib')
+        for module in ['shutil', 'subprocess', 'tempfile', 'hashlib']:
+            with self.subTest(module=module):
+                self.assertNotIn(module, library_modules, msg=f"'{module}' should not be loaded by stm32pio.lib")
+        self.assertNotIn('json', imports('-c', 'import stm32pio.trace'),
+                         msg="stm32pio.trace should load its dependencies only when writing the trace")
+
+        budget_ms = 100
+        spent_ms = sum(spent for name, spent in status_modules.items() if name not in interpreter_modules) / 1000
+        self.assertLess(spent_ms, budget_ms, msg="'status' imports take too long")
@@ -1,13 +1,25 @@
+import asyncio
 import collections
 import configparser
+import contextlib
+import copy
 import inspect
+import json
+import logging
+import os
 import platform
 import subprocess
 import time
+import unittest.mock
 
+import stm32pio.aio
+import stm32pio.firmware_cache
+import stm32pio.history
 import stm32pio.lib
 import stm32pio.settings
+import stm32pio.trace
 import stm32pio.util
+import stm32pio.watch
 
 # Provides test constants
 from tests.test import *
@@ -33,6 +45,363 @@ class TestUnit(CustomTestCase):
             with self.subTest(msg=f"{file} hasn't been created"):
                 self.assertEqual(FIXTURE_PATH.joinpath(file).is_file(), True)
 
+    @unittest.skipUnless(STUBS_SUPPORTED, "stub tools are not available on this platform")
+    def test_generate_code_is_incremental(self):
+        """
+        Second generation with the same .ioc file and parameters should not invoke the CubeMX. Use the stub tools and
+        check the log records
+        """
+        project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=STUBS_PARAMETERS)
+        project.generate_code()
+
+        with self.assertLogs(level='INFO') as logs:
+            self.assertEqual(project.generate_code(), 0)
+            self.assertTrue(any('skipping the generation' in msg for msg in logs.output),
+                            msg="Generation wasn't skipped")
+
+        with self.subTest(case='forced'), self.assertLogs(level='INFO') as logs:
+            project.generate_code(force=True)
+            self.assertTrue(any('successful code generation' in msg for msg in logs.output),
+                            msg="Generation has been skipped")
+
+        with FIXTURE_PATH.joinpath(f'{FIXTURE_PATH.name}.ioc').open(mode='a') as ioc_file:
+            ioc_file.write('Test.Key=value\n')
+        with self.subTest(case='.ioc changed'), self.assertLogs(level='INFO') as logs:
+            project.generate_code()
+            self.assertTrue(any('successful code generation' in msg for msg in logs.output),
+                            msg="Generation has been skipped")
+
+    @unittest.skipUnless(STUBS_SUPPORTED, "stub tools are not available on this platform")
+    def test_cubemx_worker(self):
+        """
+        Generate the code for 2 projects using a single CubeMX process (stub one)
+        """
+        second_project_path = FIXTURE_PATH.with_name(f'{FIXTURE_PATH.name}-second')
+        shutil.copytree(FIXTURE_PATH, second_project_path)
+        self.addCleanup(shutil.rmtree, second_project_path, ignore_errors=True)
+
+        with stm32pio.lib.CubeMXWorker(STUBS_PARAMETERS['app']['java_cmd'],
+                                       STUBS_PARAMETERS['app']['cubemx_cmd']) as worker:
+            pids = set()
+            for path in [FIXTURE_PATH, second_project_path]:
+                project = stm32pio.lib.Stm32pio(path, parameters=STUBS_PARAMETERS,
+                                                instance_options={ 'cubemx_worker': worker })
+                self.assertEqual(project.generate_code(), 0)
+                self.assertTrue(project.state[stm32pio.lib.ProjectStage.GENERATED])
+                pids.add(worker.process.pid)
+            self.assertEqual(len(pids), 1, msg="CubeMX process has been restarted")
+            self.assertEqual(worker.process.args, [STUBS_PARAMETERS['app']['java_cmd'], '-jar',
+                                                   STUBS_PARAMETERS['app']['cubemx_cmd'], '-i'],
+                             msg="CubeMX has not been started in the console mode")
+            self.assertTrue(worker.headless, msg="Console prompt hasn't been detected")
+
+        self.assertIsNone(worker.process, msg="CubeMX process has not been stopped")
+
+        # E.g. the CubeMX showing the UI instead of the console: the prompt never appears
+        with self.subTest(case='not headless'), \
+                unittest.mock.patch.object(stm32pio.lib.CubeMXWorker, 'prompt', 'NO-SUCH-PROMPT>'), \
+                stm32pio.lib.CubeMXWorker(STUBS_PARAMETERS['app']['java_cmd'], STUBS_PARAMETERS['app']['cubemx_cmd'],
+                                          startup_timeout=2) as worker:
+            project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=STUBS_PARAMETERS,
+                                            instance_options={ 'cubemx_worker': worker })
+            self.assertEqual(project.generate_code(force=True), 0)
+            self.assertIs(worker.headless, False, msg="Failed startup probe hasn't been detected")
+            self.assertIsNone(worker.process, msg="One-shot CubeMX process hasn't been used")
+
+    @unittest.skipUnless(STUBS_SUPPORTED, "stub tools are not available on this platform")
+    def test_async_api(self):
+        """
+        Drive several projects by a single event loop and cancel the long-running build (stub tools are used)
+        """
+        second_project_path = FIXTURE_PATH.with_name(f'{FIXTURE_PATH.name}-second')
+        shutil.copytree(FIXTURE_PATH, second_project_path)
+        self.addCleanup(shutil.rmtree, second_project_path, ignore_errors=True)
+        projects = [stm32pio.aio.AsyncStm32pio(stm32pio.lib.Stm32pio(path, parameters=STUBS_PARAMETERS))
+                    for path in [FIXTURE_PATH, second_project_path]]
+
+        async def new_project(project):
+            await project.generate_code()
+            await project.pio_init()
+            project.patch()
+            return await project.build()
+
+        async def new_projects():
+            return await asyncio.gather(*(new_project(project) for project in projects))
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        return_codes = loop.run_until_complete(new_projects())
+        self.assertEqual(return_codes, [0, 0], msg="Non-zero return code")
+        for project in projects:
+            self.assertTrue(project.state[stm32pio.lib.ProjectStage.BUILT], msg=f"{project} hasn't been built")
+
+        with self.subTest(case='cancellation'), unittest.mock.patch.dict(os.environ, { 'STM32PIO_STUB_DELAY': '30' }):
+            async def cancel_build():
+                task = asyncio.ensure_future(projects[0].build(force=True))  # the project is up-to-date already
+                await asyncio.sleep(0.5)
+                task.cancel()
+                await task
+
+            start = time.monotonic()
+            with self.assertRaises(asyncio.CancelledError):
+                loop.run_until_complete(cancel_build())
+            self.assertLess(time.monotonic() - start, 10, msg="Build hasn't been terminated")
+
+    @unittest.skipUnless(STUBS_SUPPORTED, "stub tools are not available on this platform")
+    def test_pipeline(self):
+        """
+        Pipeline should resume from the failed stage and skip the fulfilled ones
+        """
+        broken_parameters = copy.deepcopy(STUBS_PARAMETERS)
+        broken_parameters['app']['platformio_cmd'] = str(FIXTURE_PATH.joinpath('no-such-platformio'))
+        project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=broken_parameters)
+        self.assertTrue(all(step.run for step in project.plan(with_build=True)),
+                        msg="Empty project should run all steps")
+        with self.assertRaises(Exception):
+            project.run_pipeline(with_build=True)  # fails on the PlatformIO initialization
+
+        project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=STUBS_PARAMETERS)
+        plan = { step.action: step.run for step in project.plan(with_build=True) }
+        self.assertEqual(plan, { 'generate_code': False, 'pio_init': True, 'patch': True, 'build': True },
+                         msg="Pipeline doesn't resume from the failed stage")
+
+        with unittest.mock.patch.object(project, 'generate_code') as generate_code:
+            project.run_pipeline(with_build=True)
+            generate_code.assert_not_called()
+        self.assertTrue(project.state[stm32pio.lib.ProjectStage.BUILT], msg="Project hasn't been built")
+
+        plan = { step.action: step.run for step in project.plan() }
+        self.assertEqual(plan, { 'generate_code': False, 'pio_init': False, 'patch': False },
+                         msg="Completed stages should be skipped")
+        self.assertTrue(project.plan(force=True)[0].run, msg="Forced generation should be planned")
+
+    @unittest.skipUnless(STUBS_SUPPORTED, "stub tools are not available on this platform")
+    def test_history(self):
+        """
+        Every performed (not skipped) action should be recorded with its result and tools versions, the history is
+        compacted when it grows too large
+        """
+        project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=STUBS_PARAMETERS)
+        project.run_pipeline(with_build=True)
+        project.generate_code()  # up-to-date, skipped
+
+        records = project.history.records()
+        self.assertEqual([record['action'] for record in records], ['generate_code', 'pio_init', 'patch', 'build'])
+        self.assertTrue(all(record['success'] for record in records))
+        self.assertIn('stub', records[0]['versions']['java'], msg="Java version hasn't been recorded")
+        self.assertIn('stub', records[-1]['versions']['platformio'], msg="PlatformIO version hasn't been recorded")
+
+        broken_parameters = copy.deepcopy(STUBS_PARAMETERS)
+        broken_parameters['app']['platformio_cmd'] = str(FIXTURE_PATH.joinpath('no-such-platformio'))
+        with self.assertRaises(Exception):
+            stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=broken_parameters).build()
+
+        stats = project.history.stats()
+        self.assertEqual((stats['build'].runs, stats['build'].failures), (2, 1))
+        self.assertEqual(stats['build'].p50, records[-1]['duration'], msg="Failed runs should not affect the timings")
+        self.assertIsNotNone(project.history.expected_duration('pio_init'))
+        self.assertIsNone(project.history.expected_duration('clean'))
+
+        history = stm32pio.history.ProjectHistory(FIXTURE_PATH.joinpath('another-service-dir'), max_records=3,
+                                                  record_size=10)  # underestimated, the records will be counted
+        for run in range(6):
+            history.append('build', time.time(), run, True)
+        self.assertEqual(len(history.records()), 6, msg="History has been compacted too early")
+        history.append('build', time.time(), 6, True)
+        self.assertEqual([record['duration'] for record in history.records('build')], [4, 5, 6],
+                         msg="History hasn't been compacted")
+
+        history = stm32pio.history.ProjectHistory(FIXTURE_PATH.joinpath('third-service-dir'), max_records=10)
+        with unittest.mock.patch.object(history, '_compact', wraps=history._compact) as compact:
+            for run in range(15):
+                history.append('build', time.time(), run, True)
+        compact.assert_not_called()  # the file is far below the size limit, no need to count the records
+
+    @unittest.skipUnless(STUBS_SUPPORTED, "stub tools are not available on this platform")
+    def test_build_is_incremental(self):
+        """
+        Build of the unchanged project should not invoke the PlatformIO at all
+        """
+        project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=STUBS_PARAMETERS)
+        project.run_pipeline(with_build=True)
+        self.assertFalse(project.plan(with_build=True)[-1].run, msg="Build of the unchanged project is planned")
+
+        with self.assertLogs(level='INFO') as logs:
+            self.assertEqual(project.build(), 0)
+            self.assertTrue(any('skipping the build' in msg for msg in logs.output), msg="Build wasn't skipped")
+
+        def append_comment(file):
+            with FIXTURE_PATH.joinpath(file).open(mode='a') as opened_file:
+                opened_file.write('\n// comment\n' if file.endswith('.c') else '\n; comment\n')
+
+        cases = [
+            ('forced', lambda: None, True),
+            ('source changed', lambda: append_comment('Src/main.c'), False),
+            ('firmware removed', lambda: shutil.rmtree(FIXTURE_PATH.joinpath('.pio')), False),
+            ('platformio.ini changed', lambda: append_comment('platformio.ini'), False)
+        ]
+        for case, change, force in cases:
+            with self.subTest(case=case), self.assertLogs(level='INFO') as logs:
+                change()
+                project.invalidate_state()
+                self.assertEqual(project.plan(with_build=True, force=force)[-1].run, True, msg="Build isn't planned")
+                self.assertEqual(project.build(force=force), 0)
+                self.assertTrue(any('successful PlatformIO build' in msg for msg in logs.output),
+                                msg="Build has been skipped")
+
+    @unittest.skipUnless(STUBS_SUPPORTED, "stub tools are not available on this platform")
+    def test_firmware_cache(self):
+        """
+        The same sources should be built only once: the next builds restore the firmware from the cache. Any change of
+        the sources is a miss. The least recently used entries are evicted on overflow
+        """
+        parameters = copy.deepcopy(STUBS_PARAMETERS)
+        parameters['app']['firmware_cache_dir'] = '.firmware-cache'  # relative to the project
+        project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=parameters)
+        project.run_pipeline(with_build=True)
+        cache_dir = FIXTURE_PATH.joinpath('.firmware-cache')
+        self.assertEqual(len(list(cache_dir.iterdir())), 1, msg="Firmware hasn't been stored")
+
+        def platformio_runs(build) -> int:
+            shutil.rmtree(FIXTURE_PATH.joinpath('.pio'))
+            project.invalidate_state()
+            with unittest.mock.patch('subprocess.run', wraps=subprocess.run) as run:
+                self.assertEqual(build(), 0, msg="Build has failed")
+            self.assertTrue(project.state[stm32pio.lib.ProjectStage.BUILT], msg="Firmware is missing")
+            return sum(1 for call in run.call_args_list if 'run' in call[0][0])
+
+        self.assertEqual(platformio_runs(project.build), 0, msg="Firmware hasn't been restored from the cache")
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.assertEqual(platformio_runs(lambda: loop.run_until_complete(stm32pio.aio.AsyncStm32pio(project).build())),
+                         0, msg="Firmware hasn't been restored from the cache by the async API")
+        self.assertEqual(platformio_runs(lambda: project.build(force=True)), 1,
+                         msg="Forced build has been served from the cache")
+
+        with FIXTURE_PATH.joinpath('Src', 'main.c').open(mode='a') as main_c:
+            main_c.write('\n// changed\n')
+        self.assertEqual(platformio_runs(project.build), 1, msg="Changed sources should be built")
+        self.assertEqual(len(list(cache_dir.iterdir())), 2)
+
+        entry_size = sum(file.stat().st_size for file in cache_dir.rglob('*') if file.is_file()) // 2
+        firmware_cache = stm32pio.firmware_cache.FirmwareCache(cache_dir, max_size=entry_size)
+        oldest = min(cache_dir.iterdir(), key=lambda entry: entry.stat().st_mtime)
+        os.utime(oldest, (0, 0))
+        firmware_cache.evict()
+        self.assertFalse(oldest.exists(), msg="Least recently used entry hasn't been evicted")
+        self.assertEqual(len(list(cache_dir.iterdir())), 1, msg="Recently used entry should be kept")
+
+    @unittest.skipUnless(STUBS_SUPPORTED, "stub tools are not available on this platform")
+    def test_trace(self):
+        """
+        Actions and their subprocesses should be recorded as the nested spans and saved as the Chrome trace JSON
+        """
+        trace_file = FIXTURE_PATH.joinpath('trace.json')
+        with stm32pio.trace.tracing(trace_file):
+            project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=STUBS_PARAMETERS)
+            project.generate_code()
+        self.assertIsNone(stm32pio.trace.get_tracer(), msg="Tracing hasn't been turned off")
+
+        events = { event['name']: event for event in json.loads(trace_file.read_text())['traceEvents'] }
+        for name in ['Stm32pio.__init__', 'Stm32pio._load_config', 'Stm32pio.generate_code', 'subprocess: CubeMX']:
+            self.assertIn(name, events, msg=f"'{name}' span is missing")
+        self.assertEqual(events['Stm32pio.generate_code']['args']['project'], str(project.path))
+
+        parent, child = events['Stm32pio.generate_code'], events['subprocess: CubeMX']
+        self.assertEqual(parent['tid'], child['tid'])
+        self.assertTrue(parent['ts'] <= child['ts'] and child['ts'] + child['dur'] <= parent['ts'] + parent['dur'],
+                        msg="Subprocess span is not nested into the action one")
+
+    @unittest.skipUnless(STUBS_SUPPORTED, "stub tools are not available on this platform")
+    def test_watch(self):
+        """
+        Watcher should regenerate the code on the .ioc file changes (not reacting to the generated code itself), rebuild
+        on the sources changes and cancel the outdated build
+        """
+
+        async def wait_for(predicate, timeout=10):
+            start = time.monotonic()
+            while not predicate():
+                if time.monotonic() - start > timeout:
+                    raise TimeoutError("watcher hasn't reacted in time")
+                await asyncio.sleep(0.05)
+
+        async def scenario(watcher):
+            original_build = watcher.project.build
+
+            async def build(**kwargs):
+                builds.append(time.monotonic())
+                return await original_build(**kwargs)
+
+            builds = []
+            watcher.project.build = build
+            task = asyncio.ensure_future(watcher.watch())
+            try:
+                await wait_for(lambda: watcher.runs == 1)
+                self.assertTrue(project.state[stm32pio.lib.ProjectStage.BUILT], msg="Initial run hasn't been performed")
+
+                with project.ioc_file.open(mode='a') as ioc_file:
+                    ioc_file.write('Test.Key=value\n')
+                await wait_for(lambda: watcher.runs == 2)
+                self.assertTrue(project._generation_is_up_to_date(), msg="Code hasn't been regenerated")
+                await asyncio.sleep(1)
+                self.assertEqual(watcher.runs, 2, msg="Generated code has triggered the run")
+
+                with unittest.mock.patch.dict(os.environ, { 'STM32PIO_STUB_DELAY': '30' }):
+                    builds_before = len(builds)  # the initial build is skipped if the project is up-to-date already
+                    FIXTURE_PATH.joinpath('Src', 'main.c').write_text("/* changed */\n")
+                    await wait_for(lambda: len(builds) == builds_before + 1)
+                    await asyncio.sleep(0.5)  # build is in progress now
+                start = time.monotonic()
+                FIXTURE_PATH.joinpath('Src', 'main.c').write_text("/* changed again */\n")
+                await wait_for(lambda: watcher.runs == 4)
+                self.assertLess(time.monotonic() - start, 10, msg="Outdated build hasn't been cancelled")
+            finally:
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+
+        for polling in [False, True]:
+            with self.subTest(polling=polling):
+                project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=STUBS_PARAMETERS)
+                watcher = stm32pio.watch.ProjectWatcher(project, with_build=True, debounce=0.2, poll_interval=0.1,
+                                                        polling=polling)
+                loop = asyncio.new_event_loop()
+                try:
+                    loop.run_until_complete(scenario(watcher))
+                finally:
+                    loop.close()
+
+    def test_watch_changes_during_generation(self):
+        """
+        Sources changes coming during the code generation shouldn't be lost: they are re-checked with the plan after the
+        run and trigger the new one if the project is not up-to-date
+        """
+        project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters={ 'project': { 'board': TEST_PROJECT_BOARD } })
+        watcher = stm32pio.watch.ProjectWatcher(project, with_build=True, polling=True)
+        edited = FIXTURE_PATH.joinpath('Src', 'main.c')
+
+        async def run_pipeline(**kwargs):
+            watcher.generating = True
+            self.assertEqual(watcher._filter({ edited, project.ioc_file }), { project.ioc_file },
+                             msg="Sources changes haven't been put aside during the generation")
+            watcher.generating = False
+
+        for stale, expected in [(True, { edited }), (False, set())]:
+            with self.subTest(stale=stale):
+                watcher.pending.clear()
+                watcher.project.run_pipeline = run_pipeline
+                watcher.project.plan = lambda **kwargs: [
+                    stm32pio.lib.PipelineStep('build', stm32pio.lib.ProjectStage.BUILT, stale, 'test')]
+                loop = asyncio.new_event_loop()
+                try:
+                    loop.run_until_complete(watcher._run())
+                finally:
+                    loop.close()
+                self.assertEqual(watcher.pending, expected)
+                self.assertEqual(watcher.deferred, set())
+
     def test_pio_init(self):
         """
         Consider that the existence of a 'platformio.ini' file showing a successful PlatformIO project initialization.
@@ -221,6 +590,150 @@ class TestUnit(CustomTestCase):
         self.assertGreater(len(boards), 0, msg="boards list is empty")
         self.assertTrue(all(isinstance(item, str) for item in boards), msg="some list items are not strings")
 
+    @unittest.skipUnless(STUBS_SUPPORTED, "stub tools are not available on this platform")
+    def test_platformio_boards_cache(self):
+        """
+        Boards should be obtained from the PlatformIO only once and then served from the disk. Outdated list should be
+        served too while the new one is being requested in the background
+        """
+        cache_path = FIXTURE_PATH.joinpath('boards_cache.json')
+        platformio_cmd = STUBS_PARAMETERS['app']['platformio_cmd']
+
+        boards = stm32pio.util.PlatformIOBoardsCache(path=cache_path).get(platformio_cmd)
+        self.assertIn(TEST_PROJECT_BOARD, boards)
+        self.assertTrue(cache_path.is_file(), msg="Cache hasn't been saved")
+
+        with unittest.mock.patch('stm32pio.util.query_platformio_boards',
+                                 side_effect=Exception("should not be called")):
+            cache = stm32pio.util.PlatformIOBoardsCache(path=cache_path)  # new instance has an empty memory
+            self.assertEqual(cache.get(platformio_cmd), boards, msg="Boards haven't been loaded from the disk")
+            self.assertTrue(cache.contains(platformio_cmd, TEST_PROJECT_BOARD))
+            self.assertFalse(cache.contains(platformio_cmd, 'not_a_board'))
+
+        with unittest.mock.patch('stm32pio.util.query_platformio_boards', return_value=['new_board']) as query:
+            cache = stm32pio.util.PlatformIOBoardsCache(path=cache_path, ttl=0)
+            self.assertEqual(cache.get(platformio_cmd), boards, msg="Stale boards haven't been served")
+            cache.ttl = 60 * 60  # prevent subsequent refreshes
+            for _ in range(50):  # wait for the background refresh
+                if cache.contains(platformio_cmd, 'new_board'):
+                    break
+                time.sleep(0.1)
+            query.assert_called_once_with(platformio_cmd)
+            self.assertEqual(cache.get(platformio_cmd), ['new_board'], msg="Boards haven't been refreshed")
+
+    @unittest.skipUnless(STUBS_SUPPORTED, "stub tools are not available on this platform")
+    def test_platformio_boards_cache_failure(self):
+        """
+        Failed boards request should be remembered for a while so the next projects neither repeat it nor warn again
+        """
+        cache_path = FIXTURE_PATH.joinpath('boards_cache.json')
+        platformio_cmd = STUBS_PARAMETERS['app']['platformio_cmd']
+
+        with unittest.mock.patch('stm32pio.util.query_platformio_boards', side_effect=Exception("broken")) as query:
+            cache = stm32pio.util.PlatformIOBoardsCache(path=cache_path)
+            with self.assertRaises(Exception, msg="First failure hasn't been reported"):
+                cache.contains(platformio_cmd, TEST_PROJECT_BOARD)
+            self.assertIsNone(cache.contains(platformio_cmd, TEST_PROJECT_BOARD), msg="Failure hasn't been remembered")
+            cache = stm32pio.util.PlatformIOBoardsCache(path=cache_path)  # failure should be loaded from the disk too
+            self.assertIsNone(cache.contains(platformio_cmd, TEST_PROJECT_BOARD))
+            self.assertEqual(query.call_count, 1, msg="Failed request has been repeated")
+
+            with unittest.mock.patch.object(stm32pio.util, 'platformio_boards_cache', cache), \
+                    self.assertLogs(level='DEBUG') as logs:
+                stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=STUBS_PARAMETERS)
+            self.assertFalse(any(record.levelno >= logging.WARNING for record in logs.records),
+                             msg="Remembered failure has been reported again")
+
+        with unittest.mock.patch('stm32pio.util.query_platformio_boards', return_value=[TEST_PROJECT_BOARD]):
+            cache = stm32pio.util.PlatformIOBoardsCache(path=cache_path, failure_ttl=0)
+            self.assertTrue(cache.contains(platformio_cmd, TEST_PROJECT_BOARD), msg="Request hasn't been retried")
+
+    def test_config_file_cache(self):
+        """
+        stm32pio.ini should be parsed once and re-read only when changed, the overrides should still be detected
+        """
+        project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters={ 'project': { 'board': TEST_PROJECT_BOARD } })
+        project.save_config()
+        config_file = FIXTURE_PATH.joinpath(stm32pio.settings.config_file_name)
+        self.assertIs(stm32pio.lib.ConfigFile.load(config_file), stm32pio.lib.ConfigFile.load(config_file),
+                      msg="Unchanged file has been parsed again")
+
+        with self.assertLogs(level='INFO') as logs:
+            project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters={ 'project': { 'board': 'nucleo_f429zi' } })
+        self.assertTrue(any("'board' has taken a precedence" in message for message in logs.output),
+                        msg="Override has not been reported")
+        self.assertEqual(project.config.get('project', 'board'), 'nucleo_f429zi')
+
+        config_file.write_text(config_file.read_text().replace(TEST_PROJECT_BOARD, 'discovery_f4'))
+        project = stm32pio.lib.Stm32pio(FIXTURE_PATH)
+        self.assertEqual(project.config.get('project', 'board'), 'discovery_f4', msg="Changed file hasn't been re-read")
+
+    def test_ioc_file(self):
+        """
+        .ioc file should be parsed correctly, shared between the calls and re-parsed after a modification
+        """
+        project = stm32pio.lib.Stm32pio(FIXTURE_PATH)
+        ioc = project.ioc
+        self.assertEqual(ioc.mcu_family, 'STM32F0', msg="Mcu.Family is incorrect")
+        self.assertEqual(ioc.mcu_name, 'STM32F031K6Tx', msg="Mcu.Name is incorrect")
+        self.assertEqual(ioc.project_manager['ProjectName'], 'stm32pio-test-project', msg="ProjectManager is incorrect")
+        self.assertEqual(ioc.value('NVIC.HardFault_IRQn').split(':')[0], 'true', msg="Escapes are not decoded")
+        self.assertIsNone(ioc.value('No.Such.Key'), msg="Fallback value hasn't been returned")
+        self.assertIs(stm32pio.lib.IocFile.load(project.ioc_file), ioc, msg="Parsed file hasn't been reused")
+        digest = ioc.digest
+
+        with project.ioc_file.open(mode='a') as ioc_file:
+            ioc_file.write('Mcu.UserName=STM32F031K6Tx\\u0021\n')
+        reloaded = project.ioc
+        self.assertIsNot(reloaded, ioc, msg="Modified file hasn't been re-parsed")
+        self.assertEqual(reloaded.value('Mcu.UserName'), 'STM32F031K6Tx!', msg="New value hasn't been read")
+        self.assertNotEqual(reloaded.digest, digest, msg="Digest hasn't been changed")
+
+        for case, content in [('empty', b''), ('binary', b'\x7fELF\x00\x01=\x02'), ('not utf-8', b'Key=\xff\xfe\n'),
+                              ('no keys', b'#MicroXplorer Configuration settings - do not modify\nnothing here\n')]:
+            with self.subTest(case=case):
+                broken_file = FIXTURE_PATH.joinpath('broken.ioc')
+                broken_file.write_bytes(content)
+                with self.assertRaises(Exception, msg="Incorrect file has been accepted"):
+                    stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters={ 'project': { 'ioc_file': 'broken.ioc' } })
+
+    def test_log_pipe(self):
+        """
+        LogPipe should log every line and store the output according to the capture mode
+        """
+        for capture, expected in [(stm32pio.util.LogPipeCapture.NONE, ''),
+                                  (stm32pio.util.LogPipeCapture.TAIL, 'line 8\nline 9\n'),
+                                  (stm32pio.util.LogPipeCapture.FULL, 'первая\n' +
+                                   ''.join(f'line {i}\n' for i in range(10)))]:
+            with self.subTest(capture=capture):
+                logger = logging.getLogger('stm32pio.tests.log_pipe')
+                with self.assertLogs(logger, level=logging.DEBUG) as logs:
+                    with stm32pio.util.LogPipe(logger, logging.DEBUG, capture=capture, tail_lines=2,
+                                               encoding='utf-8') as log:
+                        first_line = 'первая\r\n'.encode('utf-8')
+                        os.write(log.pipe, first_line[:3])  # split the multibyte character
+                        os.write(log.pipe, first_line[3:])
+                        for i in range(10):
+                            os.write(log.pipe, f'line {i}\n'.encode('utf-8'))
+                self.assertEqual(len(logs.records), 11, msg="Not every line has been logged")
+                self.assertEqual(logs.records[0].getMessage(), 'первая', msg="Line hasn't been decoded correctly")
+                self.assertEqual(log.value, expected, msg="Captured output is incorrect")
+
+        with self.subTest(case='inherited pipe'), unittest.mock.patch.object(stm32pio.settings,
+                                                                              'log_pipe_drain_timeout', 0.5):
+            logger = logging.getLogger('stm32pio.tests.log_pipe')
+            # The grandchild inherits the pipe and keeps it open after its parent has exited
+            spawn_grandchild = "import subprocess, sys; " \
+                               "subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(5)']); print('done')"
+            start = time.monotonic()
+            with self.assertLogs(logger, level=logging.DEBUG) as logs:
+                with stm32pio.util.LogPipe(logger, logging.DEBUG, encoding='utf-8') as log:
+                    subprocess.run([PYTHON_EXEC, '-c', spawn_grandchild], stdout=log.pipe, stderr=log.pipe)
+            self.assertLess(time.monotonic() - start, 10, msg="LogPipe has waited for the grandchild")
+            self.assertEqual(log.value, 'done\n', msg="Output of the child has been lost")
+            self.assertTrue(any(record.levelno == logging.WARNING for record in logs.records),
+                            msg="Pending output hasn't been reported")
+
     def test_ioc_file_provided(self):
         """
         Test a correct handling of a case when the .ioc file was specified instead of the containing directory
@@ -235,3 +748,100 @@ class TestUnit(CustomTestCase):
                         msg="Provided .ioc file hasn't been chosen")
         self.assertEqual(project.config.get('project', 'ioc_file'), '42.ioc',
                          msg="Provided .ioc file is not in the config")
+
+    def test_state(self):
+        """
+        Emulate the project files appearing stage by stage and check that the (cached) state follows them. No external
+        tools are needed for this
+        """
+        project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters={'project': {'board': TEST_PROJECT_BOARD}})
+        self.assertEqual(project.state.current_stage, stm32pio.lib.ProjectStage.EMPTY)
+
+        project.save_config()
+        self.assertEqual(project.state.current_stage, stm32pio.lib.ProjectStage.INITIALIZED)
+
+        for directory, file in [('Inc', 'main.h'), ('Src', 'main.c')]:
+            FIXTURE_PATH.joinpath(directory).mkdir()
+            FIXTURE_PATH.joinpath(directory, file).touch()
+        self.assertEqual(project.state.current_stage, stm32pio.lib.ProjectStage.GENERATED)
+
+        FIXTURE_PATH.joinpath('platformio.ini').write_text(
+            f"[env:{TEST_PROJECT_BOARD}]\nboard = {TEST_PROJECT_BOARD}\n")
+        self.assertEqual(project.state.current_stage, stm32pio.lib.ProjectStage.PIO_INITIALIZED)
+
+        project.patch()
+        self.assertEqual(project.state.current_stage, stm32pio.lib.ProjectStage.PATCHED)
+
+        firmware_dir = FIXTURE_PATH.joinpath('.pio', 'build', TEST_PROJECT_BOARD)
+        firmware_dir.mkdir(parents=True)
+        firmware_dir.joinpath('firmware.elf').touch()
+        project.invalidate_state()
+        self.assertEqual(project.state.current_stage, stm32pio.lib.ProjectStage.BUILT)
+
+        # Custom build folder should be respected ([platformio] section is the last one after the patch)
+        with FIXTURE_PATH.joinpath('platformio.ini').open(mode='a') as platformio_ini:
+            platformio_ini.write("build_dir = ${platformio.workspace_dir}/custom_build\n")
+        self.assertEqual(project.state.current_stage, stm32pio.lib.ProjectStage.PATCHED)
+        firmware_dir = FIXTURE_PATH.joinpath('.pio', 'custom_build', TEST_PROJECT_BOARD)
+        firmware_dir.mkdir(parents=True)
+        firmware_dir.joinpath('firmware.bin').touch()
+        self.assertEqual(project.state.current_stage, stm32pio.lib.ProjectStage.BUILT)
+
+        # Returned state is a copy so the caller can modify it freely
+        state = project.state
+        state.pop(stm32pio.lib.ProjectStage.UNDEFINED)
+        self.assertIn(stm32pio.lib.ProjectStage.UNDEFINED, project.state)
+
+        shutil.rmtree(FIXTURE_PATH.joinpath('Src'))
+        self.assertFalse(project.state.is_consistent, msg="Removed folder hasn't been noticed")
+
+    def test_clean(self):
+        """
+        Project should be clean right after the call while the files are deleted in the background. Trash left by the
+        interrupted runs should be collected by the next instance
+        """
+        trash_dir = FIXTURE_PATH.joinpath(stm32pio.settings.trash_dir_name)
+        leftover = trash_dir.joinpath('clean-interrupted', '.pio')
+        leftover.mkdir(parents=True)
+        leftover.joinpath('firmware.elf').touch()
+
+        project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters={'project': {'board': TEST_PROJECT_BOARD}})
+        project.save_config()
+        for directory in range(10):
+            build_dir = FIXTURE_PATH.joinpath('.pio', 'build', TEST_PROJECT_BOARD, f'dir_{directory}')
+            build_dir.mkdir(parents=True)
+            for file in range(10):
+                build_dir.joinpath(f'object_{file}.o').touch()
+        FIXTURE_PATH.joinpath('platformio.ini').touch()
+
+        project.clean()
+        self.assertEqual(project.state.current_stage, stm32pio.lib.ProjectStage.EMPTY)
+        self.assertEqual([child.name for child in FIXTURE_PATH.iterdir() if child.name != trash_dir.name],
+                         [f"{FIXTURE_PATH.name}.ioc"], msg="Project hasn't been cleaned")
+
+        stm32pio.util.trash_collector.wait(trash_dir)
+        self.assertFalse(trash_dir.exists(), msg="Trash hasn't been collected")
+
+        FIXTURE_PATH.joinpath('platformio.ini').touch()
+        project.clean(wait=True)
+        self.assertEqual([child.name for child in FIXTURE_PATH.iterdir()], [f"{FIXTURE_PATH.name}.ioc"])
+
+    @unittest.skipUnless(STUBS_SUPPORTED, "stub tools are not available on this platform")
+    def test_clean_preserves_service_data(self):
+        """
+        Clean should keep the actions history and the firmware cache located inside the project, the fingerprints of
+        the removed results should be dropped though
+        """
+        parameters = copy.deepcopy(STUBS_PARAMETERS)
+        parameters['app']['firmware_cache_dir'] = '.firmware-cache'
+        project = stm32pio.lib.Stm32pio(FIXTURE_PATH, parameters=parameters)
+        project.run_pipeline(with_build=True)
+        runs = len(project.history.records())
+
+        project.clean(wait=True)
+        self.assertEqual(sorted(child.name for child in FIXTURE_PATH.iterdir()),
+                         sorted([f"{FIXTURE_PATH.name}.ioc", stm32pio.settings.service_dir_name, '.firmware-cache']))
+        self.assertEqual(len(project.history.records()), runs, msg="History has been lost")
+        self.assertEqual(len(list(FIXTURE_PATH.joinpath('.firmware-cache').iterdir())), 1,
+                         msg="Firmware cache has been lost")
+        self.assertIsNone(project._read_fingerprint('generate_code'), msg="Stale fingerprint has been kept")